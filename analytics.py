@@ -0,0 +1,237 @@
+# analytics.py - Vectorized cohort analytics over stored intake, BP and adherence history
+#
+# Usage: python analytics.py [days]   (prints a JSON report for STORAGE_PATH)
+
+import json
+import sqlite3
+import sys
+from datetime import date, timedelta
+
+try:
+    import numpy as np
+except ImportError:  # requirements-analytics.txt: only these offline reports need NumPy, the bot does not
+    np = None
+
+from storage import STORAGE_PATH, local_day
+
+SODIUM_LIMIT = 1500  # mg per day, the patients' target
+EXERCISE_GOAL = 30  # minutes per day
+CORRELATION_LAGS = (0, 1, 2, 3)
+# Patients need this many paired days before they count towards a correlation
+MIN_PAIRED_DAYS = 3
+
+# Each query yields (user_id, day offset from the first day, values...)
+_DAY_OFFSET = "CAST(julianday(day) - julianday(?) AS INTEGER)"
+_QUERIES = {
+    'intake': f"""
+        SELECT user_id, {_DAY_OFFSET}, sodium, calories FROM daily_totals WHERE day BETWEEN ? AND ?
+        UNION ALL
+        SELECT user_id, {_DAY_OFFSET}, sodium, calories FROM daily_intake WHERE day BETWEEN ? AND ?
+    """,
+    'bp': f"""
+        SELECT user_id, {_DAY_OFFSET}, AVG(systolic), AVG(diastolic) FROM bp_readings
+        WHERE day BETWEEN ? AND ? GROUP BY user_id, day
+    """,
+    'medication': f"SELECT user_id, {_DAY_OFFSET}, value FROM medication_taken WHERE day BETWEEN ? AND ?",
+    'exercise': f"SELECT user_id, {_DAY_OFFSET}, value FROM exercise_log WHERE day BETWEEN ? AND ?"
+}
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("analytics needs NumPy: pip install -r requirements-analytics.txt")
+
+
+class Cohort:
+    """Per-user x per-day matrices over one window of days.
+
+    Rows follow user_ids and columns follow days (oldest first). Intake and
+    BP matrices hold NaN where nothing was recorded; medication is a taken
+    flag and exercise is minutes, both zero when nothing was logged. A
+    patient counts as enrolled from the first day with any record, so
+    adherence is not diluted by the days before they joined.
+    """
+
+    def __init__(self, user_ids, days, sodium, calories, systolic, diastolic, medication, exercise):
+        _require_numpy()
+        self.user_ids = list(user_ids)
+        self.days = list(days)
+        self.sodium = sodium
+        self.calories = calories
+        self.systolic = systolic
+        self.diastolic = diastolic
+        self.medication = medication
+        self.exercise = exercise
+        active = np.isfinite(sodium) | np.isfinite(systolic) | medication | (exercise > 0)
+        self.first_day = np.where(active.any(axis=1), active.argmax(axis=1), len(self.days))
+
+    @property
+    def enrolled(self):
+        """Boolean matrix of the days each patient was enrolled"""
+        return np.arange(len(self.days)) >= self.first_day[:, None]
+
+
+def _columns(conn, query, params, users):
+    """Run a query and return its columns as arrays, with user ids mapped to row numbers"""
+    rows = conn.execute(query, params).fetchall()
+    if not rows:
+        return None
+    columns = list(zip(*rows))
+    user_rows = np.fromiter((users.setdefault(user_id, len(users)) for user_id in columns[0]),
+                            dtype=np.intp, count=len(rows))
+    return [user_rows] + [np.asarray(column, dtype=np.float64) for column in columns[1:]]
+
+
+def load_cohort(path=STORAGE_PATH, days=90, end_day=None):
+    """Materialize the last `days` days (ending end_day, default today) of every patient in the database"""
+    _require_numpy()
+    end_day = end_day or local_day()
+    first_day = (date.fromisoformat(end_day) - timedelta(days=days - 1)).isoformat()
+    window = (first_day, first_day, end_day)
+    users = {}
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        intake = _columns(conn, _QUERIES['intake'], window + window, users)
+        bp = _columns(conn, _QUERIES['bp'], window, users)
+        medication = _columns(conn, _QUERIES['medication'], window, users)
+        exercise = _columns(conn, _QUERIES['exercise'], window, users)
+    finally:
+        conn.close()
+
+    shape = (len(users), days)
+    matrices = {
+        'sodium': np.full(shape, np.nan, dtype=np.float32),
+        'calories': np.full(shape, np.nan, dtype=np.float32),
+        'systolic': np.full(shape, np.nan, dtype=np.float32),
+        'diastolic': np.full(shape, np.nan, dtype=np.float32),
+        'medication': np.zeros(shape, dtype=bool),
+        'exercise': np.zeros(shape, dtype=np.float32)
+    }
+    for columns, names in ((intake, ('sodium', 'calories')), (bp, ('systolic', 'diastolic')),
+                           (medication, ('medication',)), (exercise, ('exercise',))):
+        if columns is None:
+            continue
+        user_rows, offsets = columns[0], columns[1].astype(np.intp)
+        for name, values in zip(names, columns[2:]):
+            matrices[name][user_rows, offsets] = values
+    day_names = [(date.fromisoformat(first_day) + timedelta(days=i)).isoformat() for i in range(days)]
+    return Cohort(users, day_names, **matrices)
+
+
+def weekly_means(matrix):
+    """(per-patient [users x weeks], cohort [weeks]) means over whole 7-day weeks ending on the last day"""
+    users, days = matrix.shape
+    weeks = days // 7
+    by_week = matrix[:, days - weeks * 7:].reshape(users, weeks, 7)
+    recorded = np.isfinite(by_week)
+    totals = np.where(recorded, by_week, 0).sum(axis=2, dtype=np.float64)
+    counts = recorded.sum(axis=2)
+    # NaN (without a warning) for weeks with nothing recorded
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return totals / counts, totals.sum(axis=0) / counts.sum(axis=0)
+
+
+def days_over(matrix, limit=SODIUM_LIMIT):
+    """(days over limit, days recorded) per patient"""
+    recorded = np.isfinite(matrix)
+    over = np.greater(matrix, limit, where=recorded, out=np.zeros(matrix.shape, dtype=bool))
+    return over.sum(axis=1), recorded.sum(axis=1)
+
+
+def lagged_correlation(x, y, lags=CORRELATION_LAGS, min_pairs=MIN_PAIRED_DAYS):
+    """Pearson r between x on day t and y on day t + lag, within patients and pooled.
+
+    Each patient's pairs are centred on that patient's own means first, so
+    the result says whether a saltier-than-usual day is followed by a
+    higher-than-usual reading, not merely that saltier eaters run higher.
+    Returns {lag: {'r', 'pairs', 'patients'}} with r None when undefined.
+    """
+    # Per-patient sums over the paired days come out as row-wise dot products
+    # of zero-filled values and presence masks - no per-lag masking or copies
+    has_x = np.isfinite(x).astype(np.float64)
+    has_y = np.isfinite(y).astype(np.float64)
+    x = np.where(has_x > 0, x, 0.0)
+    y = np.where(has_y > 0, y, 0.0)
+    x_squared = x * x
+    y_squared = y * y
+    days = x.shape[1]
+    result = {}
+    for lag in lags:
+        end = days - lag
+        x_lag, y_lag = slice(0, end), slice(lag, days)
+        pairs = _row_dot(has_x[:, x_lag], has_y[:, y_lag])
+        sum_x = _row_dot(x[:, x_lag], has_y[:, y_lag])
+        sum_y = _row_dot(y[:, y_lag], has_x[:, x_lag])
+        sum_xx = _row_dot(x_squared[:, x_lag], has_y[:, y_lag])
+        sum_yy = _row_dot(y_squared[:, y_lag], has_x[:, x_lag])
+        sum_xy = _row_dot(x[:, x_lag], y[:, y_lag])
+        keep = pairs >= max(min_pairs, 1)
+        pairs, sum_x, sum_y = pairs[keep], sum_x[keep], sum_y[keep]
+        # Centred on each patient's own means
+        covariance = (sum_xy[keep] - sum_x * sum_y / pairs).sum()
+        variance_x = (sum_xx[keep] - sum_x * sum_x / pairs).sum()
+        variance_y = (sum_yy[keep] - sum_y * sum_y / pairs).sum()
+        denominator = np.sqrt(variance_x * variance_y)
+        r = float(covariance / denominator) if denominator > 0 else None
+        result[lag] = {'r': r, 'pairs': int(pairs.sum()), 'patients': int(keep.sum())}
+    return result
+
+
+def _row_dot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def adherence(cohort):
+    """(medication, exercise-goal) share of enrolled days per patient; NaN if never enrolled"""
+    enrolled = cohort.enrolled
+    enrolled_days = enrolled.sum(axis=1)
+    taken = (cohort.medication & enrolled).sum(axis=1)
+    exercised = ((cohort.exercise >= EXERCISE_GOAL) & enrolled).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return taken / enrolled_days, exercised / enrolled_days
+
+
+def _plain(values):
+    """JSON-friendly list: floats rounded, NaN as None"""
+    return [None if np.isnan(value) else round(float(value), 1) for value in values]
+
+
+def _mean(values):
+    finite = values[np.isfinite(values)]
+    return round(float(finite.mean()), 3) if finite.size else None
+
+
+def cohort_report(cohort, lags=CORRELATION_LAGS):
+    """Cohort-level summary of every aggregate, as plain JSON-serializable values"""
+    _, sodium_weekly = weekly_means(cohort.sodium)
+    _, systolic_weekly = weekly_means(cohort.systolic)
+    over, recorded = days_over(cohort.sodium)
+    medication, exercise = adherence(cohort)
+    logged = recorded > 0
+    return {
+        'patients': len(cohort.user_ids),
+        'first_day': cohort.days[0] if cohort.days else None,
+        'last_day': cohort.days[-1] if cohort.days else None,
+        'sodium': {
+            'weekly_mean': _plain(sodium_weekly),
+            'days_over_limit_mean': round(float(over[logged].mean()), 2) if logged.any() else None,
+            'share_of_days_over_limit': round(float(over.sum() / recorded.sum()), 3) if recorded.sum() else None,
+            'patients_ever_over': int((over > 0).sum())
+        },
+        'systolic': {'weekly_mean': _plain(systolic_weekly)},
+        'sodium_systolic_correlation': lagged_correlation(cohort.sodium, cohort.systolic, lags),
+        'adherence': {
+            'medication_mean': _mean(medication),
+            'exercise_goal_mean': _mean(exercise),
+            'patients_below_80pct_medication': int((medication < 0.8).sum())
+        }
+    }
+
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 90
+    print(json.dumps(cohort_report(load_cohort(days=days)), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
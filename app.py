@@ -1,291 +1,269 @@
 # app.py
 
+import logging
 import os
-from datetime import datetime
-from flask import Flask, request, abort
+import time
+import requests
+from flask import Flask, request, abort, jsonify
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageMessage
 from dotenv import load_dotenv
-from gemini_handler import analyze_with_gemini, analyze_image_with_gemini, init_storage, get_daily_summary
+from gemini_handler import analyze_with_gemini, analyze_image_with_gemini, init_storage, get_daily_summary, image_cache, text_cache, summary_cache, token_usage, gemini_guard, intent_router, image_preprocessor, photo_index, forget_user_photos
 from patient_profiles import MR_LIN_PROFILE, get_weekly_meal_plan, get_bp_log_format
+from job_queue import JobQueue, BatchRunner
+import http_pool
+from http_pool import PooledLineHttpClient, line_session
+from idempotency import EventDeduplicator
+from commands import CommandRouter, HELP_TEXT, TIPS_TEXT
+from shared_state import open_state, STATE_BACKEND
+from storage import local_day, parse_bp
 
 # Load environment variables
 load_dotenv()
 
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'),
+                    format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 # Initialize LINE bot
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+# Outbound calls share one keep-alive connection pool (see http_pool.py)
+line_bot_api = LineBotApi(
+    os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
+    timeout=line_session.timeout,
+    http_client=PooledLineHttpClient
+)
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
 
-# Simple in-memory storage for demo
-user_daily_intake = {}
-user_bp_records = {}  # Store BP measurements
-user_medication_taken = {}  # Track medication
-user_exercise_log = {}  # Track exercise
-user_first_message = {}  # Track if user is new
+# Webhook dispatch: 'sync' handles events inside the request,
+# 'queue' acknowledges at once and lets a worker pool do the handling
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', 'sync')
+job_queue = JobQueue(
+    workers=int(os.getenv('WORKER_POOL_SIZE', '4')),
+    max_depth=int(os.getenv('JOB_QUEUE_DEPTH', '100'))
+)
+# Sync mode: how many users of one multi-event webhook are handled at once
+# (each user's own events always run one after another, in order)
+batch_runner = BatchRunner(workers=int(os.getenv('EVENT_CONCURRENCY', '8')))
+
+# Per-user state (intake, BP records, medication, exercise, first message),
+# shared by every worker process when STATE_BACKEND=server
+user_state = open_state()
+
+# LINE redelivers events when we are slow; each event id is handled once,
+# across every worker process when the state is shared
+seen_events = EventDeduplicator(shared=user_state if STATE_BACKEND == 'server' else None)
 
 # Make it accessible to other modules
-def get_user_daily_intake():
-    return user_daily_intake
+def get_user_daily_intake(user_id):
+    return user_state.get('daily_intake', user_id, {})
 
 # Initialize gemini_handler with storage reference
-init_storage(user_daily_intake)
+init_storage(user_state)
 
 @app.route("/")
 def home():
     return "NutriLINE - 林先生的營養追蹤助手 🥗"
 
+@app.route("/metrics")
+def metrics():
+    return jsonify({
+        'dispatch_mode': DISPATCH_MODE,
+        'job_queue': job_queue.stats(),
+        'event_batches': batch_runner.stats(),
+        'event_dedup': seen_events.stats(),
+        'image_cache': image_cache.stats(),
+        'image_preprocessing': image_preprocessor.stats(),
+        'photo_duplicates': photo_index.stats(),
+        'text_cache': text_cache.stats(),
+        'summary_cache': summary_cache.stats(),
+        'gemini_tokens': token_usage.stats(),
+        'gemini_calls': gemini_guard.stats(),
+        'intents': intent_router.stats(),
+        'commands': commands.stats(),
+        'http': http_pool.stats(),
+        'state': user_state.stats()
+    })
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
     
+    if DISPATCH_MODE == 'queue':
+        # Queue is full - let LINE redeliver instead of blocking the worker.
+        # All of the body's events or none, so a redelivery never repeats any
+        if not job_queue.submit_batch(dispatch_event, events, key=event_user_id):
+            abort(503)
+        return 'OK'
+    
+    # Different users in parallel, each user's events in order
+    batch_runner.run(events, dispatch_event, key=event_user_id)
     return 'OK'
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event):
-    user_id = event.source.user_id
-    user_message = event.message.text.strip()
-    
-    # Check if this is user's first message
-    if user_id not in user_first_message:
-        user_first_message[user_id] = True
-        # Send Mr. Lin's personalized greeting
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=MR_LIN_PROFILE['initial_greeting'])
-        )
-        return
-    
-    # Handle /help command
-    if user_message.lower() == '/help' or user_message == '幫助' or user_message == '說明':
-        help_text = """🥗 林先生的營養追蹤助手
+def event_user_id(event):
+    """Ordering key for an event: its sender (None for sources without a user id)"""
+    return getattr(event.source, 'user_id', None)
 
-📱 主要功能：
-• 分析食物照片並記錄營養
-• 追蹤每日鈉攝取（限1500mg）
-• 提醒健康飲食選擇
-• 記錄血壓和運動
-• 藥物提醒
+def dispatch_event(event):
+    """Route a parsed webhook event to its message handler"""
+    if not isinstance(event, MessageEvent):
+        return
+    if isinstance(event.message, TextMessage):
+        handle_text_message(event)
+    elif isinstance(event.message, ImageMessage):
+        handle_image_message(event)
 
-📋 指令列表：
-/help - 顯示這個說明
-/today - 今日營養摘要
-/plan - 查看一週DASH飲食計畫
-/bp - 記錄血壓（例：/bp 145/90）
-/med - 記錄服藥
-/exercise - 記錄運動
-/tips - 飲食小技巧
-/clear - 重置今天的紀錄
+# Text commands; static replies are rendered once here and reused for every request
+commands = CommandRouter()
+GREETING_MESSAGE = TextSendMessage(text=MR_LIN_PROFILE['initial_greeting'])
+commands.static('help', TextSendMessage(text=HELP_TEXT), aliases=('/help', '幫助', '說明'))
+commands.static('tips', TextSendMessage(text=TIPS_TEXT), aliases=('/tips', '小技巧'))
+commands.static('plan', TextSendMessage(text=get_weekly_meal_plan()), aliases=('/plan', '飲食計畫'))
 
-💡 記住我們的目標：
-✅ 早餐：全麥吐司+水煮蛋
-✅ 牛肉麵不喝湯
-✅ 每天走路30分鐘
-✅ 按時服用Amlodipine
+@commands.command('today', aliases=('/today', '今天'))
+def today_command(user_id, args):
+    return TextSendMessage(text=get_daily_summary(user_id))
 
-林太太有幫您準備餐點嗎？記得傳照片給我！"""
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=help_text)
-        )
-        return
-    
-    # Handle /today command
-    elif user_message.lower() == '/today' or user_message == '今天':
-        summary = get_daily_summary(user_id)
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=summary)
-        )
-        return
-    
-    # Handle /plan command - NEW FEATURE
-    elif user_message.lower() == '/plan' or user_message == '飲食計畫':
-        meal_plan = get_weekly_meal_plan()
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=meal_plan)
-        )
-        return
-    
-    # Handle /bp command - NEW FEATURE
-    elif user_message.lower().startswith('/bp'):
-        if len(user_message.split()) > 1:
-            bp_value = user_message.split()[1]
-            if '/' in bp_value:
-                record_bp(user_id, bp_value)
-                response = f"✅ 已記錄血壓：{bp_value}\n"
-                
-                # Check if BP is high
-                systolic = int(bp_value.split('/')[0])
-                if systolic >= 140:
-                    response += "⚠️ 血壓偏高！記得放鬆心情，避免高鈉食物"
-                else:
-                    response += "👍 血壓控制不錯，繼續保持！"
-                
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text=response)
-                )
-            else:
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="請輸入正確格式，例如：/bp 130/85")
-                )
-        else:
-            bp_log = get_bp_log_format(user_id, user_bp_records.get(user_id, []))
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=bp_log)
-            )
-        return
+@commands.command('bp', prefixes=('/bp',))
+def bp_command(user_id, args):
+    if not args:
+        return TextSendMessage(text=get_bp_log_format(user_id, user_state.get('bp_records', user_id)))
+    try:
+        systolic, diastolic = parse_bp(args[0])
+    except ValueError:
+        return TextSendMessage(text="請輸入正確格式，例如：/bp 130/85")
+    trends = record_bp(user_id, systolic, diastolic)
+    response = f"✅ 已記錄血壓：{systolic}/{diastolic}\n"
     
-    # Handle /med command - NEW FEATURE
-    elif user_message.lower() == '/med' or user_message == '吃藥':
-        today = datetime.now().strftime('%Y-%m-%d')
-        if user_id not in user_medication_taken:
-            user_medication_taken[user_id] = {}
-        user_medication_taken[user_id][today] = True
-        
-        response = "✅ 已記錄今天服用 Amlodipine 5mg\n\n"
-        response += "💊 記得：\n"
-        response += "• 每天固定時間服用\n"
-        response += "• 不可配葡萄柚\n"
-        response += "• 配合飲食控制效果更好！"
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=response)
-        )
-        return
+    # Check if BP is high
+    if systolic >= 140:
+        response += "⚠️ 血壓偏高！記得放鬆心情，避免高鈉食物"
+    else:
+        response += "👍 血壓控制不錯，繼續保持！"
+    if trends['count_7d'] > 1:
+        response += f"\n📈 近7天平均：{trends['systolic_7d']:.0f}/{trends['diastolic_7d']:.0f}"
+    return TextSendMessage(text=response)
+
+@commands.command('med', aliases=('/med', '吃藥'))
+def med_command(user_id, args):
+    user_state.set_day_value('medication_taken', user_id, local_day(), True)
     
-    # Handle /exercise command - NEW FEATURE
-    elif user_message.lower().startswith('/exercise') or user_message.startswith('運動'):
-        today = datetime.now().strftime('%Y-%m-%d')
-        if user_id not in user_exercise_log:
-            user_exercise_log[user_id] = {}
-        
-        # Extract minutes if provided
-        parts = user_message.split()
-        if len(parts) > 1 and parts[1].isdigit():
-            minutes = int(parts[1])
-            user_exercise_log[user_id][today] = minutes
-            response = f"✅ 已記錄運動 {minutes} 分鐘！\n\n"
-            if minutes >= 30:
-                response += "🎉 太棒了！達到今天的運動目標！\n"
-                response += "林太太一定很開心看到您這麼努力 💪"
-            else:
-                response += f"💪 加油！再運動 {30-minutes} 分鐘就達標了！"
+    response = "✅ 已記錄今天服用 Amlodipine 5mg\n\n"
+    response += "💊 記得：\n"
+    response += "• 每天固定時間服用\n"
+    response += "• 不可配葡萄柚\n"
+    response += "• 配合飲食控制效果更好！"
+    return TextSendMessage(text=response)
+
+@commands.command('exercise', prefixes=('/exercise', '運動'))
+def exercise_command(user_id, args):
+    today = local_day()
+    # Extract minutes if provided
+    if args and args[0].isdigit():
+        minutes = int(args[0])
+        user_state.set_day_value('exercise_log', user_id, today, minutes)
+        response = f"✅ 已記錄運動 {minutes} 分鐘！\n\n"
+        if minutes >= 30:
+            response += "🎉 太棒了！達到今天的運動目標！\n"
+            response += "林太太一定很開心看到您這麼努力 💪"
         else:
-            user_exercise_log[user_id][today] = 30
-            response = "✅ 已記錄運動 30 分鐘！\n"
-            response += "🎉 太棒了林先生！持續運動對血壓控制很有幫助！"
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=response)
-        )
-        return
-    
-    # Handle /tips command - NEW FEATURE
-    elif user_message.lower() == '/tips' or user_message == '小技巧':
-        tips = """🌟 林先生的健康小技巧
+            response += f"💪 加油！再運動 {30-minutes} 分鐘就達標了！"
+    else:
+        user_state.set_day_value('exercise_log', user_id, today, 30)
+        response = "✅ 已記錄運動 30 分鐘！\n"
+        response += "🎉 太棒了林先生！持續運動對血壓控制很有幫助！"
+    return TextSendMessage(text=response)
 
-🧂 減鈉妙招：
-• 用大蒜、薑、醋、檸檬調味
-• 醬料另外裝，沾著吃
-• 選「乾」的麵食，避免喝湯
-• 少吃醃漬品和加工食品
+@commands.command('clear', aliases=('/clear', '清除'))
+def clear_command(user_id, args):
+    user_state.clear_intake(user_id)
+    forget_user_photos(user_id)
+    return TextSendMessage(text="✅ 林先生，今天的紀錄已經清除囉！\n重新開始記錄，記得要選健康的食物哦～")
 
-🥗 聰明選擇：
-• 早餐店：蛋餅不加醬 > 鐵板麵
-• 便當店：蒸煮 > 油炸，配菜選時蔬
-• 麵店：乾麵 > 湯麵，不喝湯
-• 飲料：無糖茶 > 半糖飲料
+def send_reply(reply_token, message):
+    """Reply through LINE; a failed send is logged, not raised.
 
-🏃 運動建議：
-• 飯後散步最適合
-• 遛狗時多走15分鐘
-• 週末和林太太去公園
-• 爬樓梯代替搭電梯
+    By the time a handler replies it has usually changed state, and a raise
+    would only make LINE redeliver an event that must not run twice.
+    """
+    try:
+        line_bot_api.reply_message(reply_token, message)
+    except (LineBotApiError, requests.RequestException) as e:
+        logger.warning("LINE reply failed: %s", e)
 
-記住：小改變，大健康！為了不像爸爸一樣，我們一起努力 💪"""
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=tips)
-        )
+def send_push(user_id, message):
+    """Push through LINE; a failed send is logged, not raised (see send_reply)"""
+    try:
+        line_bot_api.push_message(user_id, message)
+    except (LineBotApiError, requests.RequestException) as e:
+        logger.warning("LINE push to %s failed: %s", user_id, e)
+
+@handler.add(MessageEvent, message=TextMessage)
+@seen_events.once
+def handle_text_message(event):
+    user_id = event.source.user_id
+    user_message = event.message.text.strip()
+    
+    # Check if this is user's first message
+    start = time.perf_counter()
+    if user_state.set_if_absent('first_message', user_id, True):
+        seen_events.commit()
+        # Send Mr. Lin's personalized greeting; timed like a command (the
+        # state check that decides it, not the LINE send)
+        commands.record('greeting', time.perf_counter() - start)
+        send_reply(event.reply_token, GREETING_MESSAGE)
         return
     
-    # Handle /clear command
-    elif user_message.lower() == '/clear' or user_message == '清除':
-        user_daily_intake[user_id] = {
-            'calories': 0, 'protein': 0, 'carbs': 0, 
-            'fat': 0, 'sodium': 0, 'meals': []
-        }
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="✅ 林先生，今天的紀錄已經清除囉！\n重新開始記錄，記得要選健康的食物哦～")
-        )
+    matched = commands.match(user_message)
+    if matched:
+        name, args = matched
+        message = commands.run(name, user_id, args)
+        seen_events.commit()
+        send_reply(event.reply_token, message)
         return
     
     # For everything else, use Gemini's natural language understanding
+    start = time.perf_counter()
     response = analyze_with_gemini(user_message, user_id)
+    # The meal may be logged now - a redelivery must not log it again
+    seen_events.commit()
+    commands.record('chat', time.perf_counter() - start)
     
     # Send response
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=response)
-    )
+    send_reply(event.reply_token, TextSendMessage(text=response))
 
 @handler.add(MessageEvent, message=ImageMessage)
+@seen_events.once
 def handle_image_message(event):
     user_id = event.source.user_id
     
     # Send analyzing message
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text="📸 讓我看看林先生今天吃了什麼...")
-    )
+    send_reply(event.reply_token, TextSendMessage(text="📸 讓我看看林先生今天吃了什麼..."))
     
     try:
         # Analyze image with Gemini
         analysis = analyze_image_with_gemini(event.message.id, line_bot_api, user_id)
-        
-        # Send results
-        line_bot_api.push_message(
-            user_id,
-            TextSendMessage(text=analysis)
-        )
-        
-    except Exception as e:
-        line_bot_api.push_message(
-            user_id,
-            TextSendMessage(text="哎呀，照片有點問題欸，林先生再傳一次試試看？")
-        )
-
-def record_bp(user_id, bp_value):
-    """Record blood pressure measurement"""
-    if user_id not in user_bp_records:
-        user_bp_records[user_id] = []
-    
-    user_bp_records[user_id].append({
-        'datetime': datetime.now().strftime('%Y-%m-%d %H:%M'),
-        'value': bp_value
-    })
+    except Exception:
+        logger.exception("Image analysis failed for message %s", event.message.id)
+        send_push(user_id, TextSendMessage(text="哎呀，照片有點問題欸，林先生再傳一次試試看？"))
+        return
+    # The meal may be logged now - a redelivery must not log it again
+    seen_events.commit()
     
-    # Keep only last 7 records
-    if len(user_bp_records[user_id]) > 7:
-        user_bp_records[user_id] = user_bp_records[user_id][-7:]
+    # Send results
+    send_push(user_id, TextSendMessage(text=analysis))
+
+def record_bp(user_id, systolic, diastolic):
+    """Record blood pressure measurement; returns the updated trends"""
+    return user_state.add_bp_reading(user_id, systolic, diastolic)
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,163 @@
+# bench_analytics.py - Cohort aggregates over 10k patients x 365 days: NumPy vs nested-dict loops
+#
+# Usage: python benchmarks/bench_analytics.py [patients] [days]
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+from analytics import (Cohort, SODIUM_LIMIT, adherence, cohort_report, days_over, lagged_correlation,
+                       load_cohort, weekly_means)
+from storage import TABLES
+
+END_DAY = '2026-10-18'
+# Patients materialized through SQLite (the whole cohort would take minutes to insert)
+LOAD_PATIENTS = 1000
+
+
+def synthetic_cohort(patients, days, seed=0):
+    """Realistic gaps: ~80% of days logged, BP on ~60%, systolic follows yesterday's sodium"""
+    rng = np.random.default_rng(seed)
+    shape = (patients, days)
+    baseline = rng.normal(1500, 300, (patients, 1))
+    sodium = (baseline + rng.normal(0, 400, shape)).clip(200).astype(np.float32)
+    systolic = rng.normal(132, 8, (patients, 1)) + rng.normal(0, 6, shape)
+    systolic[:, 1:] += 0.004 * (sodium[:, :-1] - baseline)
+    diastolic = systolic * 0.62 + rng.normal(0, 4, shape)
+    sodium[rng.random(shape) > 0.8] = np.nan
+    missing_bp = rng.random(shape) > 0.6
+    systolic[missing_bp] = np.nan
+    diastolic[missing_bp] = np.nan
+    medication = rng.random(shape) < rng.uniform(0.6, 1.0, (patients, 1))
+    exercise = np.where(rng.random(shape) < 0.5, rng.integers(5, 60, shape), 0).astype(np.float32)
+    user_ids = [f"U{i:032x}" for i in range(patients)]
+    day_names = [str(np.datetime64(END_DAY) - (days - 1) + i) for i in range(days)]
+    return Cohort(user_ids, day_names, sodium, sodium * 1.2, systolic.astype(np.float32),
+                  diastolic.astype(np.float32), medication, exercise)
+
+
+def nested_dicts(cohort):
+    """The same data as {user: {day: value}} dicts, the shape the state used to live in"""
+    sodium, systolic = {}, {}
+    for row, user_id in enumerate(cohort.user_ids):
+        sodium[user_id] = {day: float(v) for day, v in zip(cohort.days, cohort.sodium[row]) if v == v}
+        systolic[user_id] = {day: float(v) for day, v in zip(cohort.days, cohort.systolic[row]) if v == v}
+    return sodium, systolic
+
+
+def loop_aggregates(days, sodium, systolic):
+    """Weekly cohort means and days over the limit, one Python loop per user-day"""
+    weeks = len(days) // 7
+    week_days = days[len(days) - weeks * 7:]
+    result = {}
+    for name, table in (('sodium', sodium), ('systolic', systolic)):
+        totals, counts = [0.0] * weeks, [0] * weeks
+        for by_day in table.values():
+            for i, day in enumerate(week_days):
+                value = by_day.get(day)
+                if value is not None:
+                    totals[i // 7] += value
+                    counts[i // 7] += 1
+        result[name] = [t / c if c else None for t, c in zip(totals, counts)]
+    result['over'] = {user_id: sum(v > SODIUM_LIMIT for v in by_day.values()) for user_id, by_day in sodium.items()}
+    return result
+
+
+def timed(func, *args, runs=3):
+    best = float('inf')
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def write_database(path, cohort):
+    """Store a cohort in the app's SQLite schema (closed days, BP readings, flags)"""
+    conn = sqlite3.connect(path)
+    for table in TABLES.values():
+        conn.executescript(table.schema)
+    users = range(len(cohort.user_ids))
+    conn.executemany("INSERT INTO daily_totals VALUES (?, ?, ?, 0, 0, 0, ?, 1)", (
+        (cohort.user_ids[u], cohort.days[d], float(cohort.calories[u, d]), float(cohort.sodium[u, d]))
+        for u in users for d in np.flatnonzero(np.isfinite(cohort.sodium[u]))))
+    conn.executemany("INSERT INTO bp_readings VALUES (?, 0, ?, ?, ?)", (
+        (cohort.user_ids[u], cohort.days[d], int(cohort.systolic[u, d]), int(cohort.diastolic[u, d]))
+        for u in users for d in np.flatnonzero(np.isfinite(cohort.systolic[u]))))
+    conn.executemany("INSERT INTO medication_taken VALUES (?, ?, 1)", (
+        (cohort.user_ids[u], cohort.days[d]) for u in users for d in np.flatnonzero(cohort.medication[u])))
+    conn.executemany("INSERT INTO exercise_log VALUES (?, ?, ?)", (
+        (cohort.user_ids[u], cohort.days[d], int(cohort.exercise[u, d]))
+        for u in users for d in np.flatnonzero(cohort.exercise[u])))
+    conn.commit()
+    conn.close()
+
+
+def stored_rows(cohort):
+    """Rows load_cohort reads for a cohort: one per logged day, BP day, dose and workout"""
+    return int(np.isfinite(cohort.sodium).sum() + np.isfinite(cohort.systolic).sum()
+               + cohort.medication.sum() + (cohort.exercise > 0).sum())
+
+
+def bench_load(days):
+    """Rows per second load_cohort reads out of SQLite"""
+    cohort = synthetic_cohort(LOAD_PATIENTS, days, seed=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'analytics.db')
+        write_database(path, cohort)
+        elapsed, loaded = timed(load_cohort, path, days, END_DAY, runs=1)
+    rows = stored_rows(cohort)
+    same = np.array_equal(np.isfinite(loaded.sodium), np.isfinite(cohort.sodium[
+        [int(user_id[1:], 16) for user_id in loaded.user_ids]]))
+    print(f"\nload_cohort from SQLite: {LOAD_PATIENTS} patients x {days} days, {rows} rows "
+          f"in {elapsed * 1000:.0f} ms ({rows / elapsed / 1e6:.2f} M rows/s), layout matches: {same}")
+    return rows / elapsed
+
+
+def main():
+    patients = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+    cohort = synthetic_cohort(patients, days)
+    print(f"{patients} patients x {days} days\n")
+    print(f"{'aggregate':<32} {'ms':>8}")
+    report_time = None
+    for name, func, args in (
+            ('weekly means (sodium)', weekly_means, (cohort.sodium,)),
+            ('days over 1500 mg', days_over, (cohort.sodium,)),
+            ('sodium -> systolic r, lags 0-3', lagged_correlation, (cohort.sodium, cohort.systolic)),
+            ('adherence', adherence, (cohort,)),
+            ('full cohort_report', cohort_report, (cohort,))):
+        elapsed, _ = timed(func, *args)
+        report_time = elapsed
+        print(f"{name:<32} {elapsed * 1000:>8.1f}")
+
+    report = cohort_report(cohort)
+    print("\nsodium -> next-day systolic:", {lag: round(v['r'], 3) for lag, v in
+                                             report['sodium_systolic_correlation'].items()})
+
+    sodium, systolic = nested_dicts(cohort)
+    loop, _ = timed(loop_aggregates, cohort.days, sodium, systolic, runs=1)
+    vector, _ = timed(lambda: (weekly_means(cohort.sodium), weekly_means(cohort.systolic),
+                               days_over(cohort.sodium)))
+    print(f"\nweekly means + days over, nested-dict loops: {loop * 1000:.0f} ms, "
+          f"NumPy: {vector * 1000:.1f} ms ({loop / vector:.0f}x)")
+    rate = bench_load(days)
+
+    # The aggregates above start from matrices already in memory; a real
+    # report first has to read the whole cohort out of SQLite
+    rows = stored_rows(cohort)
+    load_time = rows / rate
+    print(f"\nend to end for {patients} patients: load_cohort ~{load_time:.1f} s for {rows} rows "
+          f"(projected at that rate) + cohort_report {report_time * 1000:.0f} ms "
+          f"= ~{load_time + report_time:.1f} s, {load_time / (load_time + report_time):.0%} of it loading")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# bench_extraction.py - Golden-corpus check and throughput of nutrition extraction
+#
+# Usage: python benchmarks/bench_extraction.py [seconds-per-path]
+
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from nutrition_extraction import extract_nutrition, extract_nutrition_values
+
+CORPUS_PATH = os.path.join(ROOT, 'benchmarks', 'gemini_responses.json')
+
+
+def legacy_extract_nutrition_values(text):
+    """The original per-call, multi-search implementation (kept for comparison)"""
+    values = {
+        'calories': 0,
+        'protein': 0,
+        'carbs': 0,
+        'fat': 0,
+        'sodium': 0
+    }
+
+    patterns = {
+        'calories': [
+            r'(\d+)\s*(?:calories|kcal|cal|大卡|卡路里|熱量)',
+            r'(?:calories|熱量)[:\s]+(\d+)',
+            r'(?:約|大約|大概|approximately)?\s*(\d+)\s*(?:kcal|大卡)'
+        ],
+        'protein': [
+            r'(?:protein|蛋白質)[:\s]+(\d+\.?\d*)\s*(?:g|克|公克)',
+            r'(\d+\.?\d*)\s*(?:g|克)\s*(?:protein|蛋白質)',
+            r'蛋白質\s*(\d+\.?\d*)(?:g|克)?'
+        ],
+        'carbs': [
+            r'(?:carb|碳水化合物|醣類)[:\s]+(\d+\.?\d*)\s*(?:g|克|公克)',
+            r'(\d+\.?\d*)\s*(?:g|克)\s*(?:carb|碳水)',
+            r'碳水\s*(\d+\.?\d*)(?:g|克)?'
+        ],
+        'fat': [
+            r'(?:fat|脂肪)[:\s]+(\d+\.?\d*)\s*(?:g|克|公克)',
+            r'(\d+\.?\d*)\s*(?:g|克)\s*(?:fat|脂肪)',
+            r'脂肪\s*(\d+\.?\d*)(?:g|克)?'
+        ],
+        'sodium': [
+            r'(?:sodium|鈉)[:\s]+(\d+)\s*(?:mg|毫克)',
+            r'(\d+)\s*(?:mg|毫克)\s*(?:sodium|的鈉|鈉)',
+            r'鈉\s*(\d+)\s*(?:mg|毫克)?',
+            r'(\d+)-(\d+)\s*(?:mg|毫克)\s*(?:的)?鈉'
+        ]
+    }
+
+    text_lower = text.lower()
+    for nutrient, pattern_list in patterns.items():
+        for pattern in pattern_list:
+            match = re.search(pattern, text_lower)
+            if match:
+                if nutrient == 'sodium' and len(match.groups()) == 2:
+                    values[nutrient] = float(match.group(2))
+                else:
+                    values[nutrient] = float(match.group(1))
+                break
+
+    return values
+
+
+def load_corpus():
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def check_golden(corpus):
+    """Both paths must reproduce the recorded values exactly"""
+    failures = 0
+    for i, item in enumerate(corpus):
+        for name, func in (('legacy', legacy_extract_nutrition_values), ('engine', extract_nutrition_values)):
+            got = func(item['response'])
+            if got != item['expected']:
+                failures += 1
+                print(f"MISMATCH [{name}] #{i}: expected {item['expected']}, got {got}")
+    return failures
+
+
+def throughput(func, texts, seconds):
+    """Responses per second over roughly `seconds` of work"""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for text in texts:
+            func(text)
+        count += len(texts)
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    corpus = load_corpus()
+    texts = [item['response'] for item in corpus]
+
+    failures = check_golden(corpus)
+    print(f"golden corpus: {len(corpus)} responses, {failures} mismatches")
+
+    ranged = sum(1 for text in texts if extract_nutrition(text)[1])
+    print(f"responses with at least one range: {ranged}")
+
+    legacy = throughput(legacy_extract_nutrition_values, texts, seconds)
+    engine = throughput(extract_nutrition_values, texts, seconds)
+    print(f"legacy: {legacy:,.0f} responses/sec")
+    print(f"engine: {engine:,.0f} responses/sec ({engine / legacy:.2f}x)")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+# bench_keywords.py - Per-message cost of keyword matching as vocabularies grow
+#
+# Usage: python benchmarks/bench_keywords.py
+
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from keyword_matcher import KeywordMatcher, KEYWORD_CATEGORIES
+from food_database import FOOD_DATABASE
+
+MESSAGES = [
+    '早餐吃全麥吐司跟水煮蛋',
+    '午餐 滷肉飯',
+    '晚餐吃牛肉麵，湯沒有喝',
+    '今天走路30分鐘，血壓130/85',
+    '林太太今天煮了清蒸魚和燙青菜，很好吃',
+    'I had a sandwich for lunch',
+    '謝謝',
+    '剛剛又吃了一根油條配甜豆漿，不好意思'
+]
+
+
+def grown_vocabulary(size):
+    """The shipped categories plus synthetic dish names up to `size` keywords"""
+    categories = {name: list(words) for name, words in KEYWORD_CATEGORIES.items()}
+    dishes = [alias for dish, info in FOOD_DATABASE.items() for alias in [dish] + info['aliases']]
+    count = sum(len(words) for words in categories.values())
+    extra = []
+    i = 0
+    while count + len(extra) < size:
+        base = dishes[i % len(dishes)]
+        extra.append(base if i < len(dishes) else f"{base}{i}")
+        i += 1
+    categories['dish'] = extra
+    return categories
+
+
+def naive_match(categories, text):
+    """What the call sites used to do: one `in` check per keyword"""
+    text = text.lower()
+    return frozenset(name for name, words in categories.items()
+                     if any(word in text for word in words))
+
+
+def main():
+    print(f"{'keywords':>9} {'states':>7} {'naive us/msg':>13} {'matcher us/msg':>15}")
+    for size in (50, 200, 1000, 5000):
+        categories = grown_vocabulary(size)
+        matcher = KeywordMatcher(categories)
+        categories = {name: [word.lower() for word in words] for name, words in categories.items()}
+        for text in MESSAGES:
+            assert matcher.match(text) == naive_match(categories, text), text
+
+        runs = 200
+        naive = timeit.timeit(lambda: [naive_match(categories, m) for m in MESSAGES], number=runs)
+        fast = timeit.timeit(lambda: [matcher.match(m) for m in MESSAGES], number=runs)
+        per_message = runs * len(MESSAGES)
+        print(f"{size:>9} {matcher.state_count:>7} {naive / per_message * 1e6:>13.2f} "
+              f"{fast / per_message * 1e6:>15.2f}")
+
+
+if __name__ == '__main__':
+    main()
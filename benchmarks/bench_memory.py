@@ -0,0 +1,96 @@
+# bench_memory.py - Bytes per active user: legacy nested dicts vs UserSession
+#
+# Usage: python benchmarks/bench_memory.py
+
+import gc
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from shared_state import StateStore
+from storage import Storage, MemoryBackend
+
+MEALS_PER_DAY = 6
+DAY = '2026-10-18'
+MORNING = 1792281600  # DAY 08:00 in Asia/Taipei
+
+
+def user_ids(count):
+    # LINE user ids are 'U' + 32 hex digits
+    return [f"U{i:032x}" for i in range(count)]
+
+
+def meal(uid, n):
+    return f"早餐吃全麥吐司跟水煮蛋 #{n} {uid[-4:]}"
+
+
+def legacy_layout(ids, days):
+    """The original module-level dicts; intake never resets, so meals pile up"""
+    user_daily_intake = {}
+    user_bp_records = {}
+    user_medication_taken = {}
+    user_exercise_log = {}
+    user_first_message = {}
+    user_conversation_count = {}
+    for uid in ids:
+        user_first_message[uid] = True
+        user_conversation_count[uid] = days * MEALS_PER_DAY
+        user_daily_intake[uid] = {
+            'calories': 1800.0, 'protein': 70.0, 'carbs': 220.0,
+            'fat': 60.0, 'sodium': 1400.0,
+            'meals': [meal(uid, n) for n in range(days * MEALS_PER_DAY)]
+        }
+        user_bp_records[uid] = [
+            {'datetime': f"{DAY} 08:00", 'value': '132/85'},
+            {'datetime': f"{DAY} 20:00", 'value': '128/82'}
+        ]
+        user_medication_taken[uid] = {DAY: True}
+        user_exercise_log[uid] = {DAY: 30}
+    return (user_daily_intake, user_bp_records, user_medication_taken,
+            user_exercise_log, user_first_message, user_conversation_count)
+
+
+def session_layout(ids, days):
+    """StateStore sessions; older days are compacted away, so only today's meals stay"""
+    state = StateStore(Storage(MemoryBackend()))
+    nutrition = {'calories': 300.0, 'protein': 11.0, 'carbs': 36.0, 'fat': 10.0, 'sodium': 230.0}
+    for uid in ids:
+        state.set_if_absent('first_message', uid, True)
+        state.incr('conversation_count', uid, days * MEALS_PER_DAY)
+        for n in range(MEALS_PER_DAY):
+            state.add_intake(uid, nutrition, [meal(uid, n)])
+        state.add_bp_reading(uid, 132, 85, MORNING)
+        state.add_bp_reading(uid, 128, 82, MORNING + 12 * 3600)
+        state.set_day_value('medication_taken', uid, DAY, True)
+        state.set_day_value('exercise_log', uid, DAY, 30)
+    return state
+
+
+def measure(build, ids, days):
+    gc.collect()
+    tracemalloc.start()
+    result = build(ids, days)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return used / len(ids)
+
+
+def main():
+    print(f"{'users':>7} {'days':>5} {'legacy B/user':>14} {'session B/user':>15} {'saved':>6}")
+    for count in (10_000, 100_000):
+        ids = user_ids(count)
+        for days in (1, 14):
+            legacy = measure(legacy_layout, ids, days)
+            session = measure(session_layout, ids, days)
+            print(f"{count:>7} {days:>5} {legacy:>14.0f} {session:>15.0f} {1 - session / legacy:>6.0%}")
+    print("\n1-day rows compare the layouts; the 14-day rows mostly measure the legacy meal list,\n"
+          "which never resets (sessions compact each closed day)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# bench_photo_index.py - Near-duplicate photo lookup cost vs photos kept per user
+#
+# Usage: python benchmarks/bench_photo_index.py
+
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from photo_index import NearDuplicateIndex, dhash
+
+USERS = 10_000
+
+
+def build_index(per_user, rng):
+    index = NearDuplicateIndex(per_user=per_user, max_users=USERS)
+    for i in range(USERS):
+        user_id = f"U{i:032x}"
+        for _ in range(per_user):
+            index.add(user_id, rng.getrandbits(64), 'analysis')
+    return index
+
+
+def near(photo_hash, rng, bits):
+    """photo_hash with `bits` random bits flipped (a re-shot of the same plate)"""
+    for bit in rng.sample(range(64), bits):
+        photo_hash ^= 1 << bit
+    return photo_hash
+
+
+def bench_dhash():
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Pillow not installed - skipping dhash timing")
+        return
+    rng = random.Random(1)
+    image = Image.frombytes('RGB', (1024, 768), bytes(rng.getrandbits(8) for _ in range(1024 * 768 * 3)))
+    runs = 200
+    elapsed = timeit.timeit(lambda: dhash(image), number=runs)
+    print(f"dhash of a 1024x768 photo: {elapsed / runs * 1e6:.0f} us")
+
+
+def main():
+    rng = random.Random(0)
+    print(f"{'per user':>9} {'miss us':>8} {'hit us':>7} {'hit rate':>9}")
+    for per_user in (5, 20, 50, 200):
+        index = build_index(per_user, rng)
+        user_ids = [f"U{rng.randrange(USERS):032x}" for _ in range(2000)]
+        # Lookups for a photo already in the index, a few bits off
+        targets = []
+        for user_id in user_ids:
+            stored = index._users[user_id][-1][2]
+            targets.append((user_id, near(stored, rng, 4)))
+        misses = [(user_id, rng.getrandbits(64)) for user_id in user_ids]
+
+        runs = 5
+        miss = timeit.timeit(lambda: [index.find(u, h) for u, h in misses], number=runs)
+        hit = timeit.timeit(lambda: [index.find(u, h) for u, h in targets], number=runs)
+        found = sum(index.find(u, h) is not None for u, h in targets) / len(targets)
+        per_lookup = runs * len(user_ids)
+        print(f"{per_user:>9} {miss / per_lookup * 1e6:>8.2f} {hit / per_lookup * 1e6:>7.2f} {found:>9.0%}")
+    bench_dhash()
+
+
+if __name__ == '__main__':
+    main()
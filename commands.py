@@ -0,0 +1,134 @@
+# commands.py - Table-driven text command router with per-command timings
+
+import threading
+import time
+
+HELP_TEXT = """🥗 林先生的營養追蹤助手
+
+📱 主要功能：
+• 分析食物照片並記錄營養
+• 追蹤每日鈉攝取（限1500mg）
+• 提醒健康飲食選擇
+• 記錄血壓和運動
+• 藥物提醒
+
+📋 指令列表：
+/help - 顯示這個說明
+/today - 今日營養摘要
+/plan - 查看一週DASH飲食計畫
+/bp - 記錄血壓（例：/bp 145/90）
+/med - 記錄服藥
+/exercise - 記錄運動
+/tips - 飲食小技巧
+/clear - 重置今天的紀錄
+
+💡 記住我們的目標：
+✅ 早餐：全麥吐司+水煮蛋
+✅ 牛肉麵不喝湯
+✅ 每天走路30分鐘
+✅ 按時服用Amlodipine
+
+林太太有幫您準備餐點嗎？記得傳照片給我！"""
+
+TIPS_TEXT = """🌟 林先生的健康小技巧
+
+🧂 減鈉妙招：
+• 用大蒜、薑、醋、檸檬調味
+• 醬料另外裝，沾著吃
+• 選「乾」的麵食，避免喝湯
+• 少吃醃漬品和加工食品
+
+🥗 聰明選擇：
+• 早餐店：蛋餅不加醬 > 鐵板麵
+• 便當店：蒸煮 > 油炸，配菜選時蔬
+• 麵店：乾麵 > 湯麵，不喝湯
+• 飲料：無糖茶 > 半糖飲料
+
+🏃 運動建議：
+• 飯後散步最適合
+• 遛狗時多走15分鐘
+• 週末和林太太去公園
+• 爬樓梯代替搭電梯
+
+記住：小改變，大健康！為了不像爸爸一樣，我們一起努力 💪"""
+
+
+class CommandRouter:
+    """Maps message text to command handlers.
+
+    Exact aliases and the first word of prefix commands are dict lookups on
+    the lowercased text, so matching costs the same however many commands
+    are registered. Prefixes glued to their argument ('/bp130/85',
+    '運動30分鐘') fall back to a startswith scan over the few prefix
+    commands. Handlers take (user_id, args) and return the message to reply
+    with; static commands return one message object built at startup.
+    """
+
+    def __init__(self):
+        self._aliases = {}    # lowercased alias -> command name
+        self._prefixes = {}   # lowercased prefix -> command name
+        self._handlers = {}   # command name -> handler
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def command(self, name, aliases=(), prefixes=()):
+        """Decorator registering handler(user_id, args) under its aliases and prefixes"""
+        def register(handler):
+            self._handlers[name] = handler
+            for alias in aliases:
+                self._aliases[alias.lower()] = name
+            for prefix in prefixes:
+                self._prefixes[prefix.lower()] = name
+            return handler
+        return register
+
+    def static(self, name, message, aliases=()):
+        """Register a command that always replies with the same prebuilt message"""
+        self.command(name, aliases)(lambda user_id, args: message)
+
+    def match(self, text):
+        """(command name, args) for a message, or None when it is not a command"""
+        lowered = text.lower()
+        name = self._aliases.get(lowered)
+        if name is not None:
+            return name, []
+        words = text.split()
+        if not words:
+            return None
+        name = self._prefixes.get(words[0].lower())
+        if name is not None:
+            return name, words[1:]
+        for prefix, name in self._prefixes.items():
+            if lowered.startswith(prefix):
+                # Legacy behaviour: args are whatever followed the first space
+                return name, words[1:]
+        return None
+
+    def run(self, name, user_id, args=()):
+        """Call a command's handler, recording its invocation count and latency"""
+        start = time.perf_counter()
+        try:
+            return self._handlers[name](user_id, args)
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, elapsed):
+        """Account one invocation (also used for work done outside the router)"""
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = {'calls': 0, 'time_total': 0.0, 'time_max': 0.0}
+            stats['calls'] += 1
+            stats['time_total'] += elapsed
+            stats['time_max'] = max(stats['time_max'], elapsed)
+
+    def stats(self):
+        with self._lock:
+            stats = {name: dict(entry) for name, entry in self._stats.items()}
+        for entry in stats.values():
+            entry['time_avg'] = entry['time_total'] / entry['calls']
+        return {
+            'commands': len(self._handlers),
+            'aliases': len(self._aliases),
+            'by_command': stats
+        }
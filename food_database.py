@@ -0,0 +1,181 @@
+# food_database.py - Local Taiwanese dish nutrition table for Mr. Lin's usual foods
+
+import re
+
+# Per-serving estimates: calories (kcal), protein/carbs/fat (g), sodium (mg).
+# 'soup_sodium' is the part of the sodium that stays in the broth.
+FOOD_DATABASE = {
+    # Breakfast
+    '油條': {'aliases': ['油炸粿'], 'serving': '1根', 'calories': 230, 'protein': 4, 'carbs': 22, 'fat': 14, 'sodium': 350},
+    '甜豆漿': {'aliases': ['豆漿'], 'serving': '1杯', 'calories': 180, 'protein': 9, 'carbs': 25, 'fat': 5, 'sodium': 40},
+    '無糖豆漿': {'aliases': [], 'serving': '1杯', 'calories': 120, 'protein': 11, 'carbs': 6, 'fat': 6, 'sodium': 40},
+    '全麥吐司': {'aliases': ['全麥麵包'], 'serving': '1片', 'calories': 90, 'protein': 4, 'carbs': 16, 'fat': 1.5, 'sodium': 150},
+    '水煮蛋': {'aliases': ['白煮蛋'], 'serving': '1顆', 'calories': 75, 'protein': 7, 'carbs': 0.5, 'fat': 5, 'sodium': 70},
+    '茶葉蛋': {'aliases': [], 'serving': '1顆', 'calories': 75, 'protein': 7, 'carbs': 1, 'fat': 5, 'sodium': 250},
+    '荷包蛋': {'aliases': ['煎蛋'], 'serving': '1顆', 'calories': 110, 'protein': 7, 'carbs': 0.5, 'fat': 9, 'sodium': 80},
+    '蛋餅': {'aliases': [], 'serving': '1份', 'calories': 250, 'protein': 9, 'carbs': 28, 'fat': 11, 'sodium': 450},
+    '蔬菜蛋餅': {'aliases': [], 'serving': '1份', 'calories': 280, 'protein': 10, 'carbs': 30, 'fat': 13, 'sodium': 500},
+    '鐵板麵': {'aliases': [], 'serving': '1份', 'calories': 550, 'protein': 15, 'carbs': 70, 'fat': 22, 'sodium': 1600},
+    '饅頭': {'aliases': [], 'serving': '1個', 'calories': 280, 'protein': 8, 'carbs': 56, 'fat': 2, 'sodium': 300},
+    '燕麥粥': {'aliases': ['燕麥'], 'serving': '1碗', 'calories': 150, 'protein': 5, 'carbs': 27, 'fat': 3, 'sodium': 10},
+    '地瓜粥': {'aliases': [], 'serving': '1碗', 'calories': 180, 'protein': 3, 'carbs': 40, 'fat': 0.5, 'sodium': 20},
+    '鮪魚三明治': {'aliases': ['三明治'], 'serving': '1份', 'calories': 350, 'protein': 18, 'carbs': 35, 'fat': 14, 'sodium': 650},
+    '低脂牛奶': {'aliases': ['牛奶', '鮮奶'], 'serving': '1杯', 'calories': 110, 'protein': 8, 'carbs': 12, 'fat': 2.5, 'sodium': 120},
+
+    # Rice and noodles
+    '滷肉飯': {'aliases': ['魯肉飯'], 'serving': '1碗', 'calories': 400, 'protein': 12, 'carbs': 55, 'fat': 15, 'sodium': 750},
+    '白飯': {'aliases': ['飯'], 'serving': '1碗', 'calories': 280, 'protein': 5, 'carbs': 62, 'fat': 0.5, 'sodium': 2},
+    '糙米飯': {'aliases': ['五穀飯', '紫米飯', '紅豆飯', '雜糧飯'], 'serving': '1碗', 'calories': 220, 'protein': 5, 'carbs': 46, 'fat': 2, 'sodium': 5},
+    '牛肉麵': {'aliases': ['紅燒牛肉麵', '清燉牛肉麵'], 'serving': '1碗', 'calories': 650, 'protein': 35, 'carbs': 75, 'fat': 22, 'sodium': 2800, 'soup_sodium': 1900},
+    '牛肉乾麵': {'aliases': ['乾拌牛肉麵'], 'serving': '1碗', 'calories': 600, 'protein': 33, 'carbs': 75, 'fat': 20, 'sodium': 1100},
+    '乾麵': {'aliases': ['麻醬麵', '陽春乾麵'], 'serving': '1碗', 'calories': 400, 'protein': 12, 'carbs': 60, 'fat': 12, 'sodium': 900},
+    '陽春麵': {'aliases': ['湯麵'], 'serving': '1碗', 'calories': 350, 'protein': 10, 'carbs': 60, 'fat': 5, 'sodium': 1500, 'soup_sodium': 900},
+    '全麥麵': {'aliases': [], 'serving': '1份', 'calories': 300, 'protein': 12, 'carbs': 58, 'fat': 2, 'sodium': 200},
+    '冬粉': {'aliases': [], 'serving': '1份', 'calories': 160, 'protein': 0, 'carbs': 40, 'fat': 0, 'sodium': 10},
+
+    # Mains
+    '清蒸雞胸肉': {'aliases': ['清蒸雞肉', '雞胸肉', '烤雞胸肉'], 'serving': '1份', 'calories': 165, 'protein': 31, 'carbs': 0, 'fat': 4, 'sodium': 150},
+    '滷雞腿': {'aliases': ['滷雞腿(去皮)', '雞腿'], 'serving': '1支', 'calories': 200, 'protein': 26, 'carbs': 2, 'fat': 9, 'sodium': 600},
+    '烤鮭魚': {'aliases': ['鮭魚'], 'serving': '1片', 'calories': 230, 'protein': 25, 'carbs': 0, 'fat': 14, 'sodium': 70},
+    '清蒸魚': {'aliases': ['蒸魚', '清蒸鱈魚', '鱈魚'], 'serving': '1份', 'calories': 150, 'protein': 25, 'carbs': 0, 'fat': 5, 'sodium': 300},
+    '豆腐': {'aliases': [], 'serving': '1份', 'calories': 90, 'protein': 9, 'carbs': 3, 'fat': 5, 'sodium': 10},
+    '豆干炒肉絲': {'aliases': [], 'serving': '1份', 'calories': 280, 'protein': 20, 'carbs': 8, 'fat': 18, 'sodium': 650},
+    '蒸蛋': {'aliases': [], 'serving': '1份', 'calories': 90, 'protein': 7, 'carbs': 1, 'fat': 6, 'sodium': 300},
+    '火鍋': {'aliases': ['昆布鍋'], 'serving': '1鍋', 'calories': 500, 'protein': 30, 'carbs': 30, 'fat': 25, 'sodium': 1500, 'soup_sodium': 800},
+
+    # Soups
+    '清燉雞湯': {'aliases': ['香菇雞湯', '雞湯'], 'serving': '1碗', 'calories': 180, 'protein': 20, 'carbs': 3, 'fat': 9, 'sodium': 900, 'soup_sodium': 700},
+    '番茄豆腐湯': {'aliases': [], 'serving': '1碗', 'calories': 110, 'protein': 8, 'carbs': 8, 'fat': 5, 'sodium': 700, 'soup_sodium': 500},
+    '貢丸湯': {'aliases': [], 'serving': '1碗', 'calories': 150, 'protein': 9, 'carbs': 5, 'fat': 10, 'sodium': 800, 'soup_sodium': 450},
+
+    # Vegetables
+    '炒青菜': {'aliases': ['炒青江菜', '炒高麗菜', '炒小白菜', '炒a菜', '清炒菠菜', '炒菠菜'], 'serving': '1盤', 'calories': 80, 'protein': 2, 'carbs': 6, 'fat': 6, 'sodium': 300},
+    '燙青菜': {'aliases': ['燙花椰菜', '燙空心菜', '燙地瓜葉', '燙菠菜', '燙高麗菜', '大量蔬菜'], 'serving': '1盤', 'calories': 40, 'protein': 2, 'carbs': 5, 'fat': 1, 'sodium': 150},
+    '生菜沙拉': {'aliases': ['沙拉'], 'serving': '1份', 'calories': 60, 'protein': 2, 'carbs': 8, 'fat': 2, 'sodium': 150},
+    '地瓜': {'aliases': ['烤地瓜', '燙地瓜'], 'serving': '1條', 'calories': 130, 'protein': 1.5, 'carbs': 30, 'fat': 0.2, 'sodium': 40},
+    '南瓜': {'aliases': [], 'serving': '1份', 'calories': 70, 'protein': 2, 'carbs': 16, 'fat': 0.2, 'sodium': 1},
+    '馬鈴薯': {'aliases': [], 'serving': '1顆', 'calories': 130, 'protein': 3, 'carbs': 30, 'fat': 0.1, 'sodium': 10},
+    '小黃瓜': {'aliases': [], 'serving': '1條', 'calories': 15, 'protein': 1, 'carbs': 3, 'fat': 0, 'sodium': 2},
+    '醃菜': {'aliases': ['酸菜', '泡菜', '醃黃瓜'], 'serving': '1小碟', 'calories': 20, 'protein': 1, 'carbs': 3, 'fat': 0, 'sodium': 800},
+
+    # Fruit, snacks and drinks
+    '蘋果': {'aliases': [], 'serving': '1顆', 'calories': 80, 'protein': 0.3, 'carbs': 21, 'fat': 0.2, 'sodium': 1},
+    '香蕉': {'aliases': [], 'serving': '1根', 'calories': 100, 'protein': 1, 'carbs': 26, 'fat': 0.3, 'sodium': 1},
+    '芭樂': {'aliases': [], 'serving': '1顆', 'calories': 80, 'protein': 1.5, 'carbs': 18, 'fat': 0.5, 'sodium': 5},
+    '橘子': {'aliases': [], 'serving': '1顆', 'calories': 60, 'protein': 1, 'carbs': 15, 'fat': 0.2, 'sodium': 2},
+    '水果拼盤': {'aliases': ['水果'], 'serving': '1份', 'calories': 100, 'protein': 1, 'carbs': 25, 'fat': 0.3, 'sodium': 3},
+    '無鹽堅果': {'aliases': ['堅果'], 'serving': '1小把', 'calories': 180, 'protein': 5, 'carbs': 6, 'fat': 15, 'sodium': 2},
+    '優格': {'aliases': ['優酪乳'], 'serving': '1杯', 'calories': 120, 'protein': 6, 'carbs': 15, 'fat': 4, 'sodium': 80},
+    '洋芋片': {'aliases': [], 'serving': '1包', 'calories': 300, 'protein': 3, 'carbs': 30, 'fat': 19, 'sodium': 400},
+    '珍珠奶茶': {'aliases': ['珍奶'], 'serving': '1杯', 'calories': 500, 'protein': 3, 'carbs': 80, 'fat': 18, 'sodium': 60},
+    '無糖茶': {'aliases': ['無糖紅茶', '無糖綠茶', '綠茶'], 'serving': '1杯', 'calories': 0, 'protein': 0, 'carbs': 0, 'fat': 0, 'sodium': 10},
+}
+
+NUTRIENTS = ('calories', 'protein', 'carbs', 'fat', 'sodium')
+
+# Quantity words before ("兩片全麥吐司") or after ("全麥吐司2片") a dish
+_NUMERALS = {'一': 1, '二': 2, '兩': 2, '三': 3, '四': 4, '五': 5, '半': 0.5}
+_SIZES = {'大碗': 1.5, '大份': 1.5, '大杯': 1.5, '小碗': 0.7, '小份': 0.7, '小杯': 0.7}
+_QTY = r'(?:\d+(?:\.\d+)?|[一二兩三四五半])'
+_UNIT = r'(?:個|顆|片|碗|杯|份|條|根|盤|塊|把|支|包|鍋)'
+
+# Skipping the broth removes its sodium from every soup dish in the message
+_NO_SOUP = re.compile(r'不喝湯|沒喝湯|湯沒喝|湯不喝|湯沒有喝|湯另裝|不要湯|湯都沒喝|去湯')
+
+# Words that may surround food names without naming a food of their own
+_FILLER = re.compile(
+    r'早餐|午餐|晚餐|宵夜|點心|下午茶|早上|中午|晚上|今天|剛剛|剛才|我|吃了|喝了|吃|喝|了|'
+    r'跟|和|與|及|加上|加|配|還有|也|有|一些|一點|一起|林太太|準備|的|[\s，,。.、！!～~：:；;+＋&]'
+)
+
+
+def _build_alias_index():
+    """Map every alias (lowercased) to its dish name"""
+    index = {}
+    for dish, info in FOOD_DATABASE.items():
+        for alias in [dish] + info['aliases']:
+            index[alias.lower()] = dish
+    return index
+
+
+ALIAS_INDEX = _build_alias_index()
+
+# Longest aliases first so 牛肉乾麵 wins over 乾麵 and 無糖豆漿 over 豆漿
+_DISH_PATTERN = re.compile(
+    rf'(?:(?P<qty>{_QTY})\s*{_UNIT}?)?\s*(?P<size>{"|".join(_SIZES)})?'
+    rf'(?P<dish>{"|".join(re.escape(alias) for alias in sorted(ALIAS_INDEX, key=len, reverse=True))})'
+    rf'(?:\s*(?P<qty_after>{_QTY})\s*{_UNIT})?'
+)
+
+
+def _quantity(text):
+    if text is None:
+        return 1
+    return _NUMERALS[text] if text in _NUMERALS else float(text)
+
+
+def match_meal(message):
+    """Resolve a food log against the local table.
+
+    Returns a list of items ({'name', 'dish', 'servings', nutrients...}) when
+    every food in the message is known, otherwise None so the caller can ask
+    Gemini instead. A zero quantity ("0碗") is not understood either.
+    """
+    text = message.lower()
+    no_soup = _NO_SOUP.search(text) is not None
+    items = []
+    residue = []
+    last_end = 0
+    for match in _DISH_PATTERN.finditer(text):
+        residue.append(text[last_end:match.start()])
+        last_end = match.end()
+
+        dish = ALIAS_INDEX[match.group('dish')]
+        info = FOOD_DATABASE[dish]
+        servings = _quantity(match.group('qty') or match.group('qty_after'))
+        servings *= _SIZES.get(match.group('size'), 1)
+        if servings <= 0:
+            return None
+
+        item = {'name': dish, 'dish': dish, 'servings': servings}
+        for nutrient in NUTRIENTS:
+            item[nutrient] = info[nutrient] * servings
+        if no_soup and 'soup_sodium' in info:
+            item['sodium'] -= info['soup_sodium'] * servings
+            item['name'] = f"{dish}（不喝湯）"
+        if servings != 1:
+            item['name'] += f" ×{servings:g}"
+        items.append(item)
+    residue.append(text[last_end:])
+
+    if not items:
+        return None
+    # Anything left besides filler words is a food we don't know
+    leftover = _FILLER.sub('', _NO_SOUP.sub('', ''.join(residue)))
+    if leftover:
+        return None
+    return items
+
+
+def meal_totals(items):
+    """Sum the nutrients of matched items"""
+    return {nutrient: sum(item[nutrient] for item in items) for nutrient in NUTRIENTS}
+
+
+def render_local_reply(items, totals, current_sodium, logged=True):
+    """Template reply for a meal answered from the local table.
+
+    logged=False (a zero-calorie meal such as unsweetened tea, which the
+    intake log skips) says so instead of confirming a record.
+    """
+    lines = ["📝 幫林先生記錄好了！" if logged else "📝 這餐幾乎沒有熱量，就不另外記錄囉！"]
+    for item in items:
+        lines.append(f"• {item['name']}：{item['calories']:.0f}大卡，鈉{item['sodium']:.0f}毫克")
+    lines.append("")
+    if not logged:
+        lines.append(f"今天鈉累計：{current_sodium:.0f} / 1500 毫克")
+        return "\n".join(lines)
+    lines.append(f"這餐合計：熱量 {totals['calories']:.0f} 大卡，蛋白質 {totals['protein']:.1f} 克，"
+                 f"碳水 {totals['carbs']:.1f} 克，脂肪 {totals['fat']:.1f} 克，鈉 {totals['sodium']:.0f} 毫克")
+    lines.append(f"今天鈉累計：{current_sodium + totals['sodium']:.0f} / 1500 毫克")
+    return "\n".join(lines)
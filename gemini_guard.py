@@ -0,0 +1,230 @@
+# gemini_guard.py - Rate limiting, retries and a circuit breaker around Gemini calls
+
+import os
+import random
+import threading
+import time
+
+import requests
+from google.genai import errors
+
+# Client-side limit matched to the project's Gemini quota (requests per minute)
+GEMINI_RPM = float(os.getenv('GEMINI_RPM', '60'))
+GEMINI_BURST = int(os.getenv('GEMINI_BURST', '10'))
+# Longest a request waits for a token before falling back
+GEMINI_RATE_WAIT = float(os.getenv('GEMINI_RATE_WAIT', '2'))
+
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '2'))
+GEMINI_BACKOFF_BASE = float(os.getenv('GEMINI_BACKOFF_BASE', '0.5'))
+GEMINI_BACKOFF_MAX = float(os.getenv('GEMINI_BACKOFF_MAX', '4'))
+# Total time one call may spend retrying; LINE reply tokens do not live long
+GEMINI_RETRY_BUDGET = float(os.getenv('GEMINI_RETRY_BUDGET', '10'))
+
+# Consecutive failures that open the breaker, and how long it stays open
+GEMINI_BREAKER_FAILURES = int(os.getenv('GEMINI_BREAKER_FAILURES', '5'))
+GEMINI_BREAKER_RESET = float(os.getenv('GEMINI_BREAKER_RESET', '30'))
+
+
+class GeminiUnavailable(Exception):
+    """Raised instead of calling Gemini; `reason` says why.
+
+    'circuit_open' - recent calls kept failing, not trying for a while
+    'rate_limited' - our own token bucket had nothing left in time
+    'quota'        - Gemini answered 429 on every attempt
+    'server_error' - 5xx on the last attempt
+    'timeout'      - timeout / connection error on the last attempt
+    """
+
+    def __init__(self, reason, cause=None):
+        super().__init__(reason if cause is None else f"{reason}: {cause!r}")
+        self.reason = reason
+        self.cause = cause
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `burst` saved up"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=0.0):
+        """Take one token, waiting up to timeout seconds; False if none came"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def drain(self):
+        """Drop the saved-up tokens, so every caller waits for the refill rate"""
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failures, lets one trial call through after `reset` seconds"""
+
+    def __init__(self, failures, reset):
+        self.failures = failures
+        self.reset = reset
+        self.state = 'closed'
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def release(self):
+        """Give back a trial call that never reached Gemini"""
+        with self._lock:
+            self._trial_running = False
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._trial_running = False
+            self.state = 'closed'
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            self._trial_running = False
+            if self.state == 'half_open' or self._consecutive >= self.failures:
+                if self.state != 'open':
+                    self.opened += 1
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
+def classify(error):
+    """Outcome name for a failed call, and whether it is worth retrying"""
+    if isinstance(error, errors.ClientError):
+        if error.code == 429:
+            return 'quota', True
+        return 'client_error', False
+    if isinstance(error, errors.ServerError):
+        return 'server_error', True
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return 'timeout', True
+    return 'error', False
+
+
+def _retry_after(error):
+    """Seconds from a Retry-After header on the failed response, if any"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class GeminiGuard:
+    """Runs Gemini calls behind a token bucket, jittered retries and a circuit breaker.
+
+    Retryable failures (429, 5xx, timeouts) are retried with full-jitter
+    exponential backoff within GEMINI_RETRY_BUDGET. When 5xx and timeouts
+    keep coming the breaker opens and call() raises GeminiUnavailable at
+    once, so callers answer from a local fallback instead of waiting out a
+    timeout per message. A 429 means Gemini is up but we are over quota:
+    it drains the token bucket and backs off, but never opens the breaker.
+    Non-retryable errors (bad request, parse errors) are raised unchanged
+    and do not count against the breaker either.
+    """
+
+    def __init__(self, rpm=GEMINI_RPM, burst=GEMINI_BURST, rate_wait=GEMINI_RATE_WAIT,
+                 max_retries=GEMINI_MAX_RETRIES, backoff_base=GEMINI_BACKOFF_BASE,
+                 backoff_max=GEMINI_BACKOFF_MAX, retry_budget=GEMINI_RETRY_BUDGET,
+                 breaker_failures=GEMINI_BREAKER_FAILURES, breaker_reset=GEMINI_BREAKER_RESET):
+        self.bucket = TokenBucket(rpm / 60.0, burst)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.rate_wait = rate_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+        self._lock = threading.Lock()
+        self._outcomes = {}
+
+    def _count(self, outcome):
+        with self._lock:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+
+    def call(self, func, *args, **kwargs):
+        """func(*args, **kwargs) under the guard; raises GeminiUnavailable to mean 'use the fallback'"""
+        deadline = time.monotonic() + self.retry_budget
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._count('circuit_open')
+                raise GeminiUnavailable('circuit_open')
+            if not self.bucket.acquire(self.rate_wait):
+                # Our own limit, not a Gemini failure
+                self.breaker.release()
+                self._count('rate_limited')
+                raise GeminiUnavailable('rate_limited')
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                outcome, retryable = classify(e)
+                self._count(outcome)
+                if not retryable:
+                    if outcome == 'client_error':
+                        # Gemini answered, so it is up - the request itself was bad
+                        self.breaker.success()
+                    else:
+                        self.breaker.release()
+                    raise
+                if outcome == 'quota':
+                    # Over quota, not down: slow everyone to the refill rate
+                    self.bucket.drain()
+                    self.breaker.release()
+                else:
+                    self.breaker.failure()
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                delay = max(delay, min(_retry_after(e) or 0.0, self.backoff_max))
+                if attempt >= self.max_retries or time.monotonic() + delay > deadline:
+                    raise GeminiUnavailable(outcome, e)
+                attempt += 1
+                self._count('retries')
+                time.sleep(delay)
+                continue
+            self.breaker.success()
+            self._count('ok' if attempt == 0 else 'ok_after_retry')
+            return result
+
+    def stats(self):
+        with self._lock:
+            outcomes = dict(self._outcomes)
+        return {
+            'outcomes': outcomes,
+            'breaker_state': self.breaker.state,
+            'breaker_opened': self.breaker.opened,
+            'rpm': self.bucket.rate * 60,
+            'burst': self.bucket.burst
+        }
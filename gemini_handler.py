@@ -2,34 +2,226 @@
 
 import os
 import re
+import hashlib
+import unicodedata
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 from patient_profiles import MR_LIN_PROFILE, get_mr_lin_context, check_food_for_mr_lin
+from response_cache import ResponseCache, LoggedPhotos, text_size
+from keyword_matcher import match_keywords
+from http_pool import use_pooled_session
+from gemini_guard import GeminiGuard, GeminiUnavailable
+from image_processing import ImagePreprocessor
+from photo_index import NearDuplicateIndex
+from intents import IntentRouter, classify_intent, render_ack, render_state_query
+from prompts import (TEXT_PREFIXES, IMAGE_PREFIXES, PromptPrefixCache, TokenUsage,
+                     build_text_suffix, build_image_suffix)
+from food_database import match_meal, meal_totals, render_local_reply
+from nutrition_extraction import extract_nutrition_values, MEAL_RESPONSE_SCHEMA, parse_structured_response, extract_reply_field
+from shared_state import STATE_BACKEND
 
 load_dotenv()
 
 # Initialize Gemini client
 client = genai.Client(api_key=os.getenv('GEMINI_API_KEY'))
+use_pooled_session(client)
+GEMINI_MODEL = "gemini-2.0-flash"
+# Local intent stage: template answers for some intents, a model tier for the rest
+intent_router = IntentRouter(GEMINI_MODEL)
+
+# Static prompt prefixes (system instruction / context cache) and token counters
+prompt_cache = PromptPrefixCache()
+token_usage = TokenUsage()
+# Rate limit, retries and circuit breaker for every generate_content call
+gemini_guard = GeminiGuard()
+
+# Local replies when Gemini is not called (busy = quota / our own rate limit)
+FALLBACK_REPLIES = {
+    ('text', 'busy'): "林先生，現在問我的人有點多 😅 等一兩分鐘再傳一次給我好嗎？",
+    ('text', 'down'): "林先生，我的分析系統暫時休息中 🙏 過幾分鐘再傳給我，記得今天鈉要控制在1500毫克以下哦！",
+    ('image', 'busy'): "林先生，現在照片有點多 😅 等一兩分鐘再傳一次，或先用文字告訴我吃了什麼！",
+    ('image', 'down'): "林先生，照片分析暫時休息中 🙏 可以先用文字告訴我吃了什麼，過幾分鐘再傳照片也可以！"
+}
+
+def fallback_reply(kind, error):
+    """Local reply for a Gemini call that GeminiGuard turned away"""
+    busy = error.reason in ('rate_limited', 'quota')
+    return FALLBACK_REPLIES[(kind, 'busy' if busy else 'down')]
 
 # Storage will be passed from main app
-user_daily_intake = None
-user_conversation_count = {}  # Track conversation depth
+user_state = None  # shared_state.StateStore (or its proxy)
 
 def init_storage(storage_ref):
     """Initialize storage reference from main app"""
-    global user_daily_intake
-    user_daily_intake = storage_ref
+    global user_state
+    user_state = storage_ref
+    # Every worker has to see the same already-logged marks
+    logged_photos.shared = storage_ref if STATE_BACKEND == 'server' else None
 
 # Demo mode flag - always True for Mr. Lin demo
 DEMO_MODE = True
 
+# Structured mode: ask Gemini for JSON (reply + per-item nutrition) instead of
+# scraping numbers out of prose; regex extraction stays as the fallback
+STRUCTURED_OUTPUT = os.getenv('STRUCTURED_OUTPUT', 'false').lower() == 'true'
+STRUCTURED_PROMPT = """
+輸出格式（JSON）：
+- reply：要傳給林先生的完整回覆
+- items：提到或照片中的每一樣食物，各自估算熱量(大卡)、蛋白質/碳水/脂肪(克)、鈉(毫克)
+- 沒有吃東西就讓 items 為空陣列
+"""
+
+# Answer food logs made only of dishes in the local table without calling Gemini
+LOCAL_FOOD_DB = os.getenv('LOCAL_FOOD_DB', 'true').lower() == 'true'
+
+# Image download limits
+IMAGE_CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', str(10 * 1024 * 1024)))
+
+# Photo analysis cache keyed by a hash of the image bytes
+image_cache = ResponseCache(
+    max_bytes=int(os.getenv('IMAGE_CACHE_BYTES', str(4 * 1024 * 1024))),
+    ttl=int(os.getenv('IMAGE_CACHE_TTL', str(24 * 3600))),
+    name='image'
+)
+# Text reply cache keyed by normalized message + context + coarse intake bucket
+text_cache = ResponseCache(
+    max_bytes=int(os.getenv('TEXT_CACHE_BYTES', str(2 * 1024 * 1024))),
+    ttl=int(os.getenv('TEXT_CACHE_TTL', str(6 * 3600))),
+    name='text'
+)
+# Rendered /today summaries, keyed by user and checked against the intake revision
+summary_cache = ResponseCache(
+    max_bytes=int(os.getenv('SUMMARY_CACHE_BYTES', str(2 * 1024 * 1024))),
+    ttl=int(os.getenv('SUMMARY_CACHE_TTL', str(24 * 3600))),
+    name='summary'
+)
+SODIUM_BUCKET_MG = 300
+CALORIE_BUCKET_KCAL = 500
+
+DUPLICATE_PHOTO_NOTE = "\n\n📝 這張照片剛剛已經記錄過了，不會重複計算哦！"
+NEAR_DUPLICATE_PHOTO_NOTE = "\n\n📝 看起來跟剛剛那張是同一餐，已經記錄過了，不會重複計算哦！"
+DUPLICATE_PHOTO_PENDING = "📝 這張照片已經收到了，正在分析中，不會重複計算哦！"
+
+# Re-log the meal when the same photo is sent again (off = don't double-count)
+IMAGE_CACHE_RECOUNT = os.getenv('IMAGE_CACHE_RECOUNT', 'false').lower() == 'true'
+# Sniff / EXIF-strip / downscale photos off the request thread before upload
+image_preprocessor = ImagePreprocessor()
+# Recent photo hashes per user: a second shot of the same plate reuses the analysis
+photo_index = NearDuplicateIndex()
+# Which exact photos each user already logged today (image_cache is shared by all users)
+logged_photos = LoggedPhotos()
+
+class ImageTooLargeError(Exception):
+    """Raised when a LINE image exceeds MAX_IMAGE_BYTES"""
+
+def download_image(line_bot_api, image_id, max_bytes=None):
+    """Stream a LINE image into a single size-capped buffer"""
+    max_bytes = max_bytes or MAX_IMAGE_BYTES
+    message_content = line_bot_api.get_message_content(image_id)
+    try:
+        # Preallocate when LINE tells us the size, abort early if it's too big
+        declared = message_content.response.headers.get('content-length')
+        declared = int(declared) if declared and declared.isdigit() else None
+        if declared is not None and declared > max_bytes:
+            raise ImageTooLargeError(f"image is {declared} bytes (limit {max_bytes})")
+        
+        buffer = bytearray(declared or 0)
+        view = memoryview(buffer)
+        size = 0
+        try:
+            for chunk in message_content.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                end = size + len(chunk)
+                if end > max_bytes:
+                    raise ImageTooLargeError(f"image exceeds {max_bytes} bytes")
+                if end <= len(buffer):
+                    view[size:end] = chunk
+                else:
+                    # Declared length was wrong or missing - grow in place
+                    view.release()
+                    del buffer[size:]
+                    buffer += chunk
+                    view = memoryview(buffer)
+                size = end
+        finally:
+            view.release()
+    finally:
+        # Hand the pooled connection back on every path, including an abandoned
+        # stream: Content.response is the SDK's RequestsHttpResponse, which has
+        # no close() - the requests.Response inside it holds the connection
+        message_content.response.response.close()
+    
+    if size < len(buffer):
+        del buffer[size:]
+    return buffer
+
 def get_conversation_depth(user_id):
     """Track how many messages exchanged to adjust verbosity"""
-    if user_id not in user_conversation_count:
-        user_conversation_count[user_id] = 0
-    user_conversation_count[user_id] += 1
-    return user_conversation_count[user_id]
+    return user_state.incr('conversation_count', user_id)
+
+def generate_reply(prefix, contents, prefix_key, kind='text', blocks=(), model=GEMINI_MODEL,
+                   structured=STRUCTURED_OUTPUT):
+    """Call Gemini and return (reply_text, nutrition, items).
+
+    `prefix` is the static per-profile prompt and `contents` the per-request
+    suffix (plus any image part). In structured mode nutrition/items come
+    straight from the JSON reply; otherwise (or if the JSON is unusable)
+    they are None and callers fall back to regex extraction on the text.
+    The JSON itself is never returned as the reply.
+    """
+    config_kwargs = {}
+    request_prefix, request_key = prefix, prefix_key
+    if structured:
+        request_prefix += STRUCTURED_PROMPT
+        request_key += ':structured'
+        config_kwargs = {
+            'response_mime_type': 'application/json',
+            'response_schema': MEAL_RESPONSE_SCHEMA
+        }
+    
+    request_contents, config = prompt_cache.prepare(client, model, request_key, request_prefix, contents,
+                                                    **config_kwargs)
+    response = gemini_guard.call(
+        client.models.generate_content,
+        model=model,
+        contents=request_contents,
+        config=config
+    )
+    token_usage.record(kind, response, blocks)
+    
+    if structured:
+        parsed = parse_structured_response(response.text)
+        if parsed is not None:
+            return parsed
+        # Broken or truncated JSON: keep just its reply text if one is there
+        reply = extract_reply_field(response.text)
+        if reply is not None:
+            return reply, None, None
+        # No reply field at all - ask once more for plain text
+        return generate_reply(prefix, contents, prefix_key, kind, blocks, model, structured=False)
+    return response.text, None, None
+
+def normalize_message(text):
+    """Width-fold, lowercase and collapse whitespace for cache lookups"""
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+CONTEXT_TRIGGERS = ('youtiao', 'beef_noodle', 'exercise', 'health')
+
+def get_context_triggers(user_message, hits=None):
+    """Names of the special-context prompt blocks this message hits"""
+    if hits is None:
+        hits = match_keywords(user_message)
+    return [name for name in CONTEXT_TRIGGERS if f"ctx_{name}" in hits]
+
+def text_cache_key(user_message, triggers, current_sodium, current_calories):
+    """Cache key: normalized text, context triggers and coarse intake bucket"""
+    return (
+        normalize_message(user_message),
+        tuple(triggers),
+        int(current_sodium // SODIUM_BUCKET_MG),
+        int(current_calories // CALORIE_BUCKET_KCAL)
+    )
 
 def analyze_with_gemini(user_message, user_id):
     """Mr. Lin specific version with personalized responses"""
@@ -37,129 +229,83 @@ def analyze_with_gemini(user_message, user_id):
     # Track conversation depth
     msg_count = get_conversation_depth(user_id)
     
-    # Check if message seems food-related
-    food_keywords = ['吃', '喝', '早餐', '午餐', '晚餐', '宵夜', '點心', '飲料', 'ate', 'eaten', 'had', 'breakfast', 'lunch', 'dinner']
-    is_food_log = any(keyword in user_message.lower() for keyword in food_keywords)
+    # One keyword pass covers the food-log check, prompt contexts and food warnings
+    hits = match_keywords(user_message)
+    is_food_log = 'food_log' in hits
+    
+    # Thanks / ok and "how much sodium today?" are answered without Gemini
+    intent = classify_intent(user_message, hits)
+    intent_router.record(intent)
+    model = intent_router.model_for(intent)
+    if model is None:
+        if intent == 'ack':
+            return render_ack(msg_count)
+        return render_state_query(user_state.get('daily_intake', user_id, {}))
     
     # Get current intake
-    current_intake = user_daily_intake.get(user_id, {})
+    current_intake = user_state.get('daily_intake', user_id, {})
     current_sodium = current_intake.get('sodium', 0)
     current_calories = current_intake.get('calories', 0)
     
-    # Build Mr. Lin specific prompt
-    base_prompt = f"""你是林先生的個人營養追蹤助手。以下是他的完整背景：
-
-**諮詢背景（從營養師轉介）：**
-- 林先生，55歲，BMI 27，高血壓（145/92）
-- 每天服用 Amlodipine 5mg
-- 爸爸60多歲中風（他最大的恐懼）
-- 原本飲食：油條甜豆漿、滷肉飯、牛肉麵（喝湯）、洋芋片、珍奶
-- 原本鈉攝取：約4000毫克/天（超標快3倍！）
-- 久坐上班，只有週末跟林太太散步
-- LDL膽固醇160，血糖也偏高
-
-**營養師計畫（他已同意）：**
-- 早餐：全麥吐司+水煮蛋+無糖豆漿（取代油條）
-- 午餐：清蒸雞肉/豆腐（取代滷肉）
-- 晚餐：乾麵或不喝湯（取代整碗湯）
-- 點心：水果、無鹽堅果（取代洋芋片）
-- 每天走路30分鐘，5次/週（可以遛狗時進行）
-- 鈉限制：1500毫克/天
-- 熱量目標：2000大卡/天
-- 林太太會協助準備健康餐點
-
-**今日狀況：**
-- 已攝取鈉：{current_sodium:.0f}毫克（限制1500）
-- 已攝取熱量：{current_calories:.0f}大卡（目標2000）
-- 第{msg_count}次對話
-
-使用者訊息："{user_message}"
-
-重要回應原則：
-1. 你完全了解林先生的病史和諮詢內容
-2. 如果他吃了不該吃的（如油條），溫和但堅定地提醒
-3. 適時提到他爸爸中風的事（這是他的主要動力）
-4. 多提到林太太的支持和幫助
-5. 建議要具體可行（用大蒜、醋調味等）
-6. 用台灣人說話方式，親切但關心的語氣
-7. 記得他「不想吃太多藥」的心願
-"""
-
-    # Special context for specific situations
-    if "油條" in user_message or "甜豆漿" in user_message:
-        base_prompt += """
-特別處理：他又吃油條了！
-- 溫和提醒全麥吐司的約定
-- 提到油脂對LDL的影響（已經160了）
-- 請林太太幫忙準備早餐
-"""
+    triggers = get_context_triggers(user_message, hits)
+    cache_key = text_cache_key(user_message, triggers, current_sodium, current_calories)
     
-    if "牛肉麵" in user_message:
-        base_prompt += """
-特別處理：確認他有沒有喝湯！
-- 如果喝湯，嚴肅提醒（一碗湯=一天的鈉）
-- 建議乾麵或湯另裝
-- 提醒他爸爸的事
-"""
-    
-    if "運動" in user_message or "走" in user_message:
-        base_prompt += """
-特別處理：運動追蹤
-- 鼓勵他遛狗時多走15分鐘
-- 提醒林太太可以陪他
-- 讚美任何運動努力
-"""
-    
-    if "血壓" in user_message or "藥" in user_message:
-        base_prompt += """
-特別處理：健康監測
-- 提醒按時吃 Amlodipine 5mg
-- 詢問今天血壓多少
-- 強調飲食控制能減少用藥
-"""
-
-    base_prompt += """
-回應風格：
-- 像個關心他的朋友，不是機器人
-- 用「林先生」稱呼，表示尊重
-- 適當使用 😊 💪 👍 等表情
-- 語氣：關切但不說教，鼓勵但要實際
-"""
+    # Only the per-request suffix is built here; the static prefix is shared
+    prompt_suffix = build_text_suffix(user_message, current_sodium, current_calories, msg_count, triggers)
 
     try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[base_prompt]
-        )
-        
-        response_text = response.text
+        local_items = match_meal(user_message) if LOCAL_FOOD_DB and is_food_log else None
+        cached = text_cache.get(cache_key) if local_items is None else None
+        if local_items is not None:
+            # Every food is in the local table - the template reply is
+            # rendered below, once we know whether anything was logged
+            known_nutrition = meal_totals(local_items)
+            items = local_items
+            response_text = ''
+        elif cached is not None:
+            response_text, known_nutrition, items = cached
+        else:
+            intent_router.record_call(model)
+            response_text, known_nutrition, items = generate_reply(
+                TEXT_PREFIXES['mr_lin'], [prompt_suffix], 'mr_lin:text', kind='text', blocks=triggers, model=model
+            )
         
-        # If it was a food log, extract nutrition and add Mr. Lin specific warnings
+        # If it was a food log, extract nutrition (cached/structured replies carry theirs)
+        nutrition_data = None
+        sodium_totals = None
         if is_food_log:
-            nutrition_data = update_daily_intake(user_id, user_message, response.text)
-            
-            if nutrition_data['calories'] > 0:
-                # Check against Mr. Lin's specific triggers
-                warnings, suggestions = check_food_for_mr_lin(user_message, nutrition_data)
-                
-                # Add personalized warnings based on daily totals
-                new_sodium_total = current_sodium + nutrition_data.get('sodium', 0)
-                
-                if current_sodium < 1500 and new_sodium_total >= 1500:
-                    response_text += "\n\n🚨 林先生！今天的鈉已經超標了（1500毫克）！"
-                    response_text += "\n記得您爸爸的事...晚餐一定要清淡，不然血壓會飆高的"
-                elif current_sodium < 1200 and new_sodium_total >= 1200:
-                    response_text += "\n\n📊 提醒：鈉攝取已經到80%了，晚餐要小心哦"
-                
-                # Add any specific warnings
-                for warning in warnings[:1]:  # Only show top warning
-                    response_text += f"\n\n{warning}"
-                
-                for suggestion in suggestions[:1]:  # Only show top suggestion
-                    response_text += f"\n💡 {suggestion}"
+            nutrition_data, sodium_totals = update_daily_intake(user_id, user_message, response_text, known_nutrition, items)
+        if local_items is not None:
+            response_text = render_local_reply(items, known_nutrition, current_sodium, logged=sodium_totals is not None)
+        if cached is None and local_items is None:
+            text_cache.set(cache_key, (response_text, nutrition_data, items), text_size(response_text))
         
+        # Add Mr. Lin specific warnings for logged food
+        if sodium_totals is not None:
+            # Check against Mr. Lin's specific triggers
+            warnings, suggestions = check_food_for_mr_lin(user_message, nutrition_data, hits)
+            
+            # Add personalized warnings based on daily totals - the before/after
+            # pair comes from the same atomic update, so each crossing fires once
+            sodium_before, new_sodium_total = sodium_totals
+            
+            if sodium_before < 1500 and new_sodium_total >= 1500:
+                response_text += "\n\n🚨 林先生！今天的鈉已經超標了（1500毫克）！"
+                response_text += "\n記得您爸爸的事...晚餐一定要清淡，不然血壓會飆高的"
+            elif sodium_before < 1200 and new_sodium_total >= 1200:
+                response_text += "\n\n📊 提醒：鈉攝取已經到80%了，晚餐要小心哦"
+            
+            # Add any specific warnings
+            for warning in warnings[:1]:  # Only show top warning
+                response_text += f"\n\n{warning}"
+            
+            for suggestion in suggestions[:1]:  # Only show top suggestion
+                response_text += f"\n💡 {suggestion}"
+    
         return response_text
         
+    except GeminiUnavailable as e:
+        return fallback_reply('text', e)
     except Exception as e:
         return "哎呀，我現在有點轉不過來，林先生可以再說一次嗎？"
 
@@ -168,57 +314,67 @@ def analyze_image_with_gemini(image_id, line_bot_api, user_id):
     
     # Track conversation
     msg_count = get_conversation_depth(user_id)
-    current_intake = user_daily_intake.get(user_id, {})
+    current_intake = user_state.get('daily_intake', user_id, {})
     current_sodium = current_intake.get('sodium', 0)
     current_calories = current_intake.get('calories', 0)
     
     try:
         # Download image from LINE
-        message_content = line_bot_api.get_message_content(image_id)
-        image_bytes = b''
-        for chunk in message_content.iter_content():
-            image_bytes += chunk
-        
-        image_part = types.Part.from_bytes(
-            data=image_bytes,
-            mime_type='image/jpeg'
-        )
-        
-        prompt = f"""你是林先生的營養追蹤助手，正在分析他傳來的食物照片。
-
-林先生背景：
-- 55歲，高血壓（145/92），BMI 27
-- 原本愛吃：油條、滷肉飯、牛肉麵湯
-- 目標：鈉<1500mg/天，熱量2000大卡
-- 今天已吃：鈉{current_sodium}mg，熱量{current_calories}大卡
-- 怕像爸爸一樣中風
-
-分析這張照片時：
-1. 用台灣人熟悉的食物名稱描述
-2. 估算營養成分（特別注意鈉含量）
-3. 如果是他的「地雷食物」（油條、滷肉、醃菜等），要提醒
-4. 給出具體建議（不是說教）
-5. 如果是健康選擇，要大力稱讚
-6. 適時提到林太太可以幫忙準備更健康的版本
-
-回應要像朋友，不要像營養報告。"""
-
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[prompt, image_part]
-        )
+        image_bytes = download_image(line_bot_api, image_id)
+        image_key = hashlib.sha256(image_bytes).hexdigest()
         
-        # Extract nutrition and check limits
-        nutrition_data = update_daily_intake_from_image(user_id, response.text)
-        
-        response_text = response.text
+        cached = image_cache.get(image_key)
+        if cached is not None:
+            # Same photo seen before - skip the model call
+            response_text = cached['text']
+            nutrition_data = cached['nutrition']
+            # Atomic check-and-mark, so two concurrent copies are logged only once
+            already_logged = logged_photos.mark(user_id, image_key)
+            if already_logged and not IMAGE_CACHE_RECOUNT:
+                return response_text + DUPLICATE_PHOTO_NOTE
+            _, sodium_totals = update_daily_intake_from_image(user_id, response_text, nutrition_data, cached['items'])
+            if cached['dhash'] is not None:
+                photo_index.add(user_id, cached['dhash'], response_text)
+        else:
+            # Claim the photo before analysing it: a copy that arrives while
+            # this one is still with Gemini finds the mark instead of a cache miss
+            if logged_photos.mark(user_id, image_key) and not IMAGE_CACHE_RECOUNT:
+                return DUPLICATE_PHOTO_PENDING
+            try:
+                # Real format from the magic bytes, EXIF gone, long edge capped
+                data, mime_type, photo_hash = image_preprocessor.run(image_bytes)
+                duplicate = photo_index.find(user_id, photo_hash) if photo_hash is not None else None
+                if duplicate is None:
+                    response_text, known_nutrition, items = _analyze_image_bytes(data, mime_type, current_sodium, current_calories)
+            except BaseException:
+                logged_photos.unmark(user_id, image_key)
+                raise
+            if duplicate is not None:
+                # Another shot (or a crop) of a plate analyzed moments ago:
+                # reuse that analysis and don't log the meal a second time
+                logged_photos.unmark(user_id, image_key)
+                return duplicate[1] + NEAR_DUPLICATE_PHOTO_NOTE
+            
+            # Extract nutrition and check limits
+            nutrition_data, sodium_totals = update_daily_intake_from_image(user_id, response_text, known_nutrition, items)
+            image_cache.set(image_key, {
+                'text': response_text,
+                'nutrition': nutrition_data,
+                'items': items,
+                'dhash': photo_hash
+            }, text_size(response_text))
+            if photo_hash is not None:
+                photo_index.add(user_id, photo_hash, response_text)
         
         # Mr. Lin specific alerts
         if nutrition_data.get('sodium', 0) > 0:
-            new_sodium_total = current_sodium + nutrition_data['sodium']
+            if sodium_totals is not None:
+                new_sodium_total = sodium_totals[1]
+            else:
+                new_sodium_total = current_sodium + nutrition_data['sodium']
             
             # Check for his specific trigger foods in the response
-            if any(trigger in response_text for trigger in ['油條', '滷肉', '牛肉麵', '醃']):
+            if 'reply_trigger' in match_keywords(response_text):
                 response_text += "\n\n😅 林先生...這個不是我們說好要避免的嗎？"
                 response_text += "\n記得您說過「不想像爸爸一樣」，加油，我們可以做到的！"
             
@@ -228,16 +384,36 @@ def analyze_image_with_gemini(image_id, line_bot_api, user_id):
         
         return response_text
         
+    except GeminiUnavailable as e:
+        return fallback_reply('image', e)
+    except ImageTooLargeError:
+        return "哎呀，這張照片太大了，林先生可以縮小一點或重新拍一張再傳嗎？"
     except Exception as e:
         return "哎呀，照片有點看不清楚欸，林先生可以再拍一張嗎？光線亮一點會更好哦！"
 
-def get_daily_summary(user_id):
-    """Generate Mr. Lin specific daily summary"""
-    # Import these at function level to avoid circular import
-    from datetime import datetime
+def forget_user_photos(user_id):
+    """Let the user's photos count again after they clear their day.
+
+    Drops both the exact-photo marks and the near-duplicate hashes, so a
+    re-sent or re-shot plate is logged again instead of answered with the
+    analysis of a meal that no longer counts.
+    """
+    logged_photos.forget(user_id)
+    photo_index.forget(user_id)
+
+def _analyze_image_bytes(data, mime_type, current_sodium, current_calories):
+    """Ask Gemini about a preprocessed food photo; returns generate_reply's tuple"""
+    image_part = types.Part.from_bytes(
+        data=data,
+        mime_type=mime_type
+    )
     
-    if user_id not in user_daily_intake or not user_daily_intake[user_id]['meals']:
-        return """📊 林先生，今天還沒有記錄任何餐點欸！
+    return generate_reply(
+        IMAGE_PREFIXES['mr_lin'], [build_image_suffix(current_sodium, current_calories), image_part],
+        'mr_lin:image', kind='image'
+    )
+
+EMPTY_SUMMARY = """📊 林先生，今天還沒有記錄任何餐點欸！
 
 記得要：
 • 拍照或告訴我您吃了什麼
@@ -245,8 +421,44 @@ def get_daily_summary(user_id):
 • 今天走路了嗎？
 
 加油！為了不要像爸爸一樣，我們一起努力 💪"""
+
+# Trigger foods counted per day for the summary, in reminder order
+MEAL_TRIGGERS = (
+    ('meal_youtiao', '油條'),
+    ('meal_beef_noodle', '牛肉麵'),
+    ('meal_braised_pork', '滷肉')
+)
+
+def count_meal_triggers(meals):
+    """Running-counter increments for MEAL_TRIGGERS found in new meal rows"""
+    counts = [0] * len(MEAL_TRIGGERS)
+    for meal in meals:
+        meal_hits = match_keywords(meal)
+        for i, (category, _) in enumerate(MEAL_TRIGGERS):
+            if category in meal_hits:
+                counts[i] += 1
+    return tuple(counts)
+
+def get_daily_summary(user_id):
+    """Generate Mr. Lin specific daily summary (cached until his day changes)"""
+    revision = user_state.intake_revision(user_id)
+    if revision is None:
+        return EMPTY_SUMMARY
+    
+    cached = summary_cache.get(user_id)
+    if cached is not None and cached[0] == revision:
+        return cached[1]
+    
+    intake = user_state.get('daily_intake', user_id)
+    summary = render_daily_summary(intake)
+    summary_cache.set(user_id, (intake['revision'], summary), text_size(summary))
+    return summary
+
+def render_daily_summary(intake):
+    """Format the summary text for one day's intake"""
+    if not intake['meals']:
+        return EMPTY_SUMMARY
     
-    intake = user_daily_intake[user_id]
     meals_list = "\n".join([f"• {meal}" for meal in intake['meals'][-5:]])
     
     # Calculate percentages
@@ -261,15 +473,14 @@ def get_daily_summary(user_id):
     else:
         sodium_msg = f"✅ 鈉控制得不錯：{intake['sodium']:.0f}毫克（{sodium_percent:.0f}%）\n繼續保持！"
     
-    # Check if he ate any trigger foods
+    # Trigger foods eaten today - counted at write time, rescanned only for
+    # days saved before the counters existed
+    trigger_counts = intake['trigger_counts']
+    if trigger_counts is None:
+        trigger_counts = count_meal_triggers(intake['meals'])
     trigger_foods_eaten = []
-    for meal in intake['meals']:
-        if '油條' in meal:
-            trigger_foods_eaten.append('油條')
-        if '牛肉麵' in meal:
-            trigger_foods_eaten.append('牛肉麵')
-        if '滷肉' in meal:
-            trigger_foods_eaten.append('滷肉')
+    for (_, name), count in zip(MEAL_TRIGGERS, trigger_counts):
+        trigger_foods_eaten.extend([name] * count)
     
     reminder = ""
     if trigger_foods_eaten:
@@ -300,102 +511,53 @@ def get_daily_summary(user_id):
     
     return summary
 
-def update_daily_intake(user_id, user_message, gemini_response):
-    """Extract nutrition data and return it"""
-    if user_id not in user_daily_intake:
-        user_daily_intake[user_id] = {
-            'calories': 0, 'protein': 0, 'carbs': 0, 
-            'fat': 0, 'sodium': 0, 'meals': []
-        }
-    
-    nutrition = extract_nutrition_values(gemini_response)
+def describe_item(item):
+    """One meal-list row for a structured food item"""
+    return f"{item['name']}（鈉{item['sodium']:.0f}毫克）"
+
+def update_daily_intake(user_id, user_message, gemini_response, nutrition=None, items=None):
+    """Extract nutrition data (unless already extracted) and log it.
+
+    Returns (nutrition, sodium_totals) where sodium_totals is the
+    (before, after) daily sodium from the atomic update, or None if nothing
+    was logged.
+    """
+    if nutrition is None:
+        nutrition = extract_nutrition_values(gemini_response)
     
     if nutrition['calories'] > 0:
-        for key, value in nutrition.items():
-            if key != 'meal_description':
-                user_daily_intake[user_id][key] += value
+        if items:
+            # Structured replies log one row per food item
+            meals = [describe_item(item) for item in items]
+        else:
+            meals = [user_message[:50] + "..." if len(user_message) > 50 else user_message]
         
-        meal_desc = user_message[:50] + "..." if len(user_message) > 50 else user_message
-        user_daily_intake[user_id]['meals'].append(meal_desc)
+        # One atomic update, so concurrent workers never lose an increment
+        before, after = user_state.add_intake(user_id, nutrition, meals, count_meal_triggers(meals))
+        return nutrition, (before['sodium'], after['sodium'])
     
-    return nutrition
-
-def update_daily_intake_from_image(user_id, gemini_response):
-    """Extract nutrition from image analysis"""
-    if user_id not in user_daily_intake:
-        user_daily_intake[user_id] = {
-            'calories': 0, 'protein': 0, 'carbs': 0, 
-            'fat': 0, 'sodium': 0, 'meals': []
-        }
-    
-    nutrition = extract_nutrition_values(gemini_response)
+    return nutrition, None
+
+def update_daily_intake_from_image(user_id, gemini_response, nutrition=None, items=None):
+    """Extract nutrition from image analysis (or log already-extracted values).
+
+    Returns (nutrition, sodium_totals) like update_daily_intake.
+    """
+    if nutrition is None:
+        nutrition = extract_nutrition_values(gemini_response)
     
     if nutrition['calories'] > 0:
-        for key, value in nutrition.items():
-            if key != 'meal_description':
-                user_daily_intake[user_id][key] += value
-        
-        # Try to extract food name from response
-        food_match = re.search(r'這[似看]起來是(.+?)[！。\n]', gemini_response)
-        if food_match:
-            meal_desc = f"照片：{food_match.group(1)}"
+        if items:
+            meals = [f"照片：{describe_item(item)}" for item in items]
         else:
-            meal_desc = "照片：分析的餐點"
+            # Try to extract food name from response
+            food_match = re.search(r'這[似看]起來是(.+?)[！。\n]', gemini_response)
+            if food_match:
+                meals = [f"照片：{food_match.group(1)}"]
+            else:
+                meals = ["照片：分析的餐點"]
         
-        user_daily_intake[user_id]['meals'].append(meal_desc)
-    
-    return nutrition
-
-def extract_nutrition_values(text):
-    """Extract nutrition values - works with both English and Chinese"""
-    values = {
-        'calories': 0,
-        'protein': 0,
-        'carbs': 0,
-        'fat': 0,
-        'sodium': 0
-    }
-    
-    # Patterns for both languages
-    patterns = {
-        'calories': [
-            r'(\d+)\s*(?:calories|kcal|cal|大卡|卡路里|熱量)',
-            r'(?:calories|熱量)[:\s]+(\d+)',
-            r'(?:約|大約|大概|approximately)?\s*(\d+)\s*(?:kcal|大卡)'
-        ],
-        'protein': [
-            r'(?:protein|蛋白質)[:\s]+(\d+\.?\d*)\s*(?:g|克|公克)',
-            r'(\d+\.?\d*)\s*(?:g|克)\s*(?:protein|蛋白質)',
-            r'蛋白質\s*(\d+\.?\d*)(?:g|克)?'
-        ],
-        'carbs': [
-            r'(?:carb|碳水化合物|醣類)[:\s]+(\d+\.?\d*)\s*(?:g|克|公克)',
-            r'(\d+\.?\d*)\s*(?:g|克)\s*(?:carb|碳水)',
-            r'碳水\s*(\d+\.?\d*)(?:g|克)?'
-        ],
-        'fat': [
-            r'(?:fat|脂肪)[:\s]+(\d+\.?\d*)\s*(?:g|克|公克)',
-            r'(\d+\.?\d*)\s*(?:g|克)\s*(?:fat|脂肪)',
-            r'脂肪\s*(\d+\.?\d*)(?:g|克)?'
-        ],
-        'sodium': [
-            r'(?:sodium|鈉)[:\s]+(\d+)\s*(?:mg|毫克)',
-            r'(\d+)\s*(?:mg|毫克)\s*(?:sodium|的鈉|鈉)',
-            r'鈉\s*(\d+)\s*(?:mg|毫克)?',
-            r'(\d+)-(\d+)\s*(?:mg|毫克)\s*(?:的)?鈉'  # For ranges
-        ]
-    }
-    
-    text_lower = text.lower()
-    for nutrient, pattern_list in patterns.items():
-        for pattern in pattern_list:
-            match = re.search(pattern, text_lower)
-            if match:
-                if nutrient == 'sodium' and len(match.groups()) == 2:
-                    # For ranges, take the higher value
-                    values[nutrient] = float(match.group(2))
-                else:
-                    values[nutrient] = float(match.group(1))
-                break
+        before, after = user_state.add_intake(user_id, nutrition, meals, count_meal_triggers(meals))
+        return nutrition, (before['sodium'], after['sodium'])
     
-    return values
\ No newline at end of file
+    return nutrition, None
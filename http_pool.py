@@ -0,0 +1,202 @@
+# http_pool.py - Pooled keep-alive HTTP sessions for the LINE and Gemini clients
+
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+# Connections kept per host; defaults to the most callers that can be in
+# flight at once: EVENT_CONCURRENCY event threads (sync dispatch), the
+# WORKER_POOL_SIZE queue workers and the webhook thread itself
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', str(
+    int(os.getenv('EVENT_CONCURRENCY', '8')) + int(os.getenv('WORKER_POOL_SIZE', '4')) + 1)))
+# Wait for a free pooled connection instead of opening a throwaway one past
+# the pool size; off by default so a leaked streamed response cannot stall callers
+HTTP_POOL_BLOCK = os.getenv('HTTP_POOL_BLOCK', 'false').lower() == 'true'
+# Seconds a blocked caller waits for a pooled connection before PoolTimeout
+HTTP_POOL_TIMEOUT = float(os.getenv('HTTP_POOL_TIMEOUT', '5'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))
+LINE_READ_TIMEOUT = float(os.getenv('LINE_READ_TIMEOUT', '10'))
+GEMINI_READ_TIMEOUT = float(os.getenv('GEMINI_READ_TIMEOUT', '60'))
+
+
+class PoolTimeout(requests.ConnectionError):
+    """No pooled connection came free within HTTP_POOL_TIMEOUT (blocking pools only)"""
+
+
+def _bounded_wait(pool_class, wait):
+    """Pool class whose blocking checkout gives up after `wait` seconds.
+
+    requests never passes urllib3 a pool timeout, so a blocking pool would
+    otherwise wait forever for a connection that is never returned.
+    """
+
+    class BoundedPool(pool_class):
+        def _get_conn(self, timeout=None):
+            return super()._get_conn(timeout=wait if timeout is None else timeout)
+
+    return BoundedPool
+
+
+class PooledSession:
+    """requests.Session with a bounded keep-alive pool and call counters.
+
+    Reusing the session keeps TLS connections open between requests, so a
+    reply or push only pays the handshake when the pool has no idle
+    connection for that host.
+    """
+
+    def __init__(self, name, pool_size=HTTP_POOL_SIZE, block=HTTP_POOL_BLOCK,
+                 timeout=(HTTP_CONNECT_TIMEOUT, LINE_READ_TIMEOUT), pool_timeout=HTTP_POOL_TIMEOUT):
+        self.name = name
+        self.pool_size = pool_size
+        self.block = block
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=block)
+        if block:
+            self._adapter.poolmanager.pool_classes_by_scheme = {
+                'http': _bounded_wait(HTTPConnectionPool, pool_timeout),
+                'https': _bounded_wait(HTTPSConnectionPool, pool_timeout)
+            }
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {
+            'requests': 0,
+            'errors': 0,
+            'timeouts': 0,
+            'pool_timeouts': 0,
+            'saturated': 0,
+            'in_flight_max': 0,
+            'time_total': 0.0,
+            'time_max': 0.0
+        }
+
+    def request(self, method, url, timeout=None, **kwargs):
+        with self._lock:
+            self._in_flight += 1
+            self._stats['requests'] += 1
+            if self._in_flight > self.pool_size:
+                # More callers than pooled connections - this one waits (or opens a throwaway one)
+                self._stats['saturated'] += 1
+            self._stats['in_flight_max'] = max(self._stats['in_flight_max'], self._in_flight)
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        except EmptyPoolError as e:
+            self._count('pool_timeouts')
+            raise PoolTimeout(f"{self.name}: no free connection in the pool of {self.pool_size}") from e
+        except requests.Timeout:
+            self._count('timeouts')
+            raise
+        except requests.RequestException:
+            self._count('errors')
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._in_flight -= 1
+                self._stats['time_total'] += elapsed
+                self._stats['time_max'] = max(self._stats['time_max'], elapsed)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def pools(self):
+        """Per-host connection counts straight from urllib3"""
+        pools = {}
+        manager = self._adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+            pools[pool.host] = {
+                # Every new connection is a fresh TCP + TLS handshake
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': idle
+            }
+        return pools
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = self._in_flight
+        stats['pool_size'] = self.pool_size
+        stats['pool_block'] = self.block
+        stats['timeout'] = list(self.timeout)
+        stats['time_avg'] = stats['time_total'] / stats['requests'] if stats['requests'] else 0.0
+        stats['hosts'] = self.pools()
+        return stats
+
+
+line_session = PooledSession('line', timeout=(HTTP_CONNECT_TIMEOUT, LINE_READ_TIMEOUT))
+gemini_session = PooledSession('gemini', timeout=(HTTP_CONNECT_TIMEOUT, GEMINI_READ_TIMEOUT))
+
+
+class PooledLineHttpClient(RequestsHttpClient):
+    """LINE SDK http client that sends everything through the pooled line_session"""
+
+    session = line_session
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(self.session.request(
+            'GET', url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        ))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.request(
+            'POST', url, headers=headers, data=data, timeout=timeout or self.timeout
+        ))
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.request(
+            'DELETE', url, headers=headers, data=data, timeout=timeout or self.timeout
+        ))
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.request(
+            'PUT', url, headers=headers, data=data, timeout=timeout or self.timeout
+        ))
+
+
+def use_pooled_session(client, session=gemini_session):
+    """Route a google-genai Client's API-key requests through a pooled session.
+
+    google-genai 0.1.0 builds a new requests.Session (and so a new TLS
+    connection) for every call and sets no timeout. Returns False when the
+    client does not look like that version, leaving it untouched.
+    """
+    api_client = getattr(client, '_api_client', None)
+    if api_client is None or not hasattr(api_client, '_request_unauthorized'):
+        return False
+    from google.genai import _api_client as genai_api
+    from google.genai import errors
+
+    def request_unauthorized(http_request, stream=False):
+        data = http_request.data
+        if data and not isinstance(data, bytes):
+            data = json.dumps(data, cls=genai_api.RequestJsonEncoder)
+        response = session.request(
+            http_request.method.upper(), http_request.url,
+            headers=http_request.headers, data=data or None, stream=stream
+        )
+        errors.APIError.raise_for_response(response)
+        return genai_api.HttpResponse(response.headers, response if stream else [response.text])
+
+    api_client._request_unauthorized = request_unauthorized
+    return True
+
+
+def stats():
+    return {'line': line_session.stats(), 'gemini': gemini_session.stats()}
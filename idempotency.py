@@ -0,0 +1,204 @@
+# idempotency.py - Seen-set and single-flight for redelivered webhook events
+
+import functools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# How long a handled event id is remembered; LINE redelivers within minutes
+EVENT_DEDUP_TTL = int(os.getenv('EVENT_DEDUP_TTL', '3600'))
+EVENT_DEDUP_MAX = int(os.getenv('EVENT_DEDUP_MAX', '20000'))
+
+logger = logging.getLogger(__name__)
+
+
+def event_key(event):
+    """Stable id for a webhook event: webhookEventId, else the message id"""
+    key = getattr(event, 'webhook_event_id', None)
+    if key:
+        return key
+    message = getattr(event, 'message', None)
+    message_id = getattr(message, 'id', None)
+    return f"message:{message_id}" if message_id else None
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error', 'committed')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.committed = False
+
+
+class EventDeduplicator:
+    """Runs each event key at most once per TTL.
+
+    A duplicate that arrives while the first delivery is still running
+    waits for it and gets the same result instead of repeating the work
+    (single-flight); one that arrives later gets the remembered result.
+    If the work raises before commit() was called, the key is forgotten so
+    a redelivery can retry; once it has committed side effects (a meal
+    logged, a reading stored) a later failure still marks the key done, so
+    a redelivery cannot repeat them.
+    Memory is bounded: entries expire after ttl and the oldest are
+    dropped past max_entries.
+
+    All of that is per process. With several worker processes pass the
+    shared StateStore as `shared`: each event is then also claimed there,
+    so a redelivery that lands on another worker is skipped as well (it
+    gets None instead of the first worker's result).
+    """
+
+    def __init__(self, ttl=EVENT_DEDUP_TTL, max_entries=EVENT_DEDUP_MAX, shared=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self._seen = OrderedDict()  # key -> (expires_at, result), oldest first
+        self._in_flight = {}        # key -> _Flight
+        self._lock = threading.Lock()
+        self._local = threading.local()  # the flight this thread is running, for commit()
+        self._stats = {
+            'runs': 0,
+            'duplicates': 0,
+            'redeliveries': 0,
+            'joined_in_flight': 0,
+            'failed': 0,
+            'failed_after_commit': 0,
+            'claimed_elsewhere': 0,
+            'expired': 0,
+            'evicted': 0
+        }
+
+    def run(self, key, func, *args):
+        """(result, duplicate): func(*args)'s result, computed once per key"""
+        if key is None:
+            return func(*args), False
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._seen.get(key)
+            if entry is not None:
+                self._stats['duplicates'] += 1
+                return entry[1], True
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+                self._stats['runs'] += 1
+            else:
+                self._stats['duplicates'] += 1
+                self._stats['joined_in_flight'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None and not flight.committed:
+                raise flight.error
+            return flight.result, True
+
+        if not self._claim_shared(key, flight):
+            return flight.result, True
+
+        outer = getattr(self._local, 'flight', None)
+        self._local.flight = flight
+        try:
+            flight.result = func(*args)
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                del self._in_flight[key]
+                self._stats['failed'] += 1
+                if flight.committed:
+                    self._stats['failed_after_commit'] += 1
+                    self._remember(key, None)
+            if self.shared is not None and not flight.committed:
+                self._release_shared(key)
+            raise
+        else:
+            with self._lock:
+                del self._in_flight[key]
+                self._remember(key, flight.result)
+        finally:
+            self._local.flight = outer
+            flight.done.set()
+        return flight.result, False
+
+    def _claim_shared(self, key, flight):
+        """Claim key for this process in the shared store; False if another one has it"""
+        if self.shared is None:
+            return True
+        try:
+            claimed = self.shared.claim('event', None, key, self.ttl)
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                del self._in_flight[key]
+                self._stats['failed'] += 1
+            flight.done.set()
+            raise
+        if not claimed:
+            with self._lock:
+                del self._in_flight[key]
+                self._stats['runs'] -= 1
+                self._stats['duplicates'] += 1
+                self._stats['claimed_elsewhere'] += 1
+                self._remember(key, None)
+            flight.done.set()
+        return claimed
+
+    def _release_shared(self, key):
+        try:
+            self.shared.release('event', None, key)
+        except Exception:
+            # The claim then simply expires after ttl
+            logger.exception("could not release shared claim for %s", key)
+
+    def commit(self):
+        """Mark the event this thread is running as having changed state.
+
+        A failure after this point no longer lets a redelivery run the
+        event again. No-op outside run().
+        """
+        flight = getattr(self._local, 'flight', None)
+        if flight is not None:
+            flight.committed = True
+
+    def _remember(self, key, result):
+        # Caller holds the lock
+        self._seen[key] = (time.monotonic() + self.ttl, result)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+            self._stats['evicted'] += 1
+
+    def once(self, handler):
+        """Decorator: handler(event) runs once per event_key(event)"""
+        @functools.wraps(handler)
+        def wrapper(event):
+            delivery = getattr(event, 'delivery_context', None)
+            if getattr(delivery, 'is_redelivery', False):
+                with self._lock:
+                    self._stats['redeliveries'] += 1
+            return self.run(event_key(event), handler, event)[0]
+        return wrapper
+
+    def _expire(self, now):
+        # Same TTL for every entry, so insertion order is expiry order
+        while self._seen:
+            key, (expires_at, _) = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            del self._seen[key]
+            self._stats['expired'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['remembered'] = len(self._seen)
+            stats['in_flight'] = len(self._in_flight)
+        stats['ttl'] = self.ttl
+        stats['max_entries'] = self.max_entries
+        stats['shared'] = self.shared is not None
+        return stats
@@ -0,0 +1,211 @@
+# image_processing.py - Sniff, strip and downscale food photos before the vision call
+
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # In requirements.txt; without it photos are only sniffed and EXIF-stripped
+    Image = None
+
+from photo_index import dhash
+
+# Longest edge sent to Gemini; larger photos only cost more upload bytes and tiles
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', '1024'))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '80'))
+# 'thread' (Pillow releases the GIL while decoding/resizing) or 'process'
+IMAGE_POOL = os.getenv('IMAGE_POOL', 'thread')
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+# Photos in the pool (running + waiting) before new ones skip preprocessing;
+# up to EVENT_CONCURRENCY handlers can send photos at once, far more than
+# IMAGE_WORKERS can shrink within IMAGE_PREPROCESS_TIMEOUT
+IMAGE_MAX_PENDING = int(os.getenv('IMAGE_MAX_PENDING', str(IMAGE_WORKERS * 2)))
+IMAGE_PREPROCESS_TIMEOUT = float(os.getenv('IMAGE_PREPROCESS_TIMEOUT', '10'))
+
+logger = logging.getLogger(__name__)
+
+
+def sniff_mime(data):
+    """MIME type from the file's magic bytes, or None if unrecognised"""
+    head = bytes(data[:16])
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'heic', b'heix', b'hevc', b'hevx'):
+            return 'image/heic'
+        if brand in (b'mif1', b'msf1', b'heif'):
+            return 'image/heif'
+    return None
+
+
+def strip_jpeg_exif(data):
+    """JPEG bytes without APP1 (EXIF/XMP) segments - no decoding involved"""
+    data = bytes(data)
+    out = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xDA:  # Start of scan: the rest is entropy-coded image data
+            break
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if marker != 0xE1:
+            out.append(data[pos:pos + 2 + length])
+        pos += 2 + length
+    out.append(data[pos:])
+    return b''.join(out)
+
+
+def preprocess(data, max_edge=IMAGE_MAX_EDGE, quality=IMAGE_JPEG_QUALITY):
+    """(bytes, mime, how, dhash) ready for the vision model.
+
+    With Pillow the photo is rotated per its EXIF orientation, shrunk to
+    max_edge and re-encoded as a metadata-free JPEG. Formats Pillow cannot
+    open (e.g. HEIC without a plugin) go through unchanged with their real
+    MIME type; without Pillow JPEGs still lose their EXIF block. The
+    perceptual hash is None whenever the photo could not be decoded.
+    """
+    mime = sniff_mime(data)
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if image.format == 'JPEG':
+                    # Let the decoder do most of the downscaling (DCT scaling)
+                    image.draft('RGB', (max_edge, max_edge))
+                image = ImageOps.exif_transpose(image)
+                if image.mode in ('RGBA', 'LA', 'P'):
+                    image = image.convert('RGBA')
+                    background = Image.new('RGB', image.size, (255, 255, 255))
+                    background.paste(image, mask=image.getchannel('A'))
+                    image = background
+                elif image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+                out = io.BytesIO()
+                image.save(out, 'JPEG', quality=quality, optimize=True)
+                return out.getvalue(), 'image/jpeg', 'recompressed', dhash(image)
+        except Exception:
+            pass  # Not decodable here - send the original bytes below
+    if mime == 'image/jpeg':
+        return strip_jpeg_exif(data), mime, 'exif_stripped', None
+    return bytes(data), mime or 'image/jpeg', 'passthrough', None
+
+
+class ImagePreprocessor:
+    """Runs preprocess() on a small worker pool and keeps size/latency counters.
+
+    At most max_pending photos are in the pool at once; past that a photo
+    is sent as-is (EXIF-stripped when it is a JPEG) straight away instead
+    of queueing behind work that would outlive its timeout. A photo that
+    times out is cancelled if it has not started yet, and keeps its
+    pending slot until its worker is actually free.
+    """
+
+    def __init__(self, pool=IMAGE_POOL, workers=IMAGE_WORKERS, timeout=IMAGE_PREPROCESS_TIMEOUT,
+                 max_pending=IMAGE_MAX_PENDING):
+        executor = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+        self.pool = pool
+        self.workers = workers
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._executor = executor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._pending = 0
+        if Image is None:
+            logger.warning("Pillow is not installed: photos are sent without downscaling "
+                           "and near-duplicate detection is off (pip install -r requirements.txt)")
+        self._stats = {
+            'images': 0,
+            'failed': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'time_total': 0.0,
+            'by_mime': {},
+            'by_result': {}
+        }
+
+    def run(self, data):
+        """(bytes, mime, dhash) for the vision call; falls back to the original bytes on error"""
+        start = time.perf_counter()
+        with self._lock:
+            admitted = self._pending < self.max_pending
+            if admitted:
+                self._pending += 1
+        if admitted:
+            result, mime, how, photo_hash = self._submit(data)
+        else:
+            result, mime, how, photo_hash = self._unprocessed(data, 'rejected')
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats = self._stats
+            stats['images'] += 1
+            stats['failed'] += how in ('failed', 'timeout')
+            stats['rejected'] += how == 'rejected'
+            stats['timeouts'] += how == 'timeout'
+            stats['bytes_in'] += len(data)
+            stats['bytes_out'] += len(result)
+            stats['time_total'] += elapsed
+            stats['by_mime'][mime] = stats['by_mime'].get(mime, 0) + 1
+            stats['by_result'][how] = stats['by_result'].get(how, 0) + 1
+        return result, mime, photo_hash
+
+    def _submit(self, data):
+        """preprocess() in the pool; the caller has taken a pending slot"""
+        try:
+            # Process pools pickle the argument, and bytes pickle cheaper than bytearray
+            payload = bytes(data) if self.pool == 'process' else data
+            future = self._executor.submit(preprocess, payload)
+        except Exception as e:
+            self._release()
+            logger.warning("preprocessing failed: %r", e)
+            return self._unprocessed(data, 'failed')
+        future.add_done_callback(self._release)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            if future.cancel():
+                with self._lock:
+                    self._stats['cancelled'] += 1
+            logger.warning("preprocessing timed out after %.1fs", self.timeout)
+            return self._unprocessed(data, 'timeout')
+        except Exception as e:
+            logger.warning("preprocessing failed: %r", e)
+            return self._unprocessed(data, 'failed')
+
+    def _release(self, future=None):
+        with self._lock:
+            self._pending -= 1
+
+    @staticmethod
+    def _unprocessed(data, how):
+        mime = sniff_mime(data)
+        if mime == 'image/jpeg':
+            data = strip_jpeg_exif(data)
+        return bytes(data), mime or 'image/jpeg', how, None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, by_mime=dict(self._stats['by_mime']),
+                         by_result=dict(self._stats['by_result']))
+            stats['pending'] = self._pending
+        stats['pool'] = self.pool
+        stats['workers'] = self.workers
+        stats['max_pending'] = self.max_pending
+        stats['pillow'] = Image is not None
+        stats['max_edge'] = IMAGE_MAX_EDGE
+        stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+        stats['time_avg'] = stats['time_total'] / stats['images'] if stats['images'] else 0.0
+        return stats
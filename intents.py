@@ -0,0 +1,136 @@
+# intents.py - Local intent classification and per-intent Gemini model routing
+
+import os
+import re
+import threading
+import unicodedata
+
+INTENTS = ('ack', 'state_query', 'food_log', 'exercise_bp', 'question')
+# Intents with a template reply, so they can be answered without Gemini
+LOCAL_INTENTS = ('ack', 'state_query')
+
+# Model tier per intent: 'local' answers from templates without calling
+# Gemini, 'default' uses the handler's GEMINI_MODEL
+INTENT_MODELS = {
+    'ack': os.getenv('INTENT_MODEL_ACK', 'local'),
+    'state_query': os.getenv('INTENT_MODEL_STATE_QUERY', 'local'),
+    'food_log': os.getenv('INTENT_MODEL_FOOD_LOG', 'default'),
+    'exercise_bp': os.getenv('INTENT_MODEL_EXERCISE_BP', 'gemini-2.0-flash-lite'),
+    'question': os.getenv('INTENT_MODEL_QUESTION', 'default')
+}
+
+# Whole-message acknowledgements (after stripping punctuation and emoji)
+ACK_PHRASES = frozenset([
+    '謝謝', '謝啦', '謝謝你', '感謝', '感恩', '多謝', '好', '好的', '好喔', '好哦', '好啊', '好滴',
+    '了解', '瞭解', '知道了', '收到', '沒問題', '嗯', '嗯嗯', '喔', '哦', '讚', '太好了', '加油',
+    'ok', 'okay', 'thanks', 'thank you', 'thx'
+])
+_NOT_WORD = re.compile(r'[\W_]+')
+
+# A state query is made only of these words ("今天鈉吃多少了?", "我還能吃多少鹽");
+# anything left over, like a dish name, means the message is about that food
+_QUERY_WORDS = (
+    '今天', '今日', '目前', '現在', '為止', '總共', '一共', '累積', '已經', '我的', '我',
+    '吃', '喝', '攝取量', '攝取', '含量', '量',
+    '多少', '幾', '剩下', '剩', '還能', '還可以', '可以', '能', '還', '再', '超標', '超過', '有沒有',
+    '碳水化合物', '碳水', '蛋白質', '脂肪', '卡路里', '大卡', '熱量', '鹽分', '鹽', '鈉',
+    '請問', '大概', '了', '的', '有', '呢', '嗎', '啊', '欸', '是', '到', '和', '跟',
+    'how much', 'how many', 'did i', 'have i', 'today', 'left', 'eaten', 'eat', 'had',
+    'sodium', 'calories', 'calorie', 'so far'
+)
+_QUERY_FILLER = re.compile('|'.join(re.escape(word) for word in sorted(_QUERY_WORDS, key=len, reverse=True)))
+
+
+def ack_key(message):
+    """Message reduced to its words, for the acknowledgement lookup"""
+    return _NOT_WORD.sub(' ', unicodedata.normalize('NFKC', message).lower()).strip()
+
+
+def classify_intent(message, hits):
+    """Intent for a non-command text, from the message and its keyword hits"""
+    key = ack_key(message)
+    if not key or key in ACK_PHRASES:
+        return 'ack'
+    if 'intent_query' in hits and 'intent_metric' in hits:
+        if not _QUERY_FILLER.sub('', key).replace(' ', ''):
+            return 'state_query'
+    if 'food_log' in hits:
+        return 'food_log'
+    if 'intent_activity' in hits:
+        return 'exercise_bp'
+    return 'question'
+
+
+ACK_REPLIES = (
+    "不客氣林先生 😊 有吃東西記得拍照給我看哦！",
+    "好的！林先生加油 💪 今天也要記得走路30分鐘～",
+    "👍 有任何問題隨時問我，林太太也可以一起看哦！"
+)
+
+
+def render_ack(msg_count):
+    """Short friendly reply to thanks / ok, rotating so it does not feel canned"""
+    return ACK_REPLIES[msg_count % len(ACK_REPLIES)]
+
+
+def render_state_query(intake):
+    """Answer 'how much sodium/calories today' straight from stored intake"""
+    sodium = intake.get('sodium', 0)
+    calories = intake.get('calories', 0)
+    if not intake.get('meal_count') and not calories:
+        return "林先生，今天還沒有記錄任何餐點哦！鈉的額度還有1500毫克 😊\n吃東西記得拍照或告訴我～"
+    text = f"""📊 林先生今天到目前為止：
+• 鈉：{sodium:.0f} / 1500 毫克
+• 熱量：{calories:.0f} / 2000 大卡
+• 蛋白質 {intake.get('protein', 0):.1f} 克、碳水 {intake.get('carbs', 0):.1f} 克、脂肪 {intake.get('fat', 0):.1f} 克
+"""
+    if sodium >= 1500:
+        text += "\n🚨 鈉已經超標了！接下來請吃清淡的，多喝水 💧"
+    elif sodium >= 1200:
+        text += f"\n⚠️ 只剩 {1500 - sodium:.0f} 毫克鈉，下一餐選蒸煮、不喝湯哦！"
+    else:
+        text += f"\n👍 還有 {1500 - sodium:.0f} 毫克鈉的額度，繼續保持！"
+    text += "\n\n想看完整摘要輸入 /today"
+    return text
+
+
+class IntentRouter:
+    """Picks the model per intent and counts intents, model calls and calls saved"""
+
+    def __init__(self, default_model, models=None):
+        self.default_model = default_model
+        self.models = dict(INTENT_MODELS if models is None else models)
+        self._lock = threading.Lock()
+        self._by_intent = {intent: 0 for intent in INTENTS}
+        self._calls_by_model = {}
+        self._answered_locally = 0
+
+    def model_for(self, intent):
+        """Gemini model for an intent, or None to answer locally"""
+        model = self.models.get(intent, 'default')
+        if model == 'local':
+            if intent in LOCAL_INTENTS:
+                return None
+            model = 'default'  # No template for this intent
+        return self.default_model if model == 'default' else model
+
+    def record(self, intent):
+        """Count a classified message; answered locally when its model is None"""
+        with self._lock:
+            self._by_intent[intent] += 1
+            if self.model_for(intent) is None:
+                self._answered_locally += 1
+
+    def record_call(self, model):
+        """Count a Gemini call actually made for a routed message"""
+        with self._lock:
+            self._calls_by_model[model] = self._calls_by_model.get(model, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'by_intent': dict(self._by_intent),
+                'calls_by_model': dict(self._calls_by_model),
+                'gemini_calls_saved': self._answered_locally,
+                'models': {intent: self.model_for(intent) or 'local' for intent in INTENTS}
+            }
@@ -0,0 +1,212 @@
+# job_queue.py - In-process job queue so webhooks can be acknowledged immediately
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Bounded job queue served by a fixed pool of worker threads"""
+
+    def __init__(self, workers=4, max_depth=100, name='nutriline-worker'):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.name = name
+        # Unbounded: max_depth is enforced by _depth, which also counts jobs
+        # parked behind an earlier job with the same key
+        self._queue = queue.Queue()
+        self._depth = 0
+        self._keyed = {}  # key -> deque of jobs waiting for the key's current job
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'rejected': 0,
+            'ordered_waits': 0,
+            'completed': 0,
+            'failed': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'run_time_total': 0.0,
+        }
+
+    def start(self):
+        """Start the worker threads (safe to call more than once)"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, key=None):
+        """Enqueue a job; returns False when the queue is full.
+
+        Jobs sharing a key run one at a time in submission order (jobs for
+        different keys still run in parallel), so one user's events are
+        never reordered or overlapped.
+        """
+        self.start()
+        job = (time.monotonic(), func, args, key)
+        with self._stats_lock:
+            if self._depth >= self.max_depth:
+                self._stats['rejected'] += 1
+                return False
+            ready = self._admit(job)
+        if ready:
+            self._queue.put(job)
+        return True
+
+    def submit_batch(self, func, items, key=None):
+        """Enqueue func(item) for every item, or nothing; False when they don't all fit.
+
+        A rejected webhook is redelivered whole by LINE, so its events go in
+        all together - never some queued and the rest left to the redelivery.
+        key(item) gives each job's ordering key, as in submit().
+        """
+        self.start()
+        now = time.monotonic()
+        ready = []
+        with self._stats_lock:
+            if self._depth + len(items) > self.max_depth:
+                self._stats['rejected'] += len(items)
+                return False
+            for item in items:
+                job = (now, func, (item,), None if key is None else key(item))
+                if self._admit(job):
+                    ready.append(job)
+        for job in ready:
+            self._queue.put(job)
+        return True
+
+    def _admit(self, job):
+        """Count a job in; True if it can go on the queue now. Call with _stats_lock held."""
+        self._depth += 1
+        self._stats['submitted'] += 1
+        key = job[3]
+        if key is not None:
+            waiting = self._keyed.get(key)
+            if waiting is not None:
+                # An earlier job for this key is queued or running - go after it
+                waiting.append(job)
+                self._stats['ordered_waits'] += 1
+                return False
+            self._keyed[key] = deque()
+        return True
+
+    def _worker(self):
+        while True:
+            enqueued_at, func, args, key = self._queue.get()
+            started_at = time.monotonic()
+            wait_time = started_at - enqueued_at
+            with self._stats_lock:
+                self._depth -= 1
+            ok = True
+            try:
+                func(*args)
+            except Exception:
+                ok = False
+                logger.exception("job %s failed", getattr(func, '__name__', func))
+            finally:
+                run_time = time.monotonic() - started_at
+                next_job = None
+                with self._stats_lock:
+                    self._stats['completed' if ok else 'failed'] += 1
+                    self._stats['wait_time_total'] += wait_time
+                    self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+                    self._stats['run_time_total'] += run_time
+                    if key is not None:
+                        waiting = self._keyed[key]
+                        if waiting:
+                            next_job = waiting.popleft()
+                        else:
+                            del self._keyed[key]
+                if next_job is not None:
+                    # Back of the line, so a busy key cannot starve the others
+                    self._queue.put(next_job)
+                self._queue.task_done()
+
+    def join(self):
+        """Block until every queued job has been processed"""
+        self._queue.join()
+
+    def stats(self):
+        """Snapshot of queue depth and wait-time counters"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        finished = stats['completed'] + stats['failed']
+        stats['workers'] = self.workers
+        stats['max_depth'] = self.max_depth
+        stats['depth'] = self._depth
+        stats['active_keys'] = len(self._keyed)
+        stats['wait_time_avg'] = stats['wait_time_total'] / finished if finished else 0.0
+        return stats
+
+
+class BatchRunner:
+    """Runs one batch of items concurrently across keys, in order within a key.
+
+    Used for multi-event webhooks handled inside the request: each user's
+    events run back to back on one thread, users run side by side (at most
+    `workers` at once) and run() returns when the whole batch is done.
+    """
+
+    def __init__(self, workers=8, name='nutriline-batch'):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'batches': 0,
+            'items': 0,
+            'failed': 0,
+            'batch_size_max': 0,
+            'keys_max': 0,
+            'run_time_total': 0.0,
+        }
+
+    def run(self, items, func, key):
+        """Call func(item) for every item; re-raises the first failure once all are done"""
+        started_at = time.monotonic()
+        groups = {}
+        for item in items:
+            item_key = key(item)
+            # Items without a key have nothing to stay ordered with
+            groups.setdefault(object() if item_key is None else item_key, []).append(item)
+        if len(groups) <= 1:
+            errors = [self._run_group(func, group) for group in groups.values()]
+        else:
+            futures = [self._executor.submit(self._run_group, func, group) for group in groups.values()]
+            errors = [future.result() for future in futures]
+        errors = [error for group_errors in errors for error in group_errors]
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['items'] += len(items)
+            self._stats['failed'] += len(errors)
+            self._stats['batch_size_max'] = max(self._stats['batch_size_max'], len(items))
+            self._stats['keys_max'] = max(self._stats['keys_max'], len(groups))
+            self._stats['run_time_total'] += time.monotonic() - started_at
+        if errors:
+            raise errors[0]
+
+    def _run_group(self, func, group):
+        # A failed item does not hold back the rest of that key's items
+        errors = []
+        for item in group:
+            try:
+                func(item)
+            except Exception as e:
+                logger.exception("batch item %s failed", getattr(func, '__name__', func))
+                errors.append(e)
+        return errors
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['run_time_avg'] = stats['run_time_total'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
@@ -0,0 +1,100 @@
+# keyword_matcher.py - One-pass multi-keyword matching (Aho-Corasick)
+
+from collections import deque
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over {category: [keywords]}.
+
+    The automaton is compiled into a dense DFA (fail links folded into the
+    transition tables), so matching is one dict lookup per character no
+    matter how many keywords there are.
+    """
+
+    def __init__(self, categories, lowercase=True):
+        self.lowercase = lowercase
+        self.categories = {name: list(words) for name, words in categories.items()}
+        self._build()
+
+    def _build(self):
+        goto = [{}]
+        outputs = [set()]
+        for category, words in self.categories.items():
+            for word in words:
+                if self.lowercase:
+                    word = word.lower()
+                state = 0
+                for ch in word:
+                    if ch not in goto[state]:
+                        goto.append({})
+                        outputs.append(set())
+                        goto[state][ch] = len(goto) - 1
+                    state = goto[state][ch]
+                outputs[state].add(category)
+
+        # Breadth-first: fold each state's fail transitions into its table
+        fail = [0] * len(goto)
+        delta = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            table = dict(delta[fail[state]])
+            for ch, child in goto[state].items():
+                fail[child] = delta[fail[state]].get(ch, 0)
+                outputs[child] |= outputs[fail[child]]
+                table[ch] = child
+                queue.append(child)
+            delta[state] = table
+
+        self._delta = delta
+        self._outputs = [frozenset(out) for out in outputs]
+        self.state_count = len(goto)
+
+    def match(self, text):
+        """Return the frozenset of categories with at least one keyword in text"""
+        if self.lowercase:
+            text = text.lower()
+        delta = self._delta
+        outputs = self._outputs
+        hits = set()
+        state = 0
+        for ch in text:
+            state = delta[state].get(ch, 0)
+            if outputs[state]:
+                hits |= outputs[state]
+        return frozenset(hits)
+
+
+# Every keyword vocabulary that used to be checked with separate `in` loops
+KEYWORD_CATEGORIES = {
+    # analyze_with_gemini: does the message look like a food log?
+    'food_log': ['吃', '喝', '早餐', '午餐', '晚餐', '宵夜', '點心', '飲料', 'ate', 'eaten', 'had', 'breakfast', 'lunch', 'dinner'],
+    # analyze_with_gemini: special-context prompt blocks
+    'ctx_youtiao': ['油條', '甜豆漿'],
+    'ctx_beef_noodle': ['牛肉麵'],
+    'ctx_exercise': ['運動', '走'],
+    'ctx_health': ['血壓', '藥'],
+    # check_food_for_mr_lin: trigger foods and good choices
+    'trigger_youtiao': ['油條'],
+    'trigger_fatty_pork': ['滷肉', '肥肉'],
+    'trigger_beef_noodle': ['牛肉麵'],
+    'trigger_pickled': ['醃', '泡菜'],
+    'good_choice': ['全麥', '水煮', '清蒸', '燙', '烤', '新鮮'],
+    # analyze_image_with_gemini: trigger foods named in the model's reply
+    'reply_trigger': ['油條', '滷肉', '牛肉麵', '醃'],
+    # get_daily_summary: trigger foods per logged meal
+    'meal_youtiao': ['油條'],
+    'meal_beef_noodle': ['牛肉麵'],
+    'meal_braised_pork': ['滷肉'],
+    # intents.classify_intent: questions about today's numbers, and activity/BP mentions
+    'intent_query': ['多少', '幾', '剩', '還能', '還可以', '超標', '超過', 'how much', 'how many'],
+    'intent_metric': ['鈉', '鹽', '熱量', '卡路里', '大卡', '蛋白質', '碳水', '脂肪', 'sodium', 'calorie'],
+    'intent_activity': ['運動', '走路', '散步', '跑步', '爬樓梯', '遛狗', '游泳', '騎車', '血壓', '收縮壓', '舒張壓']
+}
+
+MESSAGE_MATCHER = KeywordMatcher(KEYWORD_CATEGORIES)
+
+
+def match_keywords(text):
+    """Categories from KEYWORD_CATEGORIES found in text, in a single pass"""
+    return MESSAGE_MATCHER.match(text)
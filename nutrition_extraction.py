@@ -0,0 +1,246 @@
+# nutrition_extraction.py - Single-pass nutrition extraction from Gemini replies
+
+import json
+import re
+
+NUTRIENTS = ('calories', 'protein', 'carbs', 'fat', 'sodium')
+
+# Per-nutrient patterns in priority order - the first pattern that matches
+# anywhere wins, at its leftmost match. The value sits in the `v` group.
+_VALUE_PATTERNS = {
+    'calories': [
+        r'(?P<v>\d+)\s*(?:calories|kcal|cal|大卡|卡路里|熱量)',
+        r'(?:calories|熱量)[:\s]+(?P<v>\d+)'
+        # The old third pattern, (?:約|大約|大概|approximately)?\s*(\d+)\s*(?:kcal|大卡),
+        # can only match where the first one already does, so it is left out
+    ],
+    'protein': [
+        r'(?:protein|蛋白質)[:\s]+(?P<v>\d+\.?\d*)\s*(?:g|克|公克)',
+        r'(?P<v>\d+\.?\d*)\s*(?:g|克)\s*(?:protein|蛋白質)',
+        r'蛋白質\s*(?P<v>\d+\.?\d*)(?:g|克)?'
+    ],
+    'carbs': [
+        r'(?:carb|碳水化合物|醣類)[:\s]+(?P<v>\d+\.?\d*)\s*(?:g|克|公克)',
+        r'(?P<v>\d+\.?\d*)\s*(?:g|克)\s*(?:carb|碳水)',
+        r'碳水\s*(?P<v>\d+\.?\d*)(?:g|克)?'
+    ],
+    'fat': [
+        r'(?:fat|脂肪)[:\s]+(?P<v>\d+\.?\d*)\s*(?:g|克|公克)',
+        r'(?P<v>\d+\.?\d*)\s*(?:g|克)\s*(?:fat|脂肪)',
+        r'脂肪\s*(?P<v>\d+\.?\d*)(?:g|克)?'
+    ],
+    'sodium': [
+        r'(?:sodium|鈉)[:\s]+(?P<v>\d+)\s*(?:mg|毫克)',
+        r'(?P<v>\d+)\s*(?:mg|毫克)\s*(?:sodium|的鈉|鈉)',
+        r'鈉\s*(?P<v>\d+)\s*(?:mg|毫克)?',
+        r'\d+-(?P<v>\d+)\s*(?:mg|毫克)\s*(?:的)?鈉'  # For ranges, take the higher value
+    ]
+}
+
+# Value patterns that start at a number, keyed by what must follow it
+_NUMBER_FIRST = {
+    ('calories', 0): 'energy',
+    ('protein', 1): 'mass',
+    ('carbs', 1): 'mass',
+    ('fat', 1): 'mass',
+    ('sodium', 1): 'sodium',
+    ('sodium', 3): 'dash'
+}
+
+_UNIT_CLASSES = {
+    'mass': 'g克',
+    'sodium': 'm毫',
+    'energy': 'ck大卡熱',
+    'dash': '-',
+    'range': '~～到至'
+}
+
+# Ranges ("300-400大卡", "鈉：800~1000毫克") for every nutrient. Number-first
+# ranges share one pattern whose unit group names the nutrient.
+_NUM = r'\d+(?:\.\d+)?'
+_SEP = r'\s*(?:-|~|～|到|至)\s*'
+_RANGE_UNITS = {
+    'calories': r'(?:calories|kcal|cal|大卡|卡路里)',
+    'protein': r'(?:g|克|公克)\s*(?:的)?(?:protein|蛋白質)',
+    'carbs': r'(?:g|克|公克)\s*(?:的)?(?:carb|碳水)',
+    'fat': r'(?:g|克|公克)\s*(?:的)?(?:fat|脂肪)',
+    'sodium': r'(?:mg|毫克)\s*(?:的)?(?:sodium|鈉)'
+}
+_RANGE_KEYWORDS = {
+    'calories': r'(?:calories|熱量)',
+    'protein': r'(?:protein|蛋白質)',
+    'carbs': r'(?:carb|碳水化合物|碳水|醣類)',
+    'fat': r'(?:fat|脂肪)',
+    'sodium': r'(?:sodium|鈉)'
+}
+_RANGE_NUMBER_FIRST = re.compile(
+    rf'(?P<lo>{_NUM}){_SEP}(?P<hi>{_NUM})\s*(?:'
+    + '|'.join(f'(?P<{nutrient}>{unit})' for nutrient, unit in _RANGE_UNITS.items())
+    + ')'
+)
+_RANGE_KEYWORD_FIRST = {
+    nutrient: re.compile(
+        rf'{keyword}[:：\s]*(?:約|大約|大概|approximately)?\s*(?P<lo>{_NUM}){_SEP}(?P<hi>{_NUM})'
+    )
+    for nutrient, keyword in _RANGE_KEYWORDS.items()
+}
+
+# One scanner finds every place a pattern could start: a number followed by
+# one of the unit characters above, or a nutrient keyword. The leading
+# character class lets the regex engine skip everything else quickly.
+_SCANNER = re.compile(
+    r'(?=[\dcpfs熱蛋碳醣脂鈉])(?:'
+    r'\d+(?=(?:\.\d*)?\s*(?P<unit>[' + re.escape(''.join(_UNIT_CLASSES.values())) + r']))'
+    r'|(?P<calories>calories|熱量)'
+    r'|(?P<protein>protein|蛋白質)'
+    r'|(?P<carbs>carb|碳水|醣類)'
+    r'|(?P<fat>fat|脂肪)'
+    r'|(?P<sodium>sodium|鈉)'
+    r')'
+)
+
+
+def _build_dispatch():
+    """Precompile every pattern and index it by the anchor it can start at"""
+    by_anchor = {}
+    for nutrient, pattern_list in _VALUE_PATTERNS.items():
+        for priority, pattern in enumerate(pattern_list):
+            anchor = _NUMBER_FIRST.get((nutrient, priority), nutrient)
+            by_anchor.setdefault(anchor, []).append((nutrient, priority, re.compile(pattern)))
+    for nutrient, pattern in _RANGE_KEYWORD_FIRST.items():
+        by_anchor[nutrient].append((nutrient, None, pattern))
+    for anchor in ('dash', 'range'):
+        by_anchor.setdefault(anchor, []).append((None, None, _RANGE_NUMBER_FIRST))
+
+    # Anchors are looked up by keyword group name or by the unit character
+    dispatch = {nutrient: tuple(by_anchor[nutrient]) for nutrient in NUTRIENTS}
+    for unit_class, chars in _UNIT_CLASSES.items():
+        for char in chars:
+            dispatch[char] = tuple(by_anchor[unit_class])
+    return dispatch
+
+
+_DISPATCH = _build_dispatch()
+
+
+def extract_nutrition(text):
+    """Scan once and return (values, ranges).
+
+    `values` matches extract_nutrition_values: per nutrient the first pattern
+    (in priority order) that matches anywhere wins, at its leftmost match.
+    `ranges` maps a nutrient to (low, high) for the first range reported for
+    it. Patterns are only tried at the anchors the scanner reports, and never
+    once a higher-priority pattern has already won that nutrient.
+    """
+    text = text.lower()
+    best = {}    # nutrient -> (priority, value)
+    ranges = {}  # nutrient -> (low, high)
+
+    for anchor in _SCANNER.finditer(text):
+        key = anchor.lastgroup
+        if key == 'unit':
+            key = anchor.group('unit')
+        pos = anchor.start()
+        for nutrient, priority, pattern in _DISPATCH[key]:
+            if priority is None:
+                # Range pattern
+                if nutrient in ranges:
+                    continue
+                match = pattern.match(text, pos)
+                if match:
+                    ranges.setdefault(nutrient or match.lastgroup,
+                                      (float(match.group('lo')), float(match.group('hi'))))
+                continue
+            current = best.get(nutrient)
+            if current is not None and current[0] <= priority:
+                continue
+            match = pattern.match(text, pos)
+            if match:
+                best[nutrient] = (priority, float(match.group('v')))
+
+    values = {nutrient: 0 for nutrient in NUTRIENTS}
+    for nutrient, (_, value) in best.items():
+        values[nutrient] = value
+    return values, ranges
+
+
+def extract_nutrition_values(text):
+    """Extract nutrition values - works with both English and Chinese"""
+    return extract_nutrition(text)[0]
+
+
+# Structured output: Gemini returns the friendly reply plus per-item nutrition
+MEAL_RESPONSE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'reply': {'type': 'STRING', 'description': '給林先生的回覆，朋友的語氣'},
+        'items': {
+            'type': 'ARRAY',
+            'description': '訊息或照片中的每一樣食物；沒有提到食物就給空陣列',
+            'items': {
+                'type': 'OBJECT',
+                'properties': {
+                    'name': {'type': 'STRING', 'description': '台灣常用的食物名稱'},
+                    'calories': {'type': 'NUMBER', 'description': '大卡'},
+                    'protein': {'type': 'NUMBER', 'description': '克'},
+                    'carbs': {'type': 'NUMBER', 'description': '克'},
+                    'fat': {'type': 'NUMBER', 'description': '克'},
+                    'sodium': {'type': 'NUMBER', 'description': '毫克'}
+                },
+                'required': ['name', 'calories', 'protein', 'carbs', 'fat', 'sodium']
+            }
+        }
+    },
+    'required': ['reply', 'items']
+}
+
+
+# The reply string of a structured answer, even when the JSON around it is
+# malformed or cut off (the closing quote may be missing)
+_REPLY_FIELD = re.compile(r'"reply"\s*:\s*"((?:[^"\\]|\\.)*)', re.S)
+
+
+def extract_reply_field(text):
+    """The 'reply' text of an unparseable structured answer, or None if there is none"""
+    match = _REPLY_FIELD.search(text or '')
+    if match is None:
+        return None
+    raw = match.group(1)
+    if raw.endswith('\\') and not raw.endswith('\\\\'):
+        raw = raw[:-1]  # Cut off in the middle of an escape
+    try:
+        reply = json.loads(f'"{raw}"')
+    except ValueError:
+        return None
+    return reply.strip() or None
+
+
+def parse_structured_response(text):
+    """Parse a MEAL_RESPONSE_SCHEMA reply into (reply, totals, items).
+
+    Returns None when the text is not usable JSON so callers can fall back
+    to regex extraction on the raw text.
+    """
+    try:
+        data = json.loads(text)
+        reply = data['reply']
+        raw_items = data.get('items') or []
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(reply, str) or not isinstance(raw_items, list):
+        return None
+
+    items = []
+    totals = {nutrient: 0 for nutrient in NUTRIENTS}
+    for raw in raw_items:
+        if not isinstance(raw, dict) or not raw.get('name'):
+            continue
+        item = {'name': str(raw['name'])}
+        for nutrient in NUTRIENTS:
+            try:
+                item[nutrient] = max(float(raw.get(nutrient) or 0), 0.0)
+            except (TypeError, ValueError):
+                item[nutrient] = 0.0
+            totals[nutrient] += item[nutrient]
+        items.append(item)
+    return reply, totals, items
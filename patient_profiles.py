@@ -1,5 +1,7 @@
 # patient_profiles.py - Enhanced with meal plan and BP tracking functions
 
+from keyword_matcher import match_keywords
+
 MR_LIN_PROFILE = {
     'condition': 'Hypertension',
     'patient_info': {
@@ -165,9 +167,9 @@ def get_weekly_meal_plan():
     
     return meal_plan_text
 
-def get_bp_log_format(user_id, bp_records):
+def get_bp_log_format(user_id, bp_log):
     """Format blood pressure log for display"""
-    if not bp_records:
+    if not bp_log or not bp_log['recent']:
         return """📊 血壓記錄
 
 您還沒有血壓記錄哦！
@@ -185,10 +187,8 @@ def get_bp_log_format(user_id, bp_records):
 
 """
     
-    for record in bp_records[-7:]:  # Show last 7 records
-        bp_value = record['value']
-        date_time = record['datetime']
-        systolic = int(bp_value.split('/')[0])
+    for record in bp_log['recent']:  # Last 7 readings
+        systolic = record['systolic']
         
         # Add emoji based on BP level
         if systolic >= 140:
@@ -201,8 +201,19 @@ def get_bp_log_format(user_id, bp_records):
             emoji = "🟢"
             status = "正常"
         
-        log_text += f"{emoji} {date_time}\n"
-        log_text += f"   {bp_value} mmHg ({status})\n\n"
+        log_text += f"{emoji} {record['datetime']}\n"
+        log_text += f"   {record['value']} mmHg ({status})\n\n"
+    
+    trends = bp_log['trends']
+    log_text += "📈 血壓趨勢\n"
+    log_text += f"• 近7天平均：{trends['systolic_7d']:.0f}/{trends['diastolic_7d']:.0f}（{trends['count_7d']}次）\n" if trends['count_7d'] else "• 近7天沒有記錄\n"
+    if trends['count_30d']:
+        log_text += f"• 近30天平均：{trends['systolic_30d']:.0f}/{trends['diastolic_30d']:.0f}（{trends['count_30d']}次）\n"
+        if trends['morning_count_30d'] and trends['evening_count_30d']:
+            log_text += (f"• 早上 {trends['morning_systolic_30d']:.0f}/{trends['morning_diastolic_30d']:.0f}、"
+                         f"晚上 {trends['evening_systolic_30d']:.0f}/{trends['evening_diastolic_30d']:.0f}\n")
+        log_text += f"• 近30天達標率：{trends['at_target_30d']:.0f}%\n"
+    log_text += "\n"
     
     log_text += """━━━━━━━━━━━━━━━
 目標：<130/80
@@ -256,7 +267,7 @@ def get_hypertension_context():
     """Wrapper for compatibility"""
     return get_mr_lin_context()
 
-def check_food_for_mr_lin(food_item, nutrition_data):
+def check_food_for_mr_lin(food_item, nutrition_data, hits=None):
     """Analyze if food is appropriate for Mr. Lin specifically"""
     warnings = []
     suggestions = []
@@ -269,31 +280,29 @@ def check_food_for_mr_lin(food_item, nutrition_data):
     elif sodium > 400:
         warnings.append(f"📊 鈉含量中等：{sodium}毫克，其他餐要清淡一點")
     
-    # Check for Mr. Lin's specific trigger foods
-    food_lower = food_item.lower()
+    # Check for Mr. Lin's specific trigger foods (one keyword pass, reusable)
+    if hits is None:
+        hits = match_keywords(food_item)
     
-    if '油條' in food_item:
+    if 'trigger_youtiao' in hits:
         warnings.append("😅 林先生！您又吃油條了...記得要改全麥吐司嗎？")
         suggestions.append("明天請林太太幫您準備全麥吐司+水煮蛋")
     
-    if '滷肉' in food_item or '肥肉' in food_item:
+    if 'trigger_fatty_pork' in hits:
         warnings.append("這個油脂太高了！您的LDL已經160了")
         suggestions.append("試試清蒸雞胸肉或豆腐，一樣好吃")
     
-    if '牛肉麵' in food_item:
+    if 'trigger_beef_noodle' in hits:
         warnings.append("牛肉麵可以，但湯千萬別喝！一碗湯就超標了")
         suggestions.append("點乾麵，或是湯另外裝，意思意思喝兩口就好")
     
-    if '醃' in food_item or '泡菜' in food_item:
+    if 'trigger_pickled' in hits:
         warnings.append("醃漬品鈉含量超高！要少吃")
         suggestions.append("改吃新鮮蔬菜，用蒜爆香一樣美味")
     
     # Positive reinforcement for good choices
-    good_keywords = ['全麥', '水煮', '清蒸', '燙', '烤', '新鮮']
-    for keyword in good_keywords:
-        if keyword in food_item:
-            suggestions.append("👍 很好的選擇！這樣吃對血壓有幫助")
-            break
+    if 'good_choice' in hits:
+        suggestions.append("👍 很好的選擇！這樣吃對血壓有幫助")
     
     return warnings, suggestions
 
@@ -0,0 +1,115 @@
+# photo_index.py - Per-user perceptual-hash index for near-duplicate food photos
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+try:
+    from PIL import Image
+except ImportError:  # dhash() is only called on images Pillow decoded
+    Image = None
+
+from storage import local_day
+
+# Hamming distance (out of 64 bits) at or below which two photos count as the
+# same plate; -1 turns near-duplicate detection off. 10 catches re-encodes,
+# resizes, exposure changes and crops of about 3%; a re-shot framed 5% or more
+# differently (13+ on screenshots/photo.png) is missed and logged again, and
+# unrelated photos start near 18 (see tests/test_photo_index.py)
+PHOTO_DUP_THRESHOLD = int(os.getenv('PHOTO_DUP_THRESHOLD', '10'))
+# Only photos this recent (and from today) are compared against
+PHOTO_DUP_WINDOW = int(os.getenv('PHOTO_DUP_WINDOW', str(30 * 60)))
+PHOTO_DUP_PER_USER = int(os.getenv('PHOTO_DUP_PER_USER', '20'))
+PHOTO_DUP_MAX_USERS = int(os.getenv('PHOTO_DUP_MAX_USERS', '50000'))
+
+
+def dhash(image, size=8):
+    """64-bit difference hash of a PIL image: brighter-than-right-neighbour bits.
+
+    Survives re-encoding, resizing and small crops, so two shots of the same
+    plate land a few bits apart while different meals differ by ~half.
+    """
+    # Area-average down first, then grey: converting the full frame costs twice as much
+    small = image.resize((size + 1, size), Image.BOX).convert('L')
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class NearDuplicateIndex:
+    """Last few photo hashes per user, searched by Hamming distance.
+
+    Each user keeps at most per_user (time, day, hash, analysis) entries, so
+    a lookup is a handful of XOR + popcounts however many users there are,
+    short enough to run under a single lock. Users are kept in LRU order
+    and the least recently active are dropped past max_users.
+
+    The index is per process, even with STATE_BACKEND=server: a re-shot
+    that lands on another worker is analysed and logged again (exact
+    copies are still caught by the shared LoggedPhotos marks), and forget()
+    only clears this worker's entries.
+    """
+
+    def __init__(self, threshold=PHOTO_DUP_THRESHOLD, window=PHOTO_DUP_WINDOW,
+                 per_user=PHOTO_DUP_PER_USER, max_users=PHOTO_DUP_MAX_USERS):
+        self.threshold = threshold
+        self.window = window
+        self.per_user = per_user
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._users = OrderedDict()  # user_id -> deque of (time, day, hash, analysis)
+        self._stats = {'lookups': 0, 'hits': 0, 'added': 0, 'users_evicted': 0, 'forgotten': 0}
+
+    def find(self, user_id, photo_hash, now=None):
+        """(distance, analysis) of the closest recent photo within threshold, else None"""
+        now = time.monotonic() if now is None else now
+        today = local_day()
+        best = None
+        with self._lock:
+            self._stats['lookups'] += 1
+            entries = self._users.get(user_id)
+            if entries:
+                cutoff = now - self.window
+                for seen_at, day, other, analysis in entries:
+                    if seen_at < cutoff or day != today:
+                        continue
+                    distance = (photo_hash ^ other).bit_count()
+                    if distance <= self.threshold and (best is None or distance < best[0]):
+                        best = (distance, analysis)
+            if best is not None:
+                self._stats['hits'] += 1
+        return best
+
+    def add(self, user_id, photo_hash, analysis, now=None):
+        now = time.monotonic() if now is None else now
+        today = local_day()
+        with self._lock:
+            entries = self._users.get(user_id)
+            if entries is None:
+                entries = self._users[user_id] = deque(maxlen=self.per_user)
+            else:
+                self._users.move_to_end(user_id)
+            entries.append((now, today, photo_hash, analysis))
+            self._stats['added'] += 1
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+                self._stats['users_evicted'] += 1
+
+    def forget(self, user_id):
+        """Drop the user's photos, e.g. when they clear their day"""
+        with self._lock:
+            if self._users.pop(user_id, None) is not None:
+                self._stats['forgotten'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._users)
+        stats['threshold'] = self.threshold
+        stats['window'] = self.window
+        return stats
@@ -0,0 +1,246 @@
+# prompts.py - Static per-profile prompt prefixes, dynamic suffixes and token accounting
+
+import logging
+import os
+import threading
+import time
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+# 'local'  - send the static prefix as the system instruction (default). This
+#            only saves rebuilding the prompt: the prefix is still billed as
+#            input tokens on every call
+# 'gemini' - register the prefix with Gemini context caching (cached tokens
+#            are billed at the reduced rate), falling back to local while the
+#            cache is being created or after it failed. Gemini rejects
+#            prefixes below its minimum cacheable size, which today's
+#            profile prefixes are, so this only pays off for larger prompts
+# 'off'    - concatenate prefix and suffix into one prompt like before
+PROMPT_CACHE_MODE = os.getenv('PROMPT_CACHE_MODE', 'local')
+PROMPT_CACHE_TTL = int(os.getenv('PROMPT_CACHE_TTL', '3600'))
+# A failed cache creation is retried after this many seconds, doubling per
+# consecutive failure up to the max
+PROMPT_CACHE_RETRY_BASE = float(os.getenv('PROMPT_CACHE_RETRY_BASE', '30'))
+PROMPT_CACHE_RETRY_MAX = float(os.getenv('PROMPT_CACHE_RETRY_MAX', '3600'))
+
+# Static parts of Mr. Lin's prompts - built once, shared by every call
+TEXT_PREFIXES = {
+    'mr_lin': """你是林先生的個人營養追蹤助手。以下是他的完整背景：
+
+**諮詢背景（從營養師轉介）：**
+- 林先生，55歲，BMI 27，高血壓（145/92）
+- 每天服用 Amlodipine 5mg
+- 爸爸60多歲中風（他最大的恐懼）
+- 原本飲食：油條甜豆漿、滷肉飯、牛肉麵（喝湯）、洋芋片、珍奶
+- 原本鈉攝取：約4000毫克/天（超標快3倍！）
+- 久坐上班，只有週末跟林太太散步
+- LDL膽固醇160，血糖也偏高
+
+**營養師計畫（他已同意）：**
+- 早餐：全麥吐司+水煮蛋+無糖豆漿（取代油條）
+- 午餐：清蒸雞肉/豆腐（取代滷肉）
+- 晚餐：乾麵或不喝湯（取代整碗湯）
+- 點心：水果、無鹽堅果（取代洋芋片）
+- 每天走路30分鐘，5次/週（可以遛狗時進行）
+- 鈉限制：1500毫克/天
+- 熱量目標：2000大卡/天
+- 林太太會協助準備健康餐點
+
+重要回應原則：
+1. 你完全了解林先生的病史和諮詢內容
+2. 如果他吃了不該吃的（如油條），溫和但堅定地提醒
+3. 適時提到他爸爸中風的事（這是他的主要動力）
+4. 多提到林太太的支持和幫助
+5. 建議要具體可行（用大蒜、醋調味等）
+6. 用台灣人說話方式，親切但關心的語氣
+7. 記得他「不想吃太多藥」的心願
+
+回應風格：
+- 像個關心他的朋友，不是機器人
+- 用「林先生」稱呼，表示尊重
+- 適當使用 😊 💪 👍 等表情
+- 語氣：關切但不說教，鼓勵但要實際
+"""
+}
+
+IMAGE_PREFIXES = {
+    'mr_lin': """你是林先生的營養追蹤助手，正在分析他傳來的食物照片。
+
+林先生背景：
+- 55歲，高血壓（145/92），BMI 27
+- 原本愛吃：油條、滷肉飯、牛肉麵湯
+- 目標：鈉<1500mg/天，熱量2000大卡
+- 怕像爸爸一樣中風
+
+分析這張照片時：
+1. 用台灣人熟悉的食物名稱描述
+2. 估算營養成分（特別注意鈉含量）
+3. 如果是他的「地雷食物」（油條、滷肉、醃菜等），要提醒
+4. 給出具體建議（不是說教）
+5. 如果是健康選擇，要大力稱讚
+6. 適時提到林太太可以幫忙準備更健康的版本
+
+回應要像朋友，不要像營養報告。"""
+}
+
+# Special context for specific situations (dynamic, only when triggered)
+CONTEXT_BLOCKS = {
+    'youtiao': """
+特別處理：他又吃油條了！
+- 溫和提醒全麥吐司的約定
+- 提到油脂對LDL的影響（已經160了）
+- 請林太太幫忙準備早餐
+""",
+    'beef_noodle': """
+特別處理：確認他有沒有喝湯！
+- 如果喝湯，嚴肅提醒（一碗湯=一天的鈉）
+- 建議乾麵或湯另裝
+- 提醒他爸爸的事
+""",
+    'exercise': """
+特別處理：運動追蹤
+- 鼓勵他遛狗時多走15分鐘
+- 提醒林太太可以陪他
+- 讚美任何運動努力
+""",
+    'health': """
+特別處理：健康監測
+- 提醒按時吃 Amlodipine 5mg
+- 詢問今天血壓多少
+- 強調飲食控制能減少用藥
+"""
+}
+
+
+def build_text_suffix(user_message, current_sodium, current_calories, msg_count, triggers):
+    """Per-request part of the text prompt: today's status, message and contexts"""
+    suffix = f"""**今日狀況：**
+- 已攝取鈉：{current_sodium:.0f}毫克（限制1500）
+- 已攝取熱量：{current_calories:.0f}大卡（目標2000）
+- 第{msg_count}次對話
+
+使用者訊息："{user_message}"
+"""
+    for name in triggers:
+        suffix += CONTEXT_BLOCKS[name]
+    return suffix
+
+
+def build_image_suffix(current_sodium, current_calories):
+    """Per-request part of the photo prompt"""
+    return f"今天已吃：鈉{current_sodium}mg，熱量{current_calories}大卡"
+
+
+class PromptPrefixCache:
+    """Turns (static prefix, dynamic contents) into a generate_content request"""
+
+    def __init__(self, mode=PROMPT_CACHE_MODE, ttl=PROMPT_CACHE_TTL,
+                 retry_base=PROMPT_CACHE_RETRY_BASE, retry_max=PROMPT_CACHE_RETRY_MAX):
+        self.mode = mode
+        self.ttl = ttl
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._registered = {}  # (model, key) -> (cached content name, expires_at)
+        self._failures = {}  # (model, key) -> (consecutive failures, retry_at)
+        self._creating = set()  # (model, key) whose cache one thread is creating right now
+        self._lock = threading.Lock()
+
+    def prepare(self, client, model, key, prefix, contents, **config_kwargs):
+        """Return (contents, config) for client.models.generate_content"""
+        contents = list(contents)
+        if self.mode == 'off':
+            contents[0] = prefix + "\n" + contents[0]
+            return contents, types.GenerateContentConfig(**config_kwargs) if config_kwargs else None
+
+        if self.mode == 'gemini':
+            name = self._cached_content(client, model, key, prefix)
+            if name:
+                return contents, types.GenerateContentConfig(cached_content=name, **config_kwargs)
+
+        # Local stand-in: the prefix string is built once and sent as the system instruction
+        return contents, types.GenerateContentConfig(system_instruction=prefix, **config_kwargs)
+
+    def _cached_content(self, client, model, key, prefix):
+        """Name of a live Gemini cached content for this prefix, creating it if needed"""
+        cache_key = (model, key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._registered.get(cache_key)
+            if entry and entry[1] > now:
+                return entry[0]
+            failure = self._failures.get(cache_key)
+            if failure and failure[1] > now:
+                return None
+            if cache_key in self._creating:
+                # Single flight: another request is creating it - go local meanwhile
+                return None
+            self._creating.add(cache_key)
+        # The RPC runs outside the lock so other prefixes aren't held up
+        try:
+            cached = client.caches.create(
+                model=model,
+                contents=[],
+                config=types.CreateCachedContentConfig(
+                    system_instruction=prefix,
+                    ttl=f"{self.ttl}s",
+                    display_name=f"nutriline-{key}"
+                )
+            )
+        except Exception as e:
+            # Prefix too short for context caching, caching unavailable, or a
+            # transient error - back off and try again later
+            with self._lock:
+                self._creating.discard(cache_key)
+                failures = self._failures.get(cache_key, (0, 0.0))[0] + 1
+                delay = min(self.retry_max, self.retry_base * 2 ** (failures - 1))
+                self._failures[cache_key] = (failures, time.monotonic() + delay)
+            logger.warning("context caching unavailable for %s (retry in %.0fs): %r", key, delay, e)
+            return None
+        with self._lock:
+            self._creating.discard(cache_key)
+            self._failures.pop(cache_key, None)
+            # Refresh a minute early so requests never hit an expired cache
+            self._registered[cache_key] = (cached.name, now + self.ttl - 60)
+        return cached.name
+
+
+class TokenUsage:
+    """Per-call prompt/output token accounting, split by call kind and context block"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_kind = {}
+        self._by_block = {}
+
+    def record(self, kind, response, blocks=()):
+        usage = getattr(response, 'usage_metadata', None)
+        prompt_tokens = getattr(usage, 'prompt_token_count', None) or 0
+        output_tokens = getattr(usage, 'candidates_token_count', None) or 0
+        cached_tokens = getattr(usage, 'cached_content_token_count', None) or 0
+        with self._lock:
+            totals = self._by_kind.setdefault(kind, {
+                'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0
+            })
+            totals['calls'] += 1
+            totals['prompt_tokens'] += prompt_tokens
+            totals['output_tokens'] += output_tokens
+            totals['cached_tokens'] += cached_tokens
+            for block in blocks:
+                block_totals = self._by_block.setdefault(block, {'calls': 0, 'prompt_tokens': 0})
+                block_totals['calls'] += 1
+                block_totals['prompt_tokens'] += prompt_tokens
+        return prompt_tokens, output_tokens
+
+    def stats(self):
+        with self._lock:
+            by_kind = {kind: dict(totals) for kind, totals in self._by_kind.items()}
+            by_block = {block: dict(totals) for block, totals in self._by_block.items()}
+        for totals in list(by_kind.values()) + list(by_block.values()):
+            totals['avg_prompt_tokens'] = totals['prompt_tokens'] / totals['calls']
+        return {
+            'by_kind': by_kind,
+            # Average prompt size of calls that included each special-context block
+            'by_context_block': by_block,
+            'context_block_chars': {name: len(text) for name, text in CONTEXT_BLOCKS.items()}
+        }
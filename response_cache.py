@@ -0,0 +1,137 @@
+# response_cache.py - Bounded LRU/TTL cache for Gemini analysis results
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from storage import local_day
+
+# Users whose already-logged photo marks are kept; the least recently active go first
+LOGGED_PHOTOS_MAX_USERS = int(os.getenv('LOGGED_PHOTOS_MAX_USERS', '50000'))
+# Lifetime of a mark in the shared store; the key carries the day, this only frees memory
+LOGGED_PHOTOS_TTL = 36 * 3600
+
+
+class ResponseCache:
+    """LRU cache with per-entry TTL and a total size bound in bytes"""
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, ttl=24 * 3600, name='cache'):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.name = name
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'stores': 0}
+
+    def get(self, key):
+        """Return the cached value or None, refreshing its LRU position"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if entry[0] <= now:
+                self._drop(key)
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[2]
+
+    def set(self, key, value, size):
+        """Store a value accounted as `size` bytes; oversized values are skipped"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            self._stats['stores'] += 1
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self._stats['evicted'] += 1
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Hit/miss counters plus current size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['max_bytes'] = self.max_bytes
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def text_size(*parts):
+    """Approximate cached footprint of some strings plus a fixed overhead"""
+    return 200 + sum(len(part.encode('utf-8')) for part in parts if part)
+
+
+class LoggedPhotos:
+    """Content hashes of the exact photos each user has logged today.
+
+    Marks are per (user, local day): a photo sent again on another day is a
+    new meal, and forget() drops a user's marks when they clear their day.
+    A photo is marked before it is analysed, so a second copy arriving
+    while the first is still with Gemini is not logged as well.
+
+    The marks are per process unless `shared` is set to the shared
+    StateStore (STATE_BACKEND=server), which then holds them for every
+    worker as claims.
+    """
+
+    def __init__(self, max_users=LOGGED_PHOTOS_MAX_USERS, shared=None):
+        self.max_users = max_users
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._users = OrderedDict()  # user_id -> (day, set of photo keys)
+
+    def mark(self, user_id, photo_key):
+        """Record the photo as logged today; True if it already was"""
+        today = local_day()
+        if self.shared is not None:
+            return not self.shared.claim('photo', user_id, f"{today}:{photo_key}", LOGGED_PHOTOS_TTL)
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or entry[0] != today:
+                entry = self._users[user_id] = (today, set())
+            else:
+                self._users.move_to_end(user_id)
+            seen = photo_key in entry[1]
+            entry[1].add(photo_key)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+            return seen
+
+    def unmark(self, user_id, photo_key):
+        """Give back a mark whose meal never got logged (the analysis failed)"""
+        if self.shared is not None:
+            self.shared.release('photo', user_id, f"{local_day()}:{photo_key}")
+            return
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                entry[1].discard(photo_key)
+
+    def forget(self, user_id):
+        if self.shared is not None:
+            self.shared.release('photo', user_id)
+            return
+        with self._lock:
+            self._users.pop(user_id, None)
@@ -0,0 +1,363 @@
+# shared_state.py - Per-user state operations shared by every worker process
+
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+
+from storage import open_storage, local_day, DailyIntake, BPSeries
+from user_locks import ShardedLocks
+
+# 'local'  - state lives in this process (single worker, the old behaviour)
+# 'server' - every worker talks to one state server on this box, started on
+#            demand by the first worker (or run it yourself: python shared_state.py)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'local')
+STATE_SERVER_ADDRESS = os.getenv('STATE_SERVER_ADDRESS', '127.0.0.1:50731')
+# Shared secret for the state server, required with STATE_BACKEND=server. The
+# manager speaks pickle, so anyone who can reach the port with the key can run
+# code in the server - there is deliberately no default
+STATE_SERVER_AUTHKEY = os.getenv('STATE_SERVER_AUTHKEY', '').encode()
+STATE_SERVER_AUTOSTART = os.getenv('STATE_SERVER_AUTOSTART', 'true').lower() == 'true'
+
+
+# Users idle this long leave the in-memory hot tier (their data stays stored)
+USER_IDLE_TTL = int(os.getenv('USER_IDLE_TTL', str(6 * 3600)))
+EVICTION_SWEEP_INTERVAL = int(os.getenv('EVICTION_SWEEP_INTERVAL', '60'))
+
+logger = logging.getLogger(__name__)
+
+
+def _public(table, value):
+    """Detached, caller-facing copy of a stored value"""
+    if table == 'daily_intake':
+        return value.to_dict()
+    if table == 'bp_records':
+        return {'recent': value.recent(), 'trends': value.trends()}
+    if table in ('medication_taken', 'exercise_log'):
+        day, day_value = value
+        return {day: day_value}
+    return value
+
+
+class StateStore:
+    """Atomic read-modify-write operations on per-user state.
+
+    Callers never get a live reference: reads return copies and every change
+    is a single operation (increment, append, set), so the same interface
+    works in-process and through the state server. Each operation holds the
+    user's lock shard, so one user's updates are serialized without making
+    other users wait.
+
+    Intake is partitioned by local day: the first access after midnight
+    compacts the previous day into daily_totals and opens a fresh one.
+    Users idle for USER_IDLE_TTL are evicted from memory and reloaded from
+    storage on their next message.
+
+    claim()/release() are the once-only marks every worker has to agree on
+    (handled webhook events, logged photos); they live in memory only.
+    """
+
+    def __init__(self, storage, idle_ttl=USER_IDLE_TTL, sweep_interval=EVICTION_SWEEP_INTERVAL):
+        self.storage = storage
+        self.locks = ShardedLocks()
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._last_seen = {}  # user_id -> monotonic time of last operation
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._sweep_lock = threading.Lock()
+        self._claims = {}  # (namespace, owner) -> OrderedDict of key -> expires_at, oldest first
+        self._claims_lock = threading.Lock()
+
+    def _map(self, table):
+        return self.storage.map(table)
+
+    @contextmanager
+    def _hold(self, user_id, op):
+        with self.locks.hold(user_id, op):
+            self._last_seen[user_id] = time.monotonic()
+            yield
+        if time.monotonic() >= self._next_sweep:
+            self.evict_idle()
+
+    def _intake(self, user_id):
+        """Today's intake (or None), rolling a previous day over first.
+
+        Call with the user's lock held.
+        """
+        user_map = self._map('daily_intake')
+        intake = user_map.get(user_id)
+        if intake is None:
+            return None
+        today = local_day()
+        if intake.day != today:
+            self.storage.record('daily_totals', user_id, intake.compact())
+            self.locks.count(user_id, 'rollover')
+            intake = user_map[user_id] = DailyIntake(today)
+        return intake
+
+    def _value(self, table, user_id):
+        if table == 'daily_intake':
+            return self._intake(user_id)
+        return self._map(table).get(user_id)
+
+    def get(self, table, user_id, default=None):
+        """Copy of the user's value, or default"""
+        with self._hold(user_id, 'get'):
+            value = self._value(table, user_id)
+            return default if value is None else _public(table, value)
+
+    def set(self, table, user_id, value):
+        with self._hold(user_id, 'set'):
+            self._map(table)[user_id] = value
+
+    def intake_revision(self, user_id):
+        """Revision of today's intake (None if there is none) - cheap change check"""
+        with self._hold(user_id, 'intake_revision'):
+            intake = self._intake(user_id)
+            return None if intake is None else intake.revision
+
+    def clear_intake(self, user_id):
+        """Start today's intake over (the /clear command)"""
+        with self._hold(user_id, 'clear_intake'):
+            # Roll an old day over first so it is compacted, not overwritten
+            self._intake(user_id)
+            self._map('daily_intake')[user_id] = DailyIntake()
+
+    def set_if_absent(self, table, user_id, value):
+        """Store value unless the user already has one; True if it was stored"""
+        with self._hold(user_id, 'set_if_absent'):
+            if self._value(table, user_id) is not None:
+                return False
+            self._map(table)[user_id] = value
+            return True
+
+    def set_day_value(self, table, user_id, day, value):
+        """Set the user's value for a day in a per-day table (medication, exercise)"""
+        with self._hold(user_id, 'set_day_value'):
+            user_map = self._map(table)
+            current = user_map.get(user_id)
+            if current is not None and current[0] != day:
+                # Memory keeps only the latest day - make sure the old one is written
+                self.storage.record(table, user_id, current)
+            user_map[user_id] = (day, value)
+
+    def incr(self, table, user_id, amount=1):
+        """Add to a numeric value and return the new total"""
+        with self._hold(user_id, 'incr'):
+            user_map = self._map(table)
+            total = user_map.get(user_id, 0) + amount
+            user_map[user_id] = total
+            return total
+
+    def add_bp_reading(self, user_id, systolic, diastolic, recorded_at=None):
+        """Append a parsed reading to the user's full history; returns its trends"""
+        recorded_at = int(time.time() if recorded_at is None else recorded_at)
+        with self._hold(user_id, 'add_bp_reading'):
+            user_map = self._map('bp_records')
+            series = user_map.get(user_id)
+            if series is None:
+                series = BPSeries()
+                user_map.cache(user_id, series)
+            recorded_at, rollups = series.append(recorded_at, systolic, diastolic)
+            # Append-only rows: the series itself is never rewritten
+            self.storage.record('bp_readings', user_id, (recorded_at, systolic, diastolic))
+            for row in rollups:
+                self.storage.record('bp_daily', user_id, row)
+            return series.trends(recorded_at)
+
+    def bp_history(self, user_id, days=90):
+        """Per-day blood-pressure means for the last `days` days (oldest first)"""
+        with self._hold(user_id, 'bp_history'):
+            series = self._map('bp_records').get(user_id)
+            return [] if series is None else series.history(days)
+
+    def add_intake(self, user_id, nutrition, meals, trigger_counts=()):
+        """Add nutrient amounts, meal rows and running counts to today's intake.
+
+        Returns (before, after) nutrient totals read in the same critical
+        section as the increment, so threshold crossings computed from them
+        fire exactly once however many updates race.
+        """
+        with self._hold(user_id, 'add_intake'):
+            user_map = self._map('daily_intake')
+            intake = self._intake(user_id)
+            if intake is None:
+                intake = user_map[user_id] = DailyIntake()
+            before = intake.totals()
+            intake.add(nutrition, meals, trigger_counts)
+            user_map.touch(user_id)
+            return before, intake.totals()
+
+    def claim(self, namespace, owner, key, ttl):
+        """Hold key for ttl seconds unless it is already held; True if this call got it.
+
+        Keys of one (namespace, owner) should share a ttl, so insertion
+        order stays expiry order.
+        """
+        now = time.monotonic()
+        with self._claims_lock:
+            claims = self._claims.get((namespace, owner))
+            if claims is None:
+                claims = self._claims[(namespace, owner)] = OrderedDict()
+            else:
+                _expire_claims(claims, now)
+            if key in claims:
+                return False
+            claims[key] = now + ttl
+            return True
+
+    def release(self, namespace, owner, key=None):
+        """Drop one claim, or every claim of owner in namespace when key is None"""
+        with self._claims_lock:
+            if key is None:
+                self._claims.pop((namespace, owner), None)
+                return
+            claims = self._claims.get((namespace, owner))
+            if claims is not None:
+                claims.pop(key, None)
+                if not claims:
+                    del self._claims[(namespace, owner)]
+
+    def _sweep_claims(self, now):
+        with self._claims_lock:
+            for group, claims in list(self._claims.items()):
+                _expire_claims(claims, now)
+                if not claims:
+                    del self._claims[group]
+
+    def evict_idle(self, now=None):
+        """Evict users idle past idle_ttl from memory; returns how many went"""
+        if not self._sweep_lock.acquire(blocking=False):
+            return 0  # Another thread is already sweeping
+        try:
+            now = time.monotonic() if now is None else now
+            self._next_sweep = now + self.sweep_interval
+            self._sweep_claims(now)
+            if not self.storage.persistent:
+                return 0  # Memory is the only copy - nothing can be dropped
+            cutoff = now - self.idle_ttl
+            evicted = 0
+            for user_id, seen in list(self._last_seen.items()):
+                if seen > cutoff:
+                    continue
+                with self.locks.hold(user_id):
+                    # Re-check under the lock; users with unflushed writes stay
+                    if self._last_seen.get(user_id, now) <= cutoff and self.storage.evict_user(user_id):
+                        del self._last_seen[user_id]
+                        evicted += 1
+            return evicted
+        finally:
+            self._sweep_lock.release()
+
+    def stats(self):
+        with self._claims_lock:
+            claims = sum(len(claims) for claims in self._claims.values())
+        return {
+            'hot_users': len(self._last_seen),
+            'claims': claims,
+            'idle_ttl': self.idle_ttl,
+            'locks': self.locks.stats(),
+            'storage': self.storage.stats()
+        }
+
+
+def _expire_claims(claims, now):
+    while claims:
+        key, expires_at = next(iter(claims.items()))
+        if expires_at > now:
+            break
+        del claims[key]
+
+
+class StateManager(BaseManager):
+    pass
+
+
+_server_store = None
+_server_store_lock = threading.Lock()
+
+
+def _get_store():
+    global _server_store
+    with _server_store_lock:
+        if _server_store is None:
+            _server_store = StateStore(open_storage())
+        return _server_store
+
+
+StateManager.register('state', callable=_get_store)
+
+
+def _parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _require_authkey(authkey):
+    # The old built-in default is public, so it counts as no key at all
+    if not authkey or authkey == b'nutriline':
+        raise RuntimeError(
+            "STATE_SERVER_AUTHKEY must be set to a secret to use the state server, e.g. "
+            "python -c 'import secrets; print(secrets.token_hex(32))'"
+        )
+
+
+def serve(address=STATE_SERVER_ADDRESS, authkey=STATE_SERVER_AUTHKEY):
+    """Run the state server in this process until it is killed"""
+    _require_authkey(authkey)
+    manager = StateManager(address=_parse_address(address), authkey=authkey)
+    try:
+        server = manager.get_server()
+    except OSError as e:
+        # Usually another worker started the server first
+        logger.warning("not serving on %s: %s", address, e)
+        return
+    logger.info("serving on %s", address)
+    server.serve_forever()
+
+
+def connect_state(address=STATE_SERVER_ADDRESS, authkey=STATE_SERVER_AUTHKEY,
+                  autostart=STATE_SERVER_AUTOSTART, timeout=10.0):
+    """Proxy to the StateStore in the state server, starting one if needed"""
+    _require_authkey(authkey)
+    manager = StateManager(address=_parse_address(address), authkey=authkey)
+    deadline = time.monotonic() + timeout
+    started = False
+    while True:
+        try:
+            manager.connect()
+            return manager.state()
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() > deadline:
+                raise
+            if autostart and not started:
+                # Detached so it outlives the worker that started it. If several
+                # workers race here, the losers fail to bind and exit.
+                subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                 start_new_session=True, env=dict(
+                                     os.environ,
+                                     STATE_SERVER_ADDRESS=address,
+                                     STATE_SERVER_AUTHKEY=authkey.decode()
+                                 ))
+                started = True
+            time.sleep(0.1)
+
+
+def open_state(backend=STATE_BACKEND):
+    """StateStore for STATE_BACKEND: in-process or a proxy to the shared server"""
+    if backend == 'local':
+        return StateStore(open_storage())
+    if backend == 'server':
+        return connect_state()
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'),
+                        format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    serve()
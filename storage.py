@@ -0,0 +1,968 @@
+# storage.py - Pluggable persistent storage for per-user state
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from itertools import count, zip_longest
+from datetime import datetime, timedelta, timezone
+
+# 'sqlite' keeps state across restarts, 'memory' is the old dict-only behaviour
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+STORAGE_PATH = os.getenv('STORAGE_PATH', 'nutriline.db')
+# Write-behind: dirty users are committed in one transaction this often,
+# or sooner once this many are waiting
+STORAGE_FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', '0.5'))
+STORAGE_FLUSH_BATCH = int(os.getenv('STORAGE_FLUSH_BATCH', '200'))
+# Meal descriptions kept per day (the summary shows the last few)
+MEAL_HISTORY = int(os.getenv('MEAL_HISTORY', '30'))
+# Blood-pressure readings below both of these count as on target
+BP_TARGET_SYSTOLIC = int(os.getenv('BP_TARGET_SYSTOLIC', '130'))
+BP_TARGET_DIASTOLIC = int(os.getenv('BP_TARGET_DIASTOLIC', '80'))
+# Readings stay individual in memory this many days, then fold into per-day
+# rollups (never fewer than the 30-day trend window)
+BP_RAW_DAYS = max(30, int(os.getenv('BP_RAW_DAYS', '30')))
+
+# Days roll over at local midnight in the patients' timezone
+LOCAL_TIMEZONE = os.getenv('LOCAL_TIMEZONE', 'Asia/Taipei')
+try:
+    from zoneinfo import ZoneInfo
+    _TZ = ZoneInfo(LOCAL_TIMEZONE)
+except Exception:
+    # No tz database on this box - Taiwan has no DST, so a fixed offset is exact
+    _TZ = timezone(timedelta(hours=8), LOCAL_TIMEZONE)
+
+_MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+
+def local_now():
+    return datetime.now(_TZ)
+
+
+def local_day():
+    """Today's date (YYYY-MM-DD) in LOCAL_TIMEZONE"""
+    # Interned so every record for the same day shares one string
+    return sys.intern(local_now().strftime('%Y-%m-%d'))
+
+
+# Every change to any DailyIntake gets a new number, so (user, revision)
+# identifies one exact state of a user's day - even across /clear
+_REVISIONS = count(1)
+
+# Joins a day's meal descriptions into one string: the ASCII unit separator
+# never appears in a LINE message
+_MEAL_SEP = '\x1f'
+
+
+def _join_meals(meals):
+    return _MEAL_SEP.join(meal.replace(_MEAL_SEP, ' ') for meal in meals)
+
+
+class DailyIntake:
+    """One user's open day: fixed numeric fields plus a bounded meal history.
+
+    trigger_counts holds running per-day counts that callers maintain at
+    write time (e.g. trigger foods), so readers never rescan the meals.
+    None means unknown (a row saved before the counts existed).
+    """
+
+    __slots__ = ('day', 'calories', 'protein', 'carbs', 'fat', 'sodium', 'meal_count', 'meal_text',
+                 'trigger_counts', 'revision')
+
+    def __init__(self, day=None, calories=0.0, protein=0.0, carbs=0.0, fat=0.0, sodium=0.0,
+                 meals=(), meal_count=None, trigger_counts=()):
+        self.day = day or local_day()
+        self.calories = calories
+        self.protein = protein
+        self.carbs = carbs
+        self.fat = fat
+        self.sodium = sodium
+        # Bounded to the latest MEAL_HISTORY descriptions; meal_count counts them all.
+        # Held as one joined string (None when empty): a list of separate
+        # strings costs a ~75-byte header per meal plus the list itself
+        meals = list(meals)[-MEAL_HISTORY:]
+        self.meal_text = _join_meals(meals) if meals else None
+        self.meal_count = max(meal_count or 0, len(meals))
+        self.trigger_counts = None if trigger_counts is None else tuple(trigger_counts)
+        self.revision = next(_REVISIONS)
+
+    def add(self, nutrition, meals, trigger_counts=()):
+        self.calories += nutrition.get('calories', 0)
+        self.protein += nutrition.get('protein', 0)
+        self.carbs += nutrition.get('carbs', 0)
+        self.fat += nutrition.get('fat', 0)
+        self.sodium += nutrition.get('sodium', 0)
+        if meals:
+            added = _join_meals(meals)
+            text = added if self.meal_text is None else self.meal_text + _MEAL_SEP + added
+            if text.count(_MEAL_SEP) >= MEAL_HISTORY:
+                text = _MEAL_SEP.join(text.split(_MEAL_SEP)[-MEAL_HISTORY:])
+            self.meal_text = text
+        self.meal_count += len(meals)
+        if self.trigger_counts is not None:
+            self.trigger_counts = tuple(
+                a + b for a, b in zip_longest(self.trigger_counts, trigger_counts, fillvalue=0)
+            )
+        self.revision = next(_REVISIONS)
+
+    @property
+    def meals(self):
+        """The kept meal descriptions, oldest first (a new list)"""
+        return [] if self.meal_text is None else self.meal_text.split(_MEAL_SEP)
+
+    def totals(self):
+        return {'calories': self.calories, 'protein': self.protein, 'carbs': self.carbs,
+                'fat': self.fat, 'sodium': self.sodium}
+
+    def to_dict(self):
+        """The plain-dict shape callers and the database use"""
+        intake = self.totals()
+        intake['day'] = self.day
+        intake['meals'] = self.meals
+        intake['meal_count'] = self.meal_count
+        intake['trigger_counts'] = self.trigger_counts
+        intake['revision'] = self.revision
+        return intake
+
+    @classmethod
+    def from_dict(cls, intake):
+        return cls(intake.get('day'), intake['calories'], intake['protein'], intake['carbs'],
+                   intake['fat'], intake['sodium'], intake.get('meals', ()), intake.get('meal_count'),
+                   intake.get('trigger_counts', ()))
+
+    def compact(self):
+        """Fixed-size aggregate of a closed day (totals and meal count, no meal text)"""
+        totals = self.totals()
+        totals['day'] = self.day
+        totals['meal_count'] = self.meal_count
+        return totals
+
+
+def parse_bp(text):
+    """(systolic, diastolic) from '130/85'; ValueError if it isn't a plausible reading"""
+    systolic, _, diastolic = text.strip().partition('/')
+    systolic, diastolic = int(systolic), int(diastolic)
+    if not (50 <= systolic <= 300 and 30 <= diastolic <= 200 and diastolic < systolic):
+        raise ValueError(f"implausible blood pressure: {text}")
+    return systolic, diastolic
+
+
+def bp_day(timestamp):
+    """Local day (YYYY-MM-DD) of an epoch timestamp"""
+    return sys.intern(datetime.fromtimestamp(timestamp, _TZ).strftime('%Y-%m-%d'))
+
+
+def bp_period(timestamp):
+    """'morning' (04-12h), 'evening' (17-04h) or None for a reading's local time"""
+    hour = datetime.fromtimestamp(timestamp, _TZ).hour
+    if 4 <= hour < 12:
+        return 'morning'
+    if hour >= 17 or hour < 4:
+        return 'evening'
+    return None
+
+
+def _at_target(systolic, diastolic):
+    return systolic < BP_TARGET_SYSTOLIC and diastolic < BP_TARGET_DIASTOLIC
+
+
+def _mean(total, n):
+    return round(total / n, 1) if n else None
+
+
+_WEEK = 7 * 86400
+_MONTH = 30 * 86400
+# BPSeries._sums layout: week [count, systolic, diastolic]; month [count,
+# systolic, diastolic, at target] then morning and evening [count, systolic,
+# diastolic] within it; all-time [count, systolic, diastolic, at target]
+_WEEK_SUMS = 0
+_MONTH_SUMS = 3
+_MORNING_SUMS = 7
+_EVENING_SUMS = 10
+_TOTAL_SUMS = 13
+_SUM_FIELDS = 17
+
+
+class BPRollups:
+    """Per-day aggregates of readings older than the raw window, one column each"""
+
+    __slots__ = ('days', 'count', 'systolic_sum', 'diastolic_sum', 'systolic_min', 'systolic_max',
+                 'at_target')
+
+    def __init__(self):
+        self.days = []
+        self.count = array('I')
+        self.systolic_sum = array('I')
+        self.diastolic_sum = array('I')
+        self.systolic_min = array('H')
+        self.systolic_max = array('H')
+        self.at_target = array('I')
+
+    def append(self, row):
+        """Add a (day, count, systolic_sum, diastolic_sum, systolic_min, systolic_max, at_target) row"""
+        self.days.append(sys.intern(row[0]))
+        self.count.append(row[1])
+        self.systolic_sum.append(row[2])
+        self.diastolic_sum.append(row[3])
+        self.systolic_min.append(row[4])
+        self.systolic_max.append(row[5])
+        self.at_target.append(row[6])
+
+
+class BPSeries:
+    """One user's full blood-pressure history as parallel columns plus running trend sums.
+
+    Readings from the last BP_RAW_DAYS days are kept one by one as epoch
+    seconds and parsed systolic/diastolic values; older days fold into
+    BPRollups, so years of twice-daily readings stay a few KB. The 7- and
+    30-day means, the morning/evening split and the at-target share are
+    running sums: an append adds the new reading and slides each window's
+    start past the readings that aged out, so reading the trends never
+    rescans the history.
+    """
+
+    __slots__ = ('times', 'systolic', 'diastolic', 'rollups', '_w7', '_w30', '_sums')
+
+    def __init__(self):
+        self.times = array('q')
+        self.systolic = array('H')
+        self.diastolic = array('H')
+        self.rollups = None  # BPRollups once a day has been folded
+        # Index of the first reading inside each window
+        self._w7 = 0
+        self._w30 = 0
+        # Running sums in one flat array (a list of ints costs ~3x the memory):
+        # see the _WEEK_SUMS / _MONTH_SUMS / _TOTAL_SUMS offsets
+        self._sums = array('q', bytes(8 * _SUM_FIELDS))
+
+    def _push(self, timestamp, systolic, diastolic):
+        if self.times and timestamp < self.times[-1]:
+            # Windows only slide forward; a clock stepping back files the reading as the latest
+            timestamp = self.times[-1]
+        self.times.append(timestamp)
+        self.systolic.append(systolic)
+        self.diastolic.append(diastolic)
+        sums = self._sums
+        sums[_TOTAL_SUMS] += 1
+        sums[_TOTAL_SUMS + 1] += systolic
+        sums[_TOTAL_SUMS + 2] += diastolic
+        sums[_TOTAL_SUMS + 3] += _at_target(systolic, diastolic)
+        sums[_WEEK_SUMS] += 1
+        sums[_WEEK_SUMS + 1] += systolic
+        sums[_WEEK_SUMS + 2] += diastolic
+        self._count_month(timestamp, systolic, diastolic, 1)
+        return timestamp
+
+    def _count_month(self, timestamp, systolic, diastolic, sign):
+        sums = self._sums
+        sums[_MONTH_SUMS] += sign
+        sums[_MONTH_SUMS + 1] += sign * systolic
+        sums[_MONTH_SUMS + 2] += sign * diastolic
+        sums[_MONTH_SUMS + 3] += sign * _at_target(systolic, diastolic)
+        period = bp_period(timestamp)
+        if period is not None:
+            base = _MORNING_SUMS if period == 'morning' else _EVENING_SUMS
+            sums[base] += sign
+            sums[base + 1] += sign * systolic
+            sums[base + 2] += sign * diastolic
+
+    def append(self, timestamp, systolic, diastolic):
+        """Add a reading; returns (stored timestamp, rollup rows for days it closed)"""
+        timestamp = self._push(timestamp, systolic, diastolic)
+        self.slide(timestamp)
+        return timestamp, self._roll(timestamp)
+
+    def slide(self, now):
+        """Drop readings older than 7 / 30 days before `now` from the window sums"""
+        times, systolic, diastolic = self.times, self.systolic, self.diastolic
+        end = len(times)
+        i, sums, cutoff = self._w7, self._sums, now - _WEEK
+        while i < end and times[i] <= cutoff:
+            sums[_WEEK_SUMS] -= 1
+            sums[_WEEK_SUMS + 1] -= systolic[i]
+            sums[_WEEK_SUMS + 2] -= diastolic[i]
+            i += 1
+        self._w7 = i
+        i, cutoff = self._w30, now - _MONTH
+        while i < end and times[i] <= cutoff:
+            self._count_month(times[i], systolic[i], diastolic[i], -1)
+            i += 1
+        self._w30 = i
+
+    def _roll(self, now):
+        """Fold whole days older than BP_RAW_DAYS into rollups; returns the new rows"""
+        times = self.times
+        if not times:
+            return []
+        cutoff = bp_day(now - BP_RAW_DAYS * 86400)
+        rows = []
+        end = 0
+        while end < len(times):
+            day = bp_day(times[end])
+            if day >= cutoff:
+                break
+            start = end
+            while end < len(times) and bp_day(times[end]) == day:
+                end += 1
+            systolic = self.systolic[start:end]
+            diastolic = self.diastolic[start:end]
+            rows.append((day, end - start, sum(systolic), sum(diastolic), min(systolic), max(systolic),
+                         sum(map(_at_target, systolic, diastolic))))
+        if rows:
+            # Those days are past the 30-day window, so the window sums no longer include them
+            del times[:end], self.systolic[:end], self.diastolic[:end]
+            self._w7 -= end
+            self._w30 -= end
+            self._add_rollups(rows, count_total=False)
+        return rows
+
+    def _add_rollups(self, rows, count_total):
+        if self.rollups is None:
+            self.rollups = BPRollups()
+        sums = self._sums
+        for row in rows:
+            self.rollups.append(row)
+            if count_total:
+                sums[_TOTAL_SUMS] += row[1]
+                sums[_TOTAL_SUMS + 1] += row[2]
+                sums[_TOTAL_SUMS + 2] += row[3]
+                sums[_TOTAL_SUMS + 3] += row[6]
+
+    @classmethod
+    def from_rows(cls, rollups, readings):
+        """Rebuild from stored rollup rows and (timestamp, systolic, diastolic) readings"""
+        series = cls()
+        if rollups:
+            series._add_rollups(rollups, count_total=True)
+        for timestamp, systolic, diastolic in readings:
+            series._push(timestamp, systolic, diastolic)
+        if readings:
+            series.slide(series.times[-1])
+        return series
+
+    def recent(self, limit=7):
+        """The latest readings as plain dicts, oldest first"""
+        return [
+            {'datetime': datetime.fromtimestamp(timestamp, _TZ).strftime('%Y-%m-%d %H:%M'),
+             'systolic': systolic, 'diastolic': diastolic, 'value': f"{systolic}/{diastolic}"}
+            for timestamp, systolic, diastolic in zip(self.times[-limit:], self.systolic[-limit:],
+                                                      self.diastolic[-limit:])
+        ]
+
+    def trends(self, now=None):
+        """Rolling means, morning vs evening and the at-target share - O(1) amortised"""
+        self.slide(int(time.time()) if now is None else now)
+        sums = self._sums
+        week = sums[_WEEK_SUMS:_WEEK_SUMS + 3]
+        month = sums[_MONTH_SUMS:_TOTAL_SUMS]
+        total = sums[_TOTAL_SUMS:]
+        return {
+            'count_7d': week[0],
+            'systolic_7d': _mean(week[1], week[0]),
+            'diastolic_7d': _mean(week[2], week[0]),
+            'count_30d': month[0],
+            'systolic_30d': _mean(month[1], month[0]),
+            'diastolic_30d': _mean(month[2], month[0]),
+            'at_target_30d': _mean(100 * month[3], month[0]),
+            'morning_count_30d': month[4],
+            'morning_systolic_30d': _mean(month[5], month[4]),
+            'morning_diastolic_30d': _mean(month[6], month[4]),
+            'evening_count_30d': month[7],
+            'evening_systolic_30d': _mean(month[8], month[7]),
+            'evening_diastolic_30d': _mean(month[9], month[7]),
+            'count_all': total[0],
+            'systolic_all': _mean(total[1], total[0]),
+            'diastolic_all': _mean(total[2], total[0]),
+            'at_target_all': _mean(100 * total[3], total[0])
+        }
+
+    def history(self, days=90, now=None):
+        """Per-day [(day, count, systolic mean, diastolic mean, at-target %)] for the last `days` days"""
+        now = int(time.time()) if now is None else now
+        first = bp_day(now - (days - 1) * 86400)
+        out = []
+        rollups = self.rollups
+        if rollups is not None:
+            for i in range(bisect_left(rollups.days, first), len(rollups.days)):
+                n = rollups.count[i]
+                out.append((rollups.days[i], n, _mean(rollups.systolic_sum[i], n),
+                            _mean(rollups.diastolic_sum[i], n), _mean(100 * rollups.at_target[i], n)))
+        by_day = {}
+        for timestamp, systolic, diastolic in zip(self.times, self.systolic, self.diastolic):
+            day = bp_day(timestamp)
+            if day < first:
+                continue
+            sums = by_day.get(day)
+            if sums is None:
+                sums = by_day[day] = [0, 0, 0, 0]
+            sums[0] += 1
+            sums[1] += systolic
+            sums[2] += diastolic
+            sums[3] += _at_target(systolic, diastolic)
+        out.extend((day, n, _mean(systolic, n), _mean(diastolic, n), _mean(100 * at_target, n))
+                   for day, (n, systolic, diastolic, at_target) in by_day.items())
+        return out
+
+
+# Per-user fields, each backed by the table of the same name
+SESSION_FIELDS = ('daily_intake', 'bp_records', 'medication_taken', 'exercise_log',
+                  'first_message', 'conversation_count')
+
+_UNLOADED = object()
+
+
+class UserSession:
+    """Everything held in memory for one user, behind a single lookup by user id.
+
+    A field is _UNLOADED until first read, _MISSING when the user has no
+    stored value, and the value otherwise.
+    """
+
+    __slots__ = SESSION_FIELDS
+
+    def __init__(self):
+        self.daily_intake = _UNLOADED
+        self.bp_records = _UNLOADED
+        self.medication_taken = _UNLOADED
+        self.exercise_log = _UNLOADED
+        self.first_message = _UNLOADED
+        self.conversation_count = _UNLOADED
+
+
+class IntakeTable:
+    """The open day's intake, one row per user per day until it is compacted"""
+
+    name = 'daily_intake'
+    schema = """
+        CREATE TABLE IF NOT EXISTS daily_intake (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            calories REAL NOT NULL DEFAULT 0,
+            protein REAL NOT NULL DEFAULT 0,
+            carbs REAL NOT NULL DEFAULT 0,
+            fat REAL NOT NULL DEFAULT 0,
+            sodium REAL NOT NULL DEFAULT 0,
+            meals TEXT NOT NULL DEFAULT '[]',
+            meal_count INTEGER NOT NULL DEFAULT 0,
+            trigger_counts TEXT,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID;
+    """
+
+    def load(self, conn, user_id):
+        # The latest open day - a day from before a restart is rolled over by the caller
+        row = conn.execute(
+            "SELECT day, calories, protein, carbs, fat, sodium, meals, meal_count, trigger_counts "
+            "FROM daily_intake WHERE user_id = ? ORDER BY day DESC LIMIT 1", (user_id,)
+        ).fetchone()
+        if row is None:
+            return _MISSING
+        trigger_counts = None if row[8] is None else json.loads(row[8])
+        return DailyIntake(row[0], row[1], row[2], row[3], row[4], row[5], json.loads(row[6]), row[7],
+                           trigger_counts)
+
+    def save(self, conn, user_id, intake):
+        conn.execute(
+            "INSERT OR REPLACE INTO daily_intake VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, intake['day'], intake['calories'], intake['protein'],
+             intake['carbs'], intake['fat'], intake['sodium'],
+             json.dumps(intake['meals'], ensure_ascii=False), intake['meal_count'],
+             None if intake['trigger_counts'] is None else json.dumps(intake['trigger_counts']))
+        )
+
+
+class DailyTotalsTable:
+    """Closed days compacted to fixed-size totals; replaces the day's intake row"""
+
+    name = 'daily_totals'
+    schema = """
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            calories REAL NOT NULL,
+            protein REAL NOT NULL,
+            carbs REAL NOT NULL,
+            fat REAL NOT NULL,
+            sodium REAL NOT NULL,
+            meal_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID;
+    """
+
+    def save(self, conn, user_id, totals):
+        conn.execute(
+            "INSERT OR REPLACE INTO daily_totals VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, totals['day'], totals['calories'], totals['protein'], totals['carbs'],
+             totals['fat'], totals['sodium'], totals['meal_count'])
+        )
+        conn.execute("DELETE FROM daily_intake WHERE user_id = ? AND day = ?", (user_id, totals['day']))
+
+
+class BPSeriesTable:
+    """Loads a user's BPSeries: daily rollups plus the readings after the last rolled-up day"""
+
+    name = 'bp_records'
+    schema = ""
+
+    def load(self, conn, user_id):
+        rollups = conn.execute(
+            "SELECT day, count, systolic_sum, diastolic_sum, systolic_min, systolic_max, at_target "
+            "FROM bp_daily WHERE user_id = ? ORDER BY day", (user_id,)
+        ).fetchall()
+        after = rollups[-1][0] if rollups else ''
+        readings = conn.execute(
+            "SELECT recorded_at, systolic, diastolic FROM bp_readings "
+            "WHERE user_id = ? AND day > ? ORDER BY recorded_at, rowid", (user_id, after)
+        ).fetchall()
+        if not rollups and not readings:
+            return _MISSING
+        return BPSeries.from_rows(rollups, readings)
+
+
+class BPReadingTable:
+    """Every blood-pressure reading ever taken, appended once and never rewritten"""
+
+    name = 'bp_readings'
+    schema = """
+        CREATE TABLE IF NOT EXISTS bp_readings (
+            user_id TEXT NOT NULL,
+            recorded_at INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            systolic INTEGER NOT NULL,
+            diastolic INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS bp_readings_user_day ON bp_readings (user_id, day);
+    """
+
+    def save(self, conn, user_id, reading):
+        timestamp, systolic, diastolic = reading
+        conn.execute("INSERT INTO bp_readings VALUES (?, ?, ?, ?, ?)",
+                     (user_id, timestamp, bp_day(timestamp), systolic, diastolic))
+
+
+class BPDailyTable:
+    """Per-day blood-pressure rollups of days that left the in-memory raw window"""
+
+    name = 'bp_daily'
+    schema = """
+        CREATE TABLE IF NOT EXISTS bp_daily (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            systolic_sum INTEGER NOT NULL,
+            diastolic_sum INTEGER NOT NULL,
+            systolic_min INTEGER NOT NULL,
+            systolic_max INTEGER NOT NULL,
+            at_target INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID;
+    """
+
+    def save(self, conn, user_id, row):
+        conn.execute("INSERT OR REPLACE INTO bp_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (user_id,) + tuple(row))
+
+
+class DailyValueTable:
+    """One value per user per day, such as medication taken and exercise minutes.
+
+    Memory only holds the latest (day, value); earlier days stay in the table.
+    """
+
+    def __init__(self, name, column_type):
+        self.name = name
+        self.schema = f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                user_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                value {column_type} NOT NULL,
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID;
+        """
+
+    def load(self, conn, user_id):
+        row = conn.execute(
+            f"SELECT day, value FROM {self.name} WHERE user_id = ? ORDER BY day DESC LIMIT 1",
+            (user_id,)
+        ).fetchone()
+        return _MISSING if row is None else row
+
+    def save(self, conn, user_id, day_value):
+        day, value = day_value
+        conn.execute(f"INSERT OR REPLACE INTO {self.name} VALUES (?, ?, ?)", (user_id, day, value))
+
+
+class UserValueTable:
+    """{user_id: scalar} maps such as first-message flags and conversation counts"""
+
+    def __init__(self, name, column_type):
+        self.name = name
+        self.schema = f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                user_id TEXT PRIMARY KEY,
+                value {column_type} NOT NULL
+            ) WITHOUT ROWID;
+        """
+
+    def load(self, conn, user_id):
+        row = conn.execute(f"SELECT value FROM {self.name} WHERE user_id = ?", (user_id,)).fetchone()
+        return _MISSING if row is None else row[0]
+
+    def save(self, conn, user_id, value):
+        conn.execute(f"INSERT OR REPLACE INTO {self.name} VALUES (?, ?)", (user_id, value))
+
+
+TABLES = {
+    'daily_intake': IntakeTable(),
+    'daily_totals': DailyTotalsTable(),
+    'bp_readings': BPReadingTable(),
+    'bp_daily': BPDailyTable(),
+    'bp_records': BPSeriesTable(),
+    'medication_taken': DailyValueTable('medication_taken', 'INTEGER'),
+    'exercise_log': DailyValueTable('exercise_log', 'INTEGER'),
+    'first_message': UserValueTable('first_message', 'INTEGER'),
+    'conversation_count': UserValueTable('conversation_count', 'INTEGER')
+}
+
+
+class MemoryBackend:
+    """Nothing is persisted - every lookup misses and writes are dropped"""
+
+    def load(self, table, user_id):
+        return _MISSING
+
+    def save_batch(self, batch):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """WAL-mode SQLite: one connection for read-through loads, one for batched writes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = self._connect()
+        for table in TABLES.values():
+            self._writer.executescript(table.schema)
+        self._migrate()
+        self._reader = self._connect()
+        self._read_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _migrate(self):
+        """Bring databases created by older versions up to the current schema"""
+        columns = [row[1] for row in self._writer.execute("PRAGMA table_info(daily_intake)")]
+        if 'meal_count' not in columns:
+            self._writer.execute(
+                "ALTER TABLE daily_intake ADD COLUMN meal_count INTEGER NOT NULL DEFAULT 0"
+            )
+        if 'trigger_counts' not in columns:
+            self._writer.execute("ALTER TABLE daily_intake ADD COLUMN trigger_counts TEXT")
+        legacy = self._writer.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bp_records'"
+        ).fetchone()
+        if legacy:
+            self._migrate_bp_records()
+
+    def _migrate_bp_records(self):
+        """Parse the old last-7 '130/85' text rows into bp_readings, keeping the old table aside"""
+        conn = self._writer
+        conn.execute("BEGIN")
+        try:
+            for user_id, recorded_at, value in conn.execute(
+                    "SELECT user_id, recorded_at, value FROM bp_records ORDER BY rowid").fetchall():
+                try:
+                    systolic, diastolic = parse_bp(value)
+                    when = datetime.strptime(recorded_at, '%Y-%m-%d %H:%M').replace(tzinfo=_TZ)
+                except ValueError:
+                    continue  # Unparseable readings were never shown correctly either
+                TABLES['bp_readings'].save(conn, user_id, (int(when.timestamp()), systolic, diastolic))
+            conn.execute("ALTER TABLE bp_records RENAME TO bp_records_legacy")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps synchronous=NORMAL crash-safe; only the last commit can be lost on power failure
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def load(self, table, user_id):
+        with self._read_lock:
+            return TABLES[table].load(self._reader, user_id)
+
+    def save_batch(self, batch):
+        """Write [(table, user_id, value), ...] in a single transaction"""
+        with self._write_lock:
+            conn = self._writer
+            conn.execute("BEGIN")
+            try:
+                for table, user_id, value in batch:
+                    TABLES[table].save(conn, user_id, value)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        with self._read_lock:
+            self._reader.close()
+
+
+class UserMap:
+    """Dict-like view of one field of every UserSession.
+
+    Reads and writes hit the in-memory session; a field the session hasn't
+    loaded yet is read from the backend once. Assignments mark the user
+    dirty automatically - callers that mutate a value in place (append, +=
+    on a nested key) call touch().
+    """
+
+    def __init__(self, storage, table):
+        self._storage = storage
+        self._table = table
+        self._lock = threading.Lock()
+
+    def _load(self, user_id):
+        session = self._storage.session(user_id)
+        value = getattr(session, self._table)
+        if value is not _UNLOADED:
+            return value
+        value = self._storage.load(self._table, user_id)
+        with self._lock:
+            current = getattr(session, self._table)
+            if current is not _UNLOADED:
+                return current
+            setattr(session, self._table, value)
+        return value
+
+    def __contains__(self, user_id):
+        return self._load(user_id) is not _MISSING
+
+    def __getitem__(self, user_id):
+        value = self._load(user_id)
+        if value is _MISSING:
+            raise KeyError(user_id)
+        return value
+
+    def get(self, user_id, default=None):
+        value = self._load(user_id)
+        return default if value is _MISSING else value
+
+    def __setitem__(self, user_id, value):
+        setattr(self._storage.session(user_id), self._table, value)
+        self._storage.mark_dirty(self._table, user_id, self)
+
+    def cache(self, user_id, value):
+        """Hold a value in the session without scheduling a write - its rows go out as records"""
+        setattr(self._storage.session(user_id), self._table, value)
+
+    def touch(self, user_id):
+        """Schedule a write of a value that was changed in place"""
+        self._storage.mark_dirty(self._table, user_id, self)
+
+    def snapshot(self, user_id):
+        session = self._storage.peek_session(user_id)
+        if session is None:
+            return _MISSING
+        value = getattr(session, self._table)
+        return _MISSING if value is _UNLOADED else value
+
+
+class Storage:
+    """Owns the backend, the per-table UserMaps and the write-behind flusher"""
+
+    def __init__(self, backend, flush_interval=STORAGE_FLUSH_INTERVAL, flush_batch=STORAGE_FLUSH_BATCH):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._maps = {}
+        self._sessions = {}  # user_id -> UserSession
+        self._dirty = {}  # (table, user_id) -> UserMap
+        self._records = []  # (table, user_id, value) written once, never cached
+        self._inflight = set()  # dirty keys taken by a flush that hasn't committed yet
+        self._dirty_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'loads': 0,
+            'load_time_total': 0.0,
+            'flushes': 0,
+            'rows_written': 0,
+            'flush_time_total': 0.0,
+            'flush_errors': 0,
+            'evicted': 0
+        }
+
+    def map(self, table):
+        if table not in self._maps:
+            self._maps[table] = UserMap(self, table)
+        return self._maps[table]
+
+    def session(self, user_id):
+        """The user's UserSession, created empty on first use"""
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._sessions.setdefault(user_id, UserSession())
+        return session
+
+    def peek_session(self, user_id):
+        return self._sessions.get(user_id)
+
+    def load(self, table, user_id):
+        start = time.perf_counter()
+        value = self.backend.load(table, user_id)
+        with self._stats_lock:
+            self._stats['loads'] += 1
+            self._stats['load_time_total'] += time.perf_counter() - start
+        return value
+
+    def mark_dirty(self, table, user_id, user_map):
+        if isinstance(self.backend, MemoryBackend):
+            return
+        with self._dirty_lock:
+            self._dirty[(table, user_id)] = user_map
+            pending = len(self._dirty)
+        self._scheduled(pending)
+
+    def record(self, table, user_id, value):
+        """Queue a one-off write (e.g. a compacted day) that is not kept in memory"""
+        if isinstance(self.backend, MemoryBackend):
+            return
+        with self._dirty_lock:
+            self._records.append((table, user_id, value))
+            pending = len(self._dirty) + len(self._records)
+        self._scheduled(pending)
+
+    def _scheduled(self, pending):
+        if self._thread is None:
+            self._start()
+        if pending >= self.flush_batch:
+            self._wake.set()
+
+    @property
+    def persistent(self):
+        return not isinstance(self.backend, MemoryBackend)
+
+    def evict_user(self, user_id):
+        """Drop a user's session from memory once their writes are committed.
+
+        Returns False (and keeps the user) while anything of theirs is still
+        waiting for or in the middle of a flush, or when nothing is persisted.
+        """
+        if not self.persistent:
+            return False
+        with self._dirty_lock:
+            for table in self._maps:
+                key = (table, user_id)
+                if key in self._dirty or key in self._inflight:
+                    return False
+            if any(record[1] == user_id for record in self._records):
+                return False
+            self._sessions.pop(user_id, None)
+        with self._stats_lock:
+            self._stats['evicted'] += 1
+        return True
+
+    def _start(self):
+        with self._flush_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._flusher, name='nutriline-storage', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _flusher(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("flush failed")
+
+    def flush(self):
+        """Commit every dirty user now; returns the number of rows written"""
+        with self._flush_lock:
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, {}
+                records, self._records = self._records, []
+                self._inflight = set(dirty)
+            if not dirty and not records:
+                return 0
+
+            batch = []
+            retry = {}
+            for (table, user_id), user_map in dirty.items():
+                value = user_map.snapshot(user_id)
+                if value is _MISSING:
+                    continue
+                try:
+                    # Copy now so a handler mutating the value can't tear the write
+                    if isinstance(value, DailyIntake):
+                        value = value.to_dict()
+                    else:
+                        value = json.loads(json.dumps(value))
+                    batch.append((table, user_id, value))
+                except RuntimeError:
+                    # Changed size mid-copy - pick it up on the next flush
+                    retry[(table, user_id)] = user_map
+            # After the live rows, so a compacted day's DELETE wins over a stale save
+            batch.extend(records)
+
+            start = time.perf_counter()
+            try:
+                self.backend.save_batch(batch)
+            except Exception:
+                with self._stats_lock:
+                    self._stats['flush_errors'] += 1
+                retry.update(dirty)
+                with self._dirty_lock:
+                    self._records[:0] = records
+                raise
+            finally:
+                with self._dirty_lock:
+                    for key, user_map in retry.items():
+                        self._dirty.setdefault(key, user_map)
+                    self._inflight = set()
+            with self._stats_lock:
+                self._stats['flushes'] += 1
+                self._stats['rows_written'] += len(batch)
+                self._stats['flush_time_total'] += time.perf_counter() - start
+            return len(batch)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        with self._dirty_lock:
+            stats['dirty'] = len(self._dirty)
+        stats['backend'] = type(self.backend).__name__
+        stats['sessions'] = len(self._sessions)
+        stats['load_time_avg'] = stats['load_time_total'] / stats['loads'] if stats['loads'] else 0.0
+        return stats
+
+
+def open_storage(backend=STORAGE_BACKEND, path=STORAGE_PATH):
+    """Build the Storage selected by STORAGE_BACKEND"""
+    if backend == 'memory':
+        return Storage(MemoryBackend())
+    if backend == 'sqlite':
+        return Storage(SQLiteBackend(path))
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
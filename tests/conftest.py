@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Tests import the app's flat modules from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+# gemini_handler builds its client at import; tests never reach the API
+os.environ.setdefault('GEMINI_API_KEY', 'test')
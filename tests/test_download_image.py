@@ -0,0 +1,54 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from linebot import LineBotApi
+
+from gemini_handler import ImageTooLargeError, download_image
+from http_pool import PooledLineHttpClient, PooledSession
+
+PHOTO = b'\xff\xd8\xff' + bytes(range(256)) * 40
+
+
+class ContentHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(PHOTO)))
+        self.end_headers()
+        self.wfile.write(PHOTO)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def line_api():
+    """Real LineBotApi and SDK response wrapper over a one-connection blocking pool.
+
+    A download that leaks its connection makes the next one fail with
+    PoolTimeout instead of passing unnoticed.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ContentHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    class OneConnectionClient(PooledLineHttpClient):
+        session = PooledSession('test', pool_size=1, block=True, pool_timeout=1)
+
+    endpoint = f'http://127.0.0.1:{server.server_port}'
+    yield LineBotApi('token', endpoint=endpoint, data_endpoint=endpoint, http_client=OneConnectionClient)
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_returns_the_image(line_api):
+    assert bytes(download_image(line_api, '1')) == PHOTO
+    assert bytes(download_image(line_api, '2')) == PHOTO
+
+
+def test_oversized_download_gives_the_connection_back(line_api):
+    with pytest.raises(ImageTooLargeError):
+        download_image(line_api, '1', max_bytes=100)
+    assert bytes(download_image(line_api, '2')) == PHOTO
@@ -0,0 +1,62 @@
+import io
+import os
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+from PIL import ImageEnhance
+
+from photo_index import NearDuplicateIndex, dhash
+
+SCREENSHOTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'screenshots')
+THRESHOLD = NearDuplicateIndex().threshold
+
+
+@pytest.fixture(scope='module')
+def photo():
+    return Image.open(os.path.join(SCREENSHOTS, 'photo.png')).convert('RGB')
+
+
+def distance(a, b):
+    return (dhash(a) ^ dhash(b)).bit_count()
+
+
+def centre_crop(image, share):
+    width, height = image.size
+    dx, dy = int(width * share / 2), int(height * share / 2)
+    return image.crop((dx, dy, width - dx, height - dy))
+
+
+def jpeg(image, quality):
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=quality)
+    return Image.open(io.BytesIO(out.getvalue()))
+
+
+def test_reencoded_resized_and_relit_copies_match(photo):
+    width, height = photo.size
+    for copy in (jpeg(photo, 60), photo.resize((width // 2, height // 2)),
+                 ImageEnhance.Brightness(photo).enhance(1.15), centre_crop(photo, 0.03)):
+        assert distance(photo, copy) <= THRESHOLD
+
+
+def test_unrelated_photo_does_not_match(photo):
+    other = Image.open(os.path.join(SCREENSHOTS, 'welcome.png')).convert('RGB')
+    assert distance(photo, other) > THRESHOLD
+
+
+def test_reframed_reshots_are_missed(photo):
+    # Documented limitation: these are analysed and logged as new meals
+    width, height = photo.size
+    assert distance(photo, centre_crop(photo, 0.10)) > THRESHOLD
+    assert distance(photo, photo.crop((0, 0, int(width * 0.95), height))) > THRESHOLD
+
+
+def test_find_and_forget(photo):
+    index = NearDuplicateIndex()
+    index.add('u1', dhash(photo), 'analysis')
+    found = index.find('u1', dhash(jpeg(photo, 60)))
+    assert found is not None and found[1] == 'analysis'
+    assert index.find('u2', dhash(photo)) is None
+    index.forget('u1')
+    assert index.find('u1', dhash(photo)) is None
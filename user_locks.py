@@ -0,0 +1,61 @@
+# user_locks.py - Sharded per-user locks for read-modify-write state updates
+
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+USER_LOCK_SHARDS = int(os.getenv('USER_LOCK_SHARDS', '64'))
+
+
+class ShardedLocks:
+    """Fixed pool of locks; a user always maps to the same shard.
+
+    Updates for one user are serialized while different users almost never
+    share a lock, and memory stays constant no matter how many users there
+    are. Counters live per shard and are only touched while that shard is
+    held, so bookkeeping adds no cross-user contention either.
+    """
+
+    def __init__(self, shards=USER_LOCK_SHARDS):
+        self.shards = shards
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._ops = [Counter() for _ in range(shards)]
+        self._contended = [0] * shards
+        self._wait_time = [0.0] * shards
+
+    def _shard(self, user_id):
+        return hash(user_id) % self.shards
+
+    @contextmanager
+    def hold(self, user_id, op=None):
+        """Hold the user's shard lock for the duration of the block"""
+        shard = self._shard(user_id)
+        lock = self._locks[shard]
+        if not lock.acquire(blocking=False):
+            start = time.perf_counter()
+            lock.acquire()
+            self._contended[shard] += 1
+            self._wait_time[shard] += time.perf_counter() - start
+        try:
+            if op is not None:
+                self._ops[shard][op] += 1
+            yield
+        finally:
+            lock.release()
+
+    def count(self, user_id, op):
+        """Count an event for the user's shard; call with that shard held"""
+        self._ops[self._shard(user_id)][op] += 1
+
+    def stats(self):
+        ops = Counter()
+        for shard_ops in self._ops:
+            ops.update(shard_ops)
+        return {
+            'shards': self.shards,
+            'ops': dict(ops),
+            'contended': sum(self._contended),
+            'wait_time_total': sum(self._wait_time)
+        }